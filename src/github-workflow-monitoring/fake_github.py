@@ -0,0 +1,479 @@
+"""Synthetic or replayed workflow runs and a local fake GitHub Actions API
+
+SyntheticRuns generates scheduled workflow runs for a set of repos with a
+mix of workflows, conclusions and still running runs. Runs are derived from
+their index rather than stored, and the same parameters always give the
+same data.
+
+RecordedRuns replays a fixture recorded from the real API with --record,
+with timestamps shifted so the newest recorded run is as old as it was when
+recorded, e.g.
+
+  GITHUB_TOKEN=... python3 fake_github.py --record runs.json --repos dso-certificates dso-repositories
+  python3 fake_github.py --fixture runs.json --port 8766
+
+FakeGitHubServer serves them as the actions/runs list and single run APIs,
+with ETags, and enforces GitHub style rate limits: a primary quota of
+requests per window reported in X-RateLimit-* headers, and a secondary
+limit on concurrent requests answered with 403 and Retry-After. So
+github-workflow-monitor.py can be checked to finish a sweep without being
+rate limited. Run standalone with e.g.
+
+  python3 fake_github.py --runs 2000 --rate-limit 100 --rate-window 60 --port 8766
+  GITHUB_TOKEN=fake python3 github-workflow-monitor.py -i 3600 --api-url http://127.0.0.1:8766 all
+
+GET /stats returns request counts, including any rate limited responses.
+"""
+
+import argparse
+import bisect
+import collections
+import datetime
+import hashlib
+import http.server
+import json
+import os
+import sys
+import threading
+import time
+import urllib.parse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from monitoring_common import http_client  # pylint: disable=wrong-import-position
+
+DEFAULT_RUNS = 1000
+DEFAULT_SPAN_SECS = 216000
+DEFAULT_RATE_LIMIT = 5000
+DEFAULT_RATE_WINDOW_SECS = 3600
+DEFAULT_MAX_CONCURRENT = 100
+DEFAULT_SECONDARY_RETRY_AFTER_SECS = 1
+MAX_PAGE_SIZE = 100
+DEFAULT_RECORD_URL = 'https://api.github.com'
+DEFAULT_RECORD_ORG = 'ministryofjustice'
+# fields kept when recording, i.e. those the monitor uses
+RECORDED_FIELDS = ('id', 'name', 'path', 'event', 'status', 'conclusion', 'run_number',
+                   'created_at', 'run_started_at', 'updated_at')
+RECORDED_TIMESTAMP_FIELDS = ('created_at', 'run_started_at', 'updated_at')
+# runs created within this many seconds of now are still in progress
+IN_PROGRESS_SECS = 1800
+
+REPOS = [
+    "dso-certificates",
+    "dso-infra-azure-ad",
+    "dso-infra-azure-fixngo",
+    "dso-modernisation-platform-automation",
+    "dso-repositories",
+    "dso-useful-stuff",
+]
+WORKFLOWS = [
+    'ansible-nightly', 'certificate-renewal', 'environment-start', 'environment-stop',
+    'ami-cleanup', 'database-refresh', 'backup-check',
+]
+# (conclusion, weight)
+CONCLUSIONS = [('success', 90), ('failure', 6), ('cancelled', 2), ('timed_out', 1), ('skipped', 1)]
+
+
+def fraction(value, salt):
+    """Deterministic pseudo random number in [0, 1) for an index"""
+
+    digest = hashlib.blake2b(f'{salt}:{value}'.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') / 2 ** 64
+
+
+def timestamp_str(epoch):
+    """Format epoch seconds as the API does"""
+
+    return datetime.datetime.fromtimestamp(int(epoch), datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def parse_timestamp(value):
+    """Parse a timestamp as formatted by the API to epoch seconds"""
+
+    return datetime.datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp()
+
+
+def repo_names(num_repos):
+    """Get num_repos repo names, the real repos first then made up ones"""
+
+    return REPOS[:num_repos] + [f'synthetic-repo-{i:03d}' for i in range(len(REPOS), num_repos)]
+
+
+class SyntheticRuns:
+    """Scheduled workflow runs for repos, run i of a repo created i steps
+    before now, newest first as listed by the API"""
+
+    def __init__(self, repos=None, runs=DEFAULT_RUNS, span_secs=DEFAULT_SPAN_SECS, now=None, seed=0):
+        self.repos = list(repos or REPOS)
+        self.num_runs = runs
+        self.step = span_secs / max(1, runs)
+        self.now = time.time() if now is None else now
+        self.seed = seed
+
+    def created(self, i):
+        """Epoch seconds run i was created"""
+
+        return int(self.now - i * self.step)
+
+    def runs_after(self, repo, timestamp=None):  # pylint: disable=unused-argument
+        """Number of runs in a repo created at or after epoch seconds, all
+        runs if timestamp is None"""
+
+        if timestamp is None:
+            return self.num_runs
+        if timestamp > self.now:
+            return 0
+        return min(self.num_runs, int((self.now - timestamp) / self.step) + 1)
+
+    def run_id(self, repo, i):
+        """Unique run ID"""
+
+        return self.repos.index(repo) * 10 ** 9 + i + 1
+
+    def run_index(self, run_id):
+        """Get (repo, index) of a run ID, or None if not found"""
+
+        repo_index, i = divmod(run_id - 1, 10 ** 9)
+        if run_id < 1 or repo_index >= len(self.repos) or i >= self.num_runs:
+            return None
+        return self.repos[repo_index], i
+
+    def run(self, repo, i):
+        """Workflow run i of repo"""
+
+        created = self.created(i)
+        # mostly started at once, with the odd long wait for a runner
+        started = min(self.now, created + fraction(i, f'{self.seed}{repo}queue') ** 4 * 600)
+        workflow = WORKFLOWS[int(fraction(i, f'{self.seed}{repo}workflow') * len(WORKFLOWS))]
+        in_progress = self.now - created < IN_PROGRESS_SECS
+        conclusion = None
+        if not in_progress:
+            weight = fraction(i, f'{self.seed}{repo}conclusion') * sum(w for _, w in CONCLUSIONS)
+            for conclusion, conclusion_weight in CONCLUSIONS:
+                weight -= conclusion_weight
+                if weight < 0:
+                    break
+        return {
+            'id': self.run_id(repo, i),
+            'name': workflow,
+            'path': f'.github/workflows/{workflow}.yml',
+            'event': 'schedule',
+            'status': 'in_progress' if in_progress else 'completed',
+            'conclusion': conclusion,
+            'run_number': self.num_runs - i,
+            'created_at': timestamp_str(created),
+            'run_started_at': timestamp_str(started),
+            'updated_at': timestamp_str(min(self.now, started + 60 + fraction(i, repo) * 1200)),
+        }
+
+
+class RecordedRuns:
+    """Workflow runs from a fixture written by record_runs(), newest first.
+    Timestamps are shifted by now less the time of recording, default to
+    the current time, or not at all if now is False"""
+
+    def __init__(self, fixture, now=None):
+        if now is None:
+            now = time.time()
+        offset = now - fixture['recorded'] if now is not False else 0
+        self.repos = list(fixture['repos'])
+        self.runs = {}
+        self.created_desc = {}
+        self.run_ids = {}
+        for repo, workflow_runs in fixture['repos'].items():
+            workflow_runs = [
+                dict(workflow_run, **{field: timestamp_str(parse_timestamp(workflow_run[field]) + offset)
+                                      for field in RECORDED_TIMESTAMP_FIELDS if workflow_run.get(field)})
+                for workflow_run in workflow_runs
+            ]
+            workflow_runs.sort(key=lambda workflow_run: (workflow_run['created_at'], workflow_run['id']),
+                               reverse=True)
+            self.runs[repo] = workflow_runs
+            # negated so bisect works on the newest first order
+            self.created_desc[repo] = [-parse_timestamp(workflow_run['created_at'])
+                                       for workflow_run in workflow_runs]
+            for i, workflow_run in enumerate(workflow_runs):
+                self.run_ids[workflow_run['id']] = (repo, i)
+
+    @classmethod
+    def load(cls, filename, now=None):
+        """Load a fixture file"""
+
+        with open(filename, encoding='utf-8') as f:
+            return cls(json.load(f), now)
+
+    def runs_after(self, repo, timestamp=None):
+        """Number of runs in a repo created at or after epoch seconds, all
+        runs if timestamp is None"""
+
+        if timestamp is None:
+            return len(self.runs[repo])
+        return bisect.bisect_right(self.created_desc[repo], -timestamp)
+
+    def run_index(self, run_id):
+        """Get (repo, index) of a run ID, or None if not found"""
+
+        return self.run_ids.get(run_id)
+
+    def run(self, repo, i):
+        """Workflow run i of repo"""
+
+        return self.runs[repo][i]
+
+
+def record_runs(pool, org, repos, created_after, verbose=0):
+    """List workflow runs of repos created at or after created_after, a
+    datetime, from the real API. Returns a fixture for RecordedRuns"""
+
+    fixture = {'recorded': time.time(), 'repos': {}}
+    created = created_after.strftime('%Y-%m-%dT%H:%M:%SZ')
+    for repo in repos:
+        workflow_runs = []
+        page = 1
+        while True:
+            uri = (f'/repos/{org}/{repo}/actions/runs?created=>={created}'
+                   f'&per_page={MAX_PAGE_SIZE}&page={page}')
+            response = pool.request('GET', uri)
+            if response.status != 200:
+                raise ValueError(f'{repo}: HTTP {response.status} {response.text()}')
+            page_runs = json.loads(response.body)['workflow_runs']
+            workflow_runs += [{field: workflow_run.get(field) for field in RECORDED_FIELDS}
+                              for workflow_run in page_runs]
+            if len(page_runs) < MAX_PAGE_SIZE:
+                break
+            page += 1
+        if verbose:
+            sys.stderr.write(f'{repo}: recorded {len(workflow_runs)} runs in {page} pages' + os.linesep)
+        fixture['repos'][repo] = workflow_runs
+    return fixture
+
+
+class FakeGitHubServer(http.server.ThreadingHTTPServer):
+    """Serve SyntheticRuns or RecordedRuns as the GitHub Actions runs API"""
+
+    daemon_threads = True
+
+    def __init__(self, data, port=0, latency=0, rate_limit=DEFAULT_RATE_LIMIT,
+                 rate_window_secs=DEFAULT_RATE_WINDOW_SECS, max_concurrent=DEFAULT_MAX_CONCURRENT,
+                 secondary_retry_after=DEFAULT_SECONDARY_RETRY_AFTER_SECS):
+        super().__init__(('127.0.0.1', port), FakeGitHubHandler)
+        self.data = data
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.rate_window_secs = rate_window_secs
+        self.max_concurrent = max_concurrent
+        self.secondary_retry_after = secondary_retry_after
+        self.window_reset = int(time.time()) + rate_window_secs
+        self.used = 0
+        self.in_flight = 0
+        self.stats = collections.Counter()
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        """API URL to pass to the monitor"""
+
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    def count(self, name, value=1):
+        """Count a request or record"""
+
+        with self.lock:
+            self.stats[name] += value
+
+    def get_stats(self):
+        """Get a copy of the request counters"""
+
+        with self.lock:
+            return dict(self.stats)
+
+    def start_request(self):
+        """Check rate limits for a new request. Returns (status, message,
+        headers), status None if the request may proceed"""
+
+        with self.lock:
+            now = time.time()
+            if now >= self.window_reset:
+                self.window_reset = int(now) + self.rate_window_secs
+                self.used = 0
+            self.in_flight += 1
+            headers = {
+                'X-RateLimit-Limit': str(self.rate_limit),
+                'X-RateLimit-Reset': str(self.window_reset),
+                'X-RateLimit-Resource': 'core',
+            }
+            if self.in_flight > self.max_concurrent:
+                self.stats['secondary_rate_limited'] += 1
+                headers['X-RateLimit-Remaining'] = str(self.rate_limit - self.used)
+                headers['X-RateLimit-Used'] = str(self.used)
+                headers['Retry-After'] = str(self.secondary_retry_after)
+                return 403, 'You have exceeded a secondary rate limit', headers
+            if self.used >= self.rate_limit:
+                self.stats['primary_rate_limited'] += 1
+                headers['X-RateLimit-Remaining'] = '0'
+                headers['X-RateLimit-Used'] = str(self.used)
+                return 403, 'API rate limit exceeded', headers
+            self.used += 1
+            headers['X-RateLimit-Remaining'] = str(self.rate_limit - self.used)
+            headers['X-RateLimit-Used'] = str(self.used)
+            return None, None, headers
+
+    def end_request(self, not_modified=False):
+        """Finish a request, 304 responses don't count against the quota"""
+
+        with self.lock:
+            self.in_flight -= 1
+            if not_modified:
+                self.used -= 1
+
+    def list_runs(self, repo, params):
+        """actions/runs list, created>= filter and pagination are supported"""
+
+        data = self.data
+        created = params.get('created', '')
+        total = data.runs_after(repo, parse_timestamp(created[2:]) if created.startswith('>=') else None)
+        page_size = min(int(params.get('per_page', 30)), MAX_PAGE_SIZE)
+        start = (int(params.get('page', 1)) - 1) * page_size
+        runs = [data.run(repo, i) for i in range(start, min(total, start + page_size))]
+        return {'total_count': total, 'workflow_runs': runs}
+
+
+class FakeGitHubHandler(http.server.BaseHTTPRequestHandler):
+    """Request handler for FakeGitHubServer"""
+
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately, avoid delayed ACK stalls
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+    def send_body(self, status, body, headers=None):
+        """Send a complete response"""
+
+        data = json.dumps(body).encode('utf-8') if body is not None else b''
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        if body is not None:
+            self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """GitHub API request or request counters"""
+
+        url = urllib.parse.urlsplit(self.path)
+        if url.path == '/stats':
+            self.send_body(200, self.server.get_stats())
+            return
+        status, message, headers = self.server.start_request()
+        not_modified = False
+        try:
+            if self.server.latency:
+                time.sleep(self.server.latency)
+            if status:
+                self.server.count('requests')
+                self.send_body(status, {'message': message}, headers)
+                return
+            parts = url.path.strip('/').split('/')
+            if len(parts) < 5 or parts[0] != 'repos' or parts[3:5] != ['actions', 'runs'] or \
+                    parts[2] not in self.server.data.repos:
+                self.server.count('not_found')
+                self.send_body(404, {'message': 'Not Found'}, headers)
+                return
+            repo = parts[2]
+            if len(parts) == 6:
+                self.server.count('get_run')
+                found = parts[5].isdigit() and self.server.data.run_index(int(parts[5]))
+                if not found or found[0] != repo:
+                    self.send_body(404, {'message': 'Not Found'}, headers)
+                    return
+                self.send_body(200, self.server.data.run(*found), headers)
+                return
+            self.server.count('list_runs')
+            body = self.server.list_runs(repo, dict(urllib.parse.parse_qsl(url.query)))
+            etag = 'W/"' + hashlib.md5(json.dumps(body).encode()).hexdigest() + '"'
+            headers['ETag'] = etag
+            if self.headers.get('If-None-Match') == etag:
+                not_modified = True
+                self.server.count('not_modified')
+                self.send_body(304, None, headers)
+                return
+            self.server.count('runs', len(body['workflow_runs']))
+            self.send_body(200, body, headers)
+        finally:
+            self.server.end_request(not_modified)
+
+
+def main():
+    """Main function"""
+
+    parser = argparse.ArgumentParser(
+        description='Serve synthetic or recorded workflow runs as a fake GitHub Actions API')
+    repos_group = parser.add_mutually_exclusive_group()
+    repos_group.add_argument('--repos', nargs='+',
+                             help='Repo names, default the repos the monitor checks')
+    repos_group.add_argument('--num-repos', type=int,
+                             help='Number of repos, real repo names first then made up ones')
+    parser.add_argument('--fixture', type=str,
+                        help='Replay workflow runs recorded with --record rather than synthetic runs')
+    parser.add_argument('--record', type=str,
+                        help='Record workflow runs of --repos over --span from --record-url to this file and exit,'
+                        ' using GITHUB_TOKEN')
+    parser.add_argument('--record-url', type=str, default=DEFAULT_RECORD_URL,
+                        help='GitHub API URL to record from')
+    parser.add_argument('--record-org', type=str, default=DEFAULT_RECORD_ORG,
+                        help='GitHub org of the repos to record')
+    parser.add_argument('--runs', type=int, default=DEFAULT_RUNS,
+                        help='Number of workflow runs per repo')
+    parser.add_argument('--span', type=int, default=DEFAULT_SPAN_SECS,
+                        help='Spread runs over this many seconds before now')
+    parser.add_argument('--now', type=float,
+                        help='Epoch seconds of the newest run, or to replay --fixture as of, default current time')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Random seed for workflows and conclusions')
+    parser.add_argument('--port', type=int, default=0,
+                        help='Port to listen on, default any free port')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='Seconds to delay each response by')
+    parser.add_argument('--rate-limit', type=int, default=DEFAULT_RATE_LIMIT,
+                        help='Primary rate limit, requests per --rate-window')
+    parser.add_argument('--rate-window', type=int, default=DEFAULT_RATE_WINDOW_SECS,
+                        help='Primary rate limit window in seconds')
+    parser.add_argument('--max-concurrent', type=int, default=DEFAULT_MAX_CONCURRENT,
+                        help='Secondary rate limit on concurrent requests')
+    parser.add_argument('--secondary-retry-after', type=int, default=DEFAULT_SECONDARY_RETRY_AFTER_SECS,
+                        help='Retry-After seconds for secondary rate limit responses')
+    args = parser.parse_args()
+
+    repos = args.repos or repo_names(args.num_repos or len(REPOS))
+    if args.record:
+        if os.environ.get('GITHUB_TOKEN') is None:
+            raise ValueError('please set GITHUB_TOKEN environment variable')
+        pool = http_client.HttpConnectionPool(args.record_url, headers={
+            'Accept': 'application/vnd.github+json',
+            'Authorization': 'Bearer ' + os.environ['GITHUB_TOKEN'],
+        })
+        created_after = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=args.span)
+        fixture = record_runs(pool, args.record_org, repos, created_after, verbose=1)
+        pool.close()
+        with open(args.record, 'w', encoding='utf-8') as f:
+            json.dump(fixture, f)
+        return
+
+    if args.fixture:
+        data = RecordedRuns.load(args.fixture, args.now)
+    else:
+        data = SyntheticRuns(repos, args.runs, args.span, args.now, args.seed)
+    server = FakeGitHubServer(data, args.port, args.latency, args.rate_limit, args.rate_window,
+                              args.max_concurrent, args.secondary_retry_after)
+    print(f'Listening on {server.url}', flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        sys.exit(0)
+
+
+if __name__ == '__main__':
+    main()
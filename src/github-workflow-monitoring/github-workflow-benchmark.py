@@ -0,0 +1,361 @@
+"""Benchmark github-workflow-monitor.py against a fake GitHub Actions API
+
+For each number of repos a fake API is started (see fake_github.py), serving
+synthetic runs or a recorded --fixture, with the given latency and rate
+limits. github-workflow-monitor.py is then run once per phase, so each phase
+is a real monitor run measured end to end with its own peak RSS. Phases:
+
+  fetch       list every page of the lookback, as a plain run does
+  cache_cold  as fetch with an empty --cache file
+  cache_warm  as fetch again with the now populated --cache file, so pages
+              are revalidated with ETags and answered with 304
+  state_cold  as fetch with an empty --state ledger
+  state_warm  as fetch again with the now populated --state ledger, so only
+              new runs are listed and open or unsuccessful runs re-checked,
+              unless re-listing every page would take fewer requests
+  aggregate   check_workflow_run() and the summaries in-process, over every
+              run of the repos generated up front, as the monitor does for
+              a --round-interval run. Compared by runs rather than pages
+
+API calls and pages are counted by the fake API. Pages are list pages and
+single run requests, including 304 responses. The monitor's client side
+rate limit, see monitoring_common/scheduler.py, is lifted unless --max-rate
+is given, so pages per second measure the monitor rather than the limit.
+
+Results are appended to a JSON Lines file and compared with the previous
+result for the same parameters, flagging throughput or peak RSS regressions.
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+import fake_github
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from monitoring_common import aggregation, benchmark  # pylint: disable=wrong-import-position
+
+DEFAULT_SIZES = [6, 25, 100]
+DEFAULT_INTERVAL_SECS = 3600
+DEFAULT_RESULTS_FILE = 'github-workflow-benchmark.jsonl'
+PHASES = ['fetch', 'cache_cold', 'cache_warm', 'state_cold', 'state_warm', 'aggregate']
+# phases run in-process rather than as a monitor run, so without pages
+IN_PROCESS_PHASES = ('aggregate',)
+# effectively no client side rate limit
+UNLIMITED_RATE = 1e9
+# fake API counters which are requests, the rest are subsets of these or records
+REQUEST_COUNTERS = ('list_runs', 'get_run', 'not_found', 'requests')
+PAGE_COUNTERS = ('list_runs', 'get_run')
+RATE_LIMITED_COUNTERS = ('primary_rate_limited', 'secondary_rate_limited')
+
+
+def get_server_stats(api_url):
+    """Get fake API request counters"""
+
+    with urllib.request.urlopen(api_url + '/stats') as response:
+        return json.load(response)
+
+
+def get_totals(csv_output):
+    """Get success and failed counts over all repos and workflows from the
+    monitor's CSV output"""
+
+    totals = {'success': 0, 'failed': 0}
+    for line in csv_output.splitlines()[1:]:
+        fields = line.split(',')
+        if fields[1:3] == ['all', 'all']:
+            totals['success'] += int(fields[3])
+            totals['failed'] += int(fields[4])
+    return totals
+
+
+def run_monitor(args, api_url, repos, extra_args, tmpdir):
+    """Run github-workflow-monitor.py against the fake API. Returns the CSV
+    output and the --timings report"""
+
+    timings_filename = os.path.join(tmpdir, 'timings.json')
+    cmd = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'github-workflow-monitor.py'),
+           '-i', str(args.interval),
+           '-r',
+           '--api-url', api_url,
+           '--timings', timings_filename,
+           '--max-rate', str(args.max_rate or UNLIMITED_RATE)] + extra_args + repos
+    env = dict(os.environ, GITHUB_TOKEN='fake')
+    result = subprocess.run(cmd, capture_output=True, text=True, check=False, env=env)
+    if result.returncode != 0:
+        raise ValueError(f'github-workflow-monitor.py failed for {len(repos)} repos' + os.linesep + result.stderr)
+    with open(timings_filename, encoding='utf-8') as f:
+        return result.stdout, json.load(f)
+
+
+def run_phase(args, api_url, repos, extra_args, tmpdir):
+    """Run and measure one monitor run"""
+
+    stats_before = get_server_stats(api_url)
+    start = time.perf_counter()
+    csv_output, report = run_monitor(args, api_url, repos, extra_args, tmpdir)
+    wall_secs = time.perf_counter() - start
+    stats = get_server_stats(api_url)
+    counters = {
+        name: count - stats_before.get(name, 0)
+        for name, count in stats.items()
+        if count != stats_before.get(name, 0)
+    }
+    pages = sum(counters.get(name, 0) for name in PAGE_COUNTERS)
+    return {
+        'wall_secs': round(wall_secs, 3),
+        'pages': pages,
+        'pages_per_sec': round(pages / wall_secs, 1) if wall_secs else 0,
+        'runs': counters.get('runs', 0),
+        'runs_per_sec': round(counters.get('runs', 0) / wall_secs, 1) if wall_secs else 0,
+        'api_calls': sum(counters.get(name, 0) for name in REQUEST_COUNTERS),
+        'rate_limited': sum(counters.get(name, 0) for name in RATE_LIMITED_COUNTERS),
+        'peak_rss_mb': report['peak_rss_mb'],
+        'counters': counters,
+        'monitor_phases': {name: phase['wall_secs'] for name, phase in report['phases'].items()},
+        'totals': get_totals(csv_output),
+    }
+
+
+def run_aggregate_phase(args, repos, now):
+    """Measure aggregating the same runs as the fake API serves, in-process"""
+
+    monitor = benchmark.load_script(
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), 'github-workflow-monitor.py'),
+        'github_workflow_monitor')
+    if args.fixture:
+        data = fake_github.RecordedRuns.load(args.fixture, now)
+    else:
+        data = fake_github.SyntheticRuns(repos, args.runs, args.span, now, args.seed)
+    repos_workflow_runs = {repo: [data.run(repo, i) for i in range(data.runs_after(repo))] for repo in repos}
+    runs = sum(len(workflow_runs) for workflow_runs in repos_workflow_runs.values())
+    end_timestamp = monitor.round_down(datetime.datetime.fromtimestamp(int(now), datetime.timezone.utc),
+                                       args.interval)
+    start_timestamp = end_timestamp - datetime.timedelta(seconds=args.interval)
+    buckets = [aggregation.StatsTable(('success', 'failed'))]
+    timing_buckets = [aggregation.SketchTable(monitor.TIMING_MEASURES)]
+
+    start = time.perf_counter()
+    for repo, workflow_runs in repos_workflow_runs.items():
+        for workflow_run in workflow_runs:
+            monitor.check_workflow_run(buckets, repo, workflow_run, 0, start_timestamp, end_timestamp,
+                                       args.interval, timing_buckets)
+    summary = buckets[0].summary()
+    timing_buckets[0].summary()
+    wall_secs = time.perf_counter() - start
+    totals = summary.get('all', {}).get('all', {'success': 0, 'failed': 0})
+    return {
+        'wall_secs': round(wall_secs, 3),
+        'pages': 0,
+        'pages_per_sec': 0,
+        'runs': runs,
+        'runs_per_sec': round(runs / wall_secs, 1) if wall_secs else 0,
+        'api_calls': 0,
+        'rate_limited': 0,
+        'peak_rss_mb': round(benchmark.peak_rss_mb(), 1),
+        'counters': {},
+        'monitor_phases': {},
+        'totals': totals,
+    }
+
+
+def start_fake_github(args, repos, now):
+    """Start fake_github.py in the background. Returns the process and its URL"""
+
+    cmd = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fake_github.py'),
+           '--now', str(now),
+           '--latency', str(args.latency),
+           '--rate-limit', str(args.rate_limit),
+           '--rate-window', str(args.rate_window),
+           '--max-concurrent', str(args.max_concurrent)]
+    if args.fixture:
+        cmd += ['--fixture', args.fixture]
+    else:
+        cmd += ['--runs', str(args.runs),
+                '--span', str(args.span),
+                '--seed', str(args.seed),
+                '--repos'] + repos
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, text=True)
+    line = process.stdout.readline()
+    if not line.startswith('Listening on '):
+        process.kill()
+        raise ValueError(f'fake_github.py failed to start: {line}')
+    return process, line.split()[-1]
+
+
+def benchmark_size(args, repos):
+    """Run the phases for a set of repos against a fresh fake API, so each
+    size starts with a full rate limit quota"""
+
+    now = time.time()
+    process, api_url = start_fake_github(args, repos, now)
+    try:
+        results = {}
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache_filename = os.path.join(tmpdir, 'cache.sqlite')
+            state_filename = os.path.join(tmpdir, 'state.sqlite')
+            for phase in args.phases:
+                if phase == 'aggregate':
+                    results[phase] = run_aggregate_phase(args, repos, now)
+                    continue
+                extra_args = []
+                if phase.startswith('cache_'):
+                    extra_args = ['--cache', cache_filename]
+                elif phase.startswith('state_'):
+                    extra_args = ['--state', state_filename]
+                results[phase] = run_phase(args, api_url, repos, extra_args, tmpdir)
+        return results
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def print_results_csv(num_repos, phases, previous, threshold):
+    """Print phase results in CSV, with previous results for comparison.
+    Returns True if there are any regressions"""
+
+    regressions = False
+    for phase, phase_result in phases.items():
+        previous_phase_result = previous['phases'].get(phase) if previous else None
+        count = 'runs' if phase in IN_PROCESS_PHASES else 'pages'
+        regression = benchmark.is_regression(phase_result, previous_phase_result, threshold, count)
+        regressions = regressions or regression
+        previous_pps = previous_phase_result['pages_per_sec'] if previous_phase_result else ''
+        previous_rps = previous_phase_result.get('runs_per_sec', '') if previous_phase_result else ''
+        previous_rss = previous_phase_result['peak_rss_mb'] if previous_phase_result else ''
+        print(f'{num_repos},{phase},{phase_result["wall_secs"]},{phase_result["pages"]},'
+              f'{phase_result["pages_per_sec"]},{phase_result["runs"]},{phase_result["runs_per_sec"]},'
+              f'{phase_result["api_calls"]},{phase_result["rate_limited"]},{phase_result["peak_rss_mb"]},'
+              f'{previous_pps},{previous_rps},{previous_rss},{int(regression)}', flush=True)
+    return regressions
+
+
+def check_totals(num_repos, phases):
+    """Warn if phases disagree on the summary totals"""
+
+    totals = {json.dumps(phase_result['totals'], sort_keys=True) for phase_result in phases.values()}
+    if len(totals) > 1:
+        sys.stderr.write(f'Warning: {num_repos} repos: summary totals differ between phases: '
+                         + ' '.join(sorted(totals)) + os.linesep)
+
+
+def main():
+    """Main function"""
+
+    parser = argparse.ArgumentParser(
+        description='Benchmark github-workflow-monitor.py against a fake GitHub Actions API')
+    parser.add_argument('--sizes',
+                        nargs='+',
+                        type=int,
+                        default=DEFAULT_SIZES,
+                        help='Number of repos to benchmark, e.g. 6 25 100')
+    parser.add_argument('--fixture',
+                        type=str,
+                        help='Replay runs recorded with fake_github.py --record instead of synthetic runs,'
+                        ' the fixture repos are benchmarked and --sizes ignored')
+    parser.add_argument('--runs',
+                        type=int,
+                        default=fake_github.DEFAULT_RUNS,
+                        help='Number of synthetic workflow runs per repo')
+    parser.add_argument('--span',
+                        type=int,
+                        default=fake_github.DEFAULT_SPAN_SECS,
+                        help='Spread synthetic runs over this many seconds')
+    parser.add_argument('--seed',
+                        type=int,
+                        default=0,
+                        help='Random seed for synthetic data')
+    parser.add_argument('-i',
+                        '--interval',
+                        type=int,
+                        default=DEFAULT_INTERVAL_SECS,
+                        help='Monitor --interval in seconds')
+    parser.add_argument('--latency',
+                        type=float,
+                        default=0,
+                        help='Fake API response latency in seconds')
+    parser.add_argument('--rate-limit',
+                        type=int,
+                        default=fake_github.DEFAULT_RATE_LIMIT,
+                        help='Fake API primary rate limit, requests per --rate-window')
+    parser.add_argument('--rate-window',
+                        type=int,
+                        default=fake_github.DEFAULT_RATE_WINDOW_SECS,
+                        help='Fake API primary rate limit window in seconds')
+    parser.add_argument('--max-concurrent',
+                        type=int,
+                        default=fake_github.DEFAULT_MAX_CONCURRENT,
+                        help='Fake API secondary rate limit on concurrent requests')
+    parser.add_argument('--max-rate',
+                        type=float,
+                        default=0,
+                        help='Monitor client side GitHub API requests per second, 0=unlimited')
+    parser.add_argument('--phases',
+                        nargs='+',
+                        choices=PHASES,
+                        default=PHASES,
+                        help='Phases to run')
+    parser.add_argument('--results',
+                        type=str,
+                        default=DEFAULT_RESULTS_FILE,
+                        help='JSON Lines file to append results to and compare against')
+    parser.add_argument('--threshold',
+                        type=float,
+                        default=benchmark.REGRESSION_THRESHOLD,
+                        help='Flag a regression if page throughput drops or peak RSS grows by this fraction')
+    parser.add_argument('--check',
+                        action='store_true',
+                        help='Exit with error if there are any regressions')
+
+    args = parser.parse_args()
+
+    if args.fixture:
+        repos_list = [list(fake_github.RecordedRuns.load(args.fixture, False).repos)]
+    else:
+        repos_list = [fake_github.repo_names(size) for size in args.sizes]
+
+    previous_results = benchmark.read_results(args.results)
+    regressions = False
+    print('Repos,Phase,WallSecs,Pages,PagesPerSec,Runs,RunsPerSec,ApiCalls,RateLimited,PeakRssMB,'
+          'PreviousPagesPerSec,PreviousRunsPerSec,PreviousPeakRssMB,Regression', flush=True)
+    for repos in repos_list:
+        params = {
+            'repos': len(repos),
+            'interval': args.interval,
+            'latency': args.latency,
+            'rate_limit': args.rate_limit,
+            'rate_window': args.rate_window,
+            'max_concurrent': args.max_concurrent,
+            'max_rate': args.max_rate,
+        }
+        if args.fixture:
+            params['fixture'] = os.path.basename(args.fixture)
+        else:
+            params.update(runs=args.runs, span=args.span, seed=args.seed)
+        phases = benchmark_size(args, repos)
+        check_totals(len(repos), phases)
+        previous = benchmark.find_previous(previous_results, params)
+        regressions = print_results_csv(len(repos), phases, previous, args.threshold) or regressions
+        result = {
+            'timestamp': datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%dT%TZ"),
+            'commit': benchmark.get_commit(),
+            'python': platform.python_version(),
+            'params': params,
+            'phases': phases,
+        }
+        with open(args.results, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(result) + os.linesep)
+
+    if args.check and regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,16 +1,36 @@
 """Get aggregate statistics for Scheduled Github Workflows"""
 
 import argparse
+import concurrent.futures
+import http.client
 import json
-import subprocess
 import datetime
 import os
 import textwrap
 import sys
+import time
 
-CURL_TIMEOUT_SECS = 10
+import github_state
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from monitoring_common import aggregation, aws_client, cloudwatch, http_cache, http_client, scheduler, timings  # pylint: disable=wrong-import-position
+
+GITHUB_API_URL = 'https://api.github.com'
+GITHUB_ORG = 'ministryofjustice'
+HTTP_TIMEOUT_SECS = 10
+FETCH_MAX_WORKERS = 8
 API_PAGE_SIZE = 100
+# GitHub asks clients to wait at least a minute after a secondary rate limit
+# if it doesn't give a Retry-After
+SECONDARY_RATE_LIMIT_WAIT_SECS = 60
+# Run timing measures: queue from created_at to run_started_at, duration
+# from run_started_at to updated_at
+TIMING_MEASURES = ('duration', 'queue')
+TIMING_QUANTILES = (('P50', 0.5), ('P90', 0.9), ('P99', 0.99))
 PIPELINE_TIMEOUT_SECS = 216000
+# The created>= filter is rounded down so that successive runs request the
+# same URLs, and unchanged pages can be served from the --cache
+CREATED_AFTER_ROUND_SECS = 3600
 
 GITHUB_REPOS = [
     "dso-certificates",
@@ -21,53 +41,223 @@ GITHUB_REPOS = [
     "dso-useful-stuff",
 ]
 
-def run_github_api(uri, github_token):
-    """Invoke curl to call API"""
+class NotFoundError(ValueError):
+    """API returned 404, e.g. for a deleted workflow run"""
+
+
+def get_github_api_pool(api_url, github_token, max_connections=FETCH_MAX_WORKERS):
+    """Create a keep-alive connection pool for the GitHub API"""
+
+    return http_client.HttpConnectionPool(api_url, max_connections, HTTP_TIMEOUT_SECS, {
+        'Accept': 'application/vnd.github+json',
+        'Authorization': f'Bearer {github_token}',
+        'User-Agent': 'github-workflow-monitor',
+        'X-GitHub-Api-Version': '2022-11-28',
+    })
 
-    cmd = [
-        'curl',
-        '-s',
-        '-H',
-        f'Authorization: Bearer {github_token}',
-        uri,
-    ]
-    result = subprocess.run(cmd,
-                            capture_output=True,
-                            text=True,
-                            check=False,
-                            timeout=CURL_TIMEOUT_SECS)
-    if result.returncode != 0:
-        raise ValueError(f'exit code {result.returncode} for {uri}' + os.linesep + result.stderr)
-    return json.loads(result.stdout)
-
-
-def add_workflow_stat(workflow_summary, repo, name, status):
-    """Add to the workflow stats"""
-
-    zeroed_stats = {}
-    zeroed_stats["success"] = 0
-    zeroed_stats["failed"] = 0
-    if 'all' not in workflow_summary:
-        workflow_summary['all'] = {}
-        workflow_summary['all']['all'] = zeroed_stats.copy()
-    if name not in workflow_summary['all']:
-        workflow_summary['all'][name] = zeroed_stats.copy()
-    if repo is not None:
-        if repo not in workflow_summary:
-            workflow_summary[repo] = {}
-            workflow_summary[repo]['all'] = zeroed_stats.copy()
-        if name not in workflow_summary[repo]:
-            workflow_summary[repo][name] = zeroed_stats.copy()
-    if status is not None:
-        workflow_summary['all']['all'][status] += 1
-        workflow_summary['all'][name][status] += 1
-        if repo is not None:
-            workflow_summary[repo]['all'][status] += 1
-            workflow_summary[repo][name][status] += 1
-
-
-def check_workflow_run(workflow_summary, repo, workflow_run, verbose, start_timestamp, end_timestamp):
-    """Parse workflow json and add to the workflow stats"""
+
+def update_quota(headers):
+    """Pass the X-RateLimit-* quota headers of a response to the github
+    scheduler, so it can pace requests to make the quota last"""
+
+    try:
+        limit = int(headers['X-RateLimit-Limit'])
+        remaining = int(headers['X-RateLimit-Remaining'])
+        reset = int(headers['X-RateLimit-Reset'])
+    except (KeyError, TypeError, ValueError):
+        return
+    scheduler.get_scheduler('github').update_quota(limit, remaining, reset)
+
+
+def get_retry_after(headers):
+    """Get seconds to wait before retrying a rate limited request, from
+    Retry-After, or X-RateLimit-Reset if the quota is used up"""
+
+    try:
+        if headers.get('Retry-After'):
+            return max(1, int(headers['Retry-After']))
+        if headers.get('X-RateLimit-Remaining') == '0':
+            return max(1, int(headers['X-RateLimit-Reset']) - time.time())
+    except (TypeError, ValueError):
+        pass
+    return SECONDARY_RATE_LIMIT_WAIT_SECS
+
+
+def run_github_api_once(pool, uri, cache=None, operation='actions/runs'):
+    """Call API and raise exception on error. If a cache is given, make a
+    conditional request and use the cached body if not modified"""
+
+    url = uri if '://' in uri else pool.base_url + uri
+    start = time.perf_counter()
+    try:
+        response = pool.request('GET', uri, cache.get_validators(url) if cache else None)
+    except (OSError, http.client.HTTPException) as e:
+        raise scheduler.RetryableError(f'{e.__class__.__name__} {e} for {uri}') from e
+    wall_secs = time.perf_counter() - start
+    status = response.status
+    update_quota(response.headers)
+    if status == 429 or (status == 403 and (response.headers.get('X-RateLimit-Remaining') == '0' or
+                                            'rate limit' in response.text().lower())):
+        raise scheduler.ThrottledError(f'HTTP {status} for {uri}' + os.linesep + response.text(),
+                                       get_retry_after(response.headers))
+    if status >= 500:
+        raise scheduler.RetryableError(f'HTTP {status} for {uri}' + os.linesep + response.text())
+    data = response.body
+    if status == 304 and cache:
+        data = cache.get_body(url)
+        if data is None:
+            raise scheduler.RetryableError(f'cached response for {uri} was evicted')
+    elif status == 404:
+        raise NotFoundError(f'HTTP {status} for {uri}' + os.linesep + response.text())
+    elif status != 200:
+        raise ValueError(f'HTTP {status} for {uri}' + os.linesep + response.text())
+    elif cache:
+        cache.put(url, response.headers, data)
+    with timings.phase('json_decode'):
+        try:
+            body = json.loads(data)
+        except ValueError as e:
+            raise ValueError(f'invalid JSON for {uri}: {e}') from e
+    timings.add_api_call('github', operation, wall_secs, response.bytes_received,
+                         records=len(body['workflow_runs']) if 'workflow_runs' in body else 1)
+    return body
+
+
+def run_github_api(pool, uri, cache=None, operation='actions/runs'):
+    """Call API, rate limited and retried by the github scheduler"""
+
+    return scheduler.get_scheduler('github').run(
+        lambda: run_github_api_once(pool, uri, cache, operation))
+
+
+def get_workflow_runs_page(pool, repo, date, page, verbose, cache=None):
+    """Get one page of scheduled workflow runs created after date"""
+
+    uri = f'/repos/{GITHUB_ORG}/{repo}/actions/runs?event=schedule&created=>={date}&per_page={API_PAGE_SIZE}&page={page}'
+    if verbose >= 4:
+        sys.stderr.write(f'Verbose4: {uri}{os.linesep}')
+    workflow_runs = run_github_api(pool, uri, cache)
+    if 'workflow_runs' not in workflow_runs or 'total_count' not in workflow_runs:
+        sys.stderr.write(json.dumps(workflow_runs, indent=1))
+        raise ValueError('API response error')
+    if verbose >= 4:
+        sys.stderr.write(f'Verbose4: {repo} page {page}: got {len(workflow_runs["workflow_runs"])} workflows; total {workflow_runs["total_count"]}{os.linesep}')
+    return workflow_runs
+
+
+def fetch_workflow_runs(pool, repo_dates, verbose, cache=None, max_workers=FETCH_MAX_WORKERS):
+    """Get scheduled workflow runs for each repo, as a dict of repo to list of
+    runs. repo_dates is a dict of repo to the created>= date to list from.
+    Page 1 of every repo is fetched concurrently, then total_count gives the
+    remaining pages, which are also fetched concurrently. So until the rate
+    limit burst is used up, wall time depends on the largest repo rather
+    than the total number of pages"""
+
+    def get_page(repo, page):
+        return get_workflow_runs_page(pool, repo, repo_dates[repo], page, verbose, cache)
+
+    github_scheduler = scheduler.get_scheduler('github')
+    github_scheduler.plan(len(repo_dates))
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        first_pages = {repo: executor.submit(get_page, repo, 1) for repo in repo_dates}
+        pages = {}
+        for repo, future in first_pages.items():
+            num_pages = -(-future.result()['total_count'] // API_PAGE_SIZE)
+            github_scheduler.plan(max(0, num_pages - 1))
+            pages[repo] = [future] + [executor.submit(get_page, repo, page)
+                                      for page in range(2, num_pages + 1)]
+        repos_workflow_runs = {}
+        for repo, futures in pages.items():
+            # runs created while paging shift the later pages, so runs may
+            # be returned twice and more pages may be needed
+            workflow_runs = {}
+            for future in futures:
+                response = future.result()
+                for workflow_run in response['workflow_runs']:
+                    workflow_runs[workflow_run['id']] = workflow_run
+            page = len(futures)
+            while len(workflow_runs) < response['total_count']:
+                page += 1
+                github_scheduler.plan(1)
+                response = get_page(repo, page)
+                if not response['workflow_runs']:
+                    raise ValueError(f'API did not return all workflow page={page} processed={len(workflow_runs)}/{response["total_count"]}')
+                for workflow_run in response['workflow_runs']:
+                    workflow_runs[workflow_run['id']] = workflow_run
+            repos_workflow_runs[repo] = list(workflow_runs.values())
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+    return repos_workflow_runs
+
+
+def get_workflow_run(pool, repo, run_id, verbose):
+    """Get a single workflow run, or None if it no longer exists"""
+
+    uri = f'/repos/{GITHUB_ORG}/{repo}/actions/runs/{run_id}'
+    if verbose >= 4:
+        sys.stderr.write(f'Verbose4: {uri}{os.linesep}')
+    try:
+        return run_github_api(pool, uri, operation='actions/runs/{run_id}')
+    except NotFoundError:
+        return None
+
+
+def recheck_workflow_runs(pool, recheck_run_ids, verbose, max_workers=FETCH_MAX_WORKERS):
+    """Re-check runs which were open or didn't succeed when last fetched,
+    given a dict of repo to run IDs. Returns a dict of repo to (list of
+    runs, list of IDs of runs no longer found)"""
+
+    scheduler.get_scheduler('github').plan(sum(len(run_ids) for run_ids in recheck_run_ids.values()))
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        futures = {
+            repo: [(run_id, executor.submit(get_workflow_run, pool, repo, run_id, verbose))
+                   for run_id in run_ids]
+            for repo, run_ids in recheck_run_ids.items()
+        }
+        rechecked_workflow_runs = {}
+        for repo, run_futures in futures.items():
+            workflow_runs = []
+            deleted_run_ids = []
+            for run_id, future in run_futures:
+                workflow_run = future.result()
+                if workflow_run is None:
+                    deleted_run_ids.append(run_id)
+                else:
+                    workflow_runs.append(workflow_run)
+            rechecked_workflow_runs[repo] = (workflow_runs, deleted_run_ids)
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+    return rechecked_workflow_runs
+
+
+def round_down(timestamp, secs):
+    """Round timestamp down to a multiple of secs since the epoch"""
+
+    return timestamp - datetime.timedelta(seconds=int(timestamp.timestamp()) % secs)
+
+
+def add_workflow_run_timings(timings_table, repo, filename, workflow_run):
+    """Add queue and duration of a completed run to a SketchTable, if the run
+    has a run_started_at"""
+
+    if not workflow_run.get('run_started_at'):
+        return
+    created = aggregation.parse_timestamp(workflow_run['created_at'])
+    started = aggregation.parse_timestamp(workflow_run['run_started_at'])
+    updated = aggregation.parse_timestamp(workflow_run['updated_at'])
+    timings_table.add(repo, filename, 'queue', (started - created).total_seconds())
+    timings_table.add(repo, filename, 'duration', (updated - started).total_seconds())
+
+
+def check_workflow_run(buckets, repo, workflow_run, verbose, start_timestamp, end_timestamp, bucket_secs,
+                       timing_buckets=None):
+    """Parse workflow json and add to the workflow stats of the bucket it
+    completed in. buckets is a list of StatsTable of bucket_secs each, most
+    recent first, ending at end_timestamp. If timing_buckets, a matching
+    list of SketchTable, is given, successful and failed run timings are
+    added too"""
 
     path = workflow_run['path']
     filename = path.split('/')[-1].split('.')[0]
@@ -75,7 +265,9 @@ def check_workflow_run(workflow_summary, repo, workflow_run, verbose, start_time
     created_at = workflow_run['created_at']
     run_number = workflow_run['run_number']
 
-    add_workflow_stat(workflow_summary, repo, filename, None)
+    # add zeroed stats to every bucket so each has a row per workflow
+    for workflow_stats in buckets:
+        workflow_stats.add(repo, filename)
 
     if verbose >= 4:
         sys.stderr.write(
@@ -90,24 +282,31 @@ def check_workflow_run(workflow_summary, repo, workflow_run, verbose, start_time
         return
 
     updated_at = workflow_run['updated_at']
-    timestamp = datetime.datetime.strptime(updated_at, '%Y-%m-%dT%H:%M:%S%z')
+    timestamp = aggregation.parse_timestamp(updated_at)
 
     if timestamp < start_timestamp or timestamp >= end_timestamp:
         return
 
+    # bucket i covers [end - (i + 1) * bucket_secs, end - i * bucket_secs)
+    bucket = -int((timestamp - end_timestamp).total_seconds() // bucket_secs) - 1
+    workflow_stats = buckets[bucket]
     conclusion = workflow_run['conclusion']
     if conclusion in ['failure', 'timed_out']:
         if verbose >= 1:
             sys.stderr.write(
                 f'Verbose1: {repo} {filename}#{run_number} start={created_at} end={updated_at}: {conclusion}'
                 + os.linesep)
-        add_workflow_stat(workflow_summary, repo, filename, 'failed')
+        workflow_stats.add(repo, filename, 'failed')
+        if timing_buckets:
+            add_workflow_run_timings(timing_buckets[bucket], repo, filename, workflow_run)
     elif conclusion in ['success']:
         if verbose >= 3:
             sys.stderr.write(
                 f'Verbose3: {repo} {filename}#{run_number} start={created_at} end={updated_at}: {conclusion}'
                 + os.linesep)
-        add_workflow_stat(workflow_summary, repo, filename, 'success')
+        workflow_stats.add(repo, filename, 'success')
+        if timing_buckets:
+            add_workflow_run_timings(timing_buckets[bucket], repo, filename, workflow_run)
     else:
         if verbose >= 2:
             sys.stderr.write(
@@ -115,16 +314,61 @@ def check_workflow_run(workflow_summary, repo, workflow_run, verbose, start_time
                 + os.linesep)
 
 
-def print_workflow_summary_csv(workflow_summary, timestamp):
-    """print ssm workflow stats in csv"""
-
-    print('Timestamp,Repo,WorkflowName,SuccessCount,FailedCount')
+def get_timing_stats(sketches):
+    """Get a list of (measure, stat, seconds) for each measure's quantiles
+    and max, seconds is None if there were no runs"""
+
+    stats = []
+    for measure in TIMING_MEASURES:
+        sketch = sketches.get(measure) if sketches else None
+        for stat, q in TIMING_QUANTILES:
+            value = sketch.quantile(q) if sketch else None
+            stats.append((measure, stat, None if value is None else round(value)))
+        stats.append((measure, 'Max', None if not sketch or sketch.max is None else round(sketch.max)))
+    return stats
+
+
+def print_workflow_summary_csv(buckets_summary):
+    """print workflow stats in csv, given a list of (timestamp, summary,
+    timings summary). Timing columns are empty if there were no runs"""
+
+    timing_header = ','.join(f'{measure.capitalize()}{stat}'
+                             for measure, stat, _ in get_timing_stats(None))
+    print(f'Timestamp,Repo,WorkflowName,SuccessCount,FailedCount,{timing_header}')
+    for timestamp, workflow_summary, timings_summary in buckets_summary:
+        for repo in workflow_summary.keys():
+            for name in workflow_summary[repo].keys():
+                workflow = workflow_summary[repo][name]
+                timing_stats = get_timing_stats(timings_summary.get(repo, {}).get(name))
+                timing_values = ','.join('' if value is None else str(value)
+                                         for _, _, value in timing_stats)
+                print(
+                    f'{timestamp},{repo},{name},{workflow["success"]},{workflow["failed"]},{timing_values}'
+                )
+
+
+def workflow_summary_to_metric_data(workflow_summary, timestamp, timings_summary=None):
+    """Convert workflow stats to CloudWatch metric data, including run
+    duration and queue quantiles where there were runs"""
+
+    metric_data = []
     for repo in workflow_summary.keys():
         for name in workflow_summary[repo].keys():
             workflow = workflow_summary[repo][name]
-            print(
-                f'{timestamp},{repo},{name},{workflow["success"]},{workflow["failed"]}'
-            )
+            dimensions = {}
+            if repo != 'all':
+                dimensions['Repo'] = repo
+            if name != 'all':
+                dimensions['WorkflowName'] = name
+            metric_data += [
+                cloudwatch.metric_datum('GitHubActionRunsSuccessCount', workflow['success'], timestamp, dimensions),
+                cloudwatch.metric_datum('GitHubActionRunsFailedCount', workflow['failed'], timestamp, dimensions),
+            ]
+            for measure, stat, value in get_timing_stats((timings_summary or {}).get(repo, {}).get(name)):
+                if value is not None:
+                    metric_data.append(cloudwatch.metric_datum(
+                        f'GitHubActionRuns{measure.capitalize()}{stat}', value, timestamp, dimensions))
+    return metric_data
 
 
 def main():
@@ -142,6 +386,18 @@ def main():
                         type=int,
                         default=1,
                         help='How many intervals to check back for')
+    parser.add_argument('-b',
+                        '--buckets',
+                        action='store_true',
+                        help='Report each of the --number intervals separately, e.g. to backfill, from one sweep')
+    parser.add_argument('-c',
+                        '--cloudwatch',
+                        action='store_true',
+                        help='Upload metrics to cloudwatch')
+    parser.add_argument('-d',
+                        '--dryrun',
+                        action='store_true',
+                        help='Show cloudwatch aws cli commands but don\'t upload')
     parser.add_argument('-r',
                         '--round',
                         action='store_true',
@@ -151,6 +407,29 @@ def main():
                         action='count',
                         default=0,
                         help='Verbose output')
+    parser.add_argument('--api-url',
+                        type=str,
+                        default=GITHUB_API_URL,
+                        help='GitHub API URL, e.g. a local stub')
+    parser.add_argument('--cache',
+                        type=str,
+                        help='Optional SQLite file to cache API responses in, so unchanged pages are not re-downloaded')
+    parser.add_argument('--cache-max-mb',
+                        type=int,
+                        default=http_cache.DEFAULT_MAX_MB,
+                        help='Evict least recently used responses when the cache exceeds this size')
+    parser.add_argument('-s',
+                        '--state',
+                        type=str,
+                        help='Optional SQLite file to keep a ledger of runs between runs, so only new runs are listed')
+    parser.add_argument('--timings',
+                        type=str,
+                        help='Write per-phase timings and API call counts as JSON to this file, - for stdout,'
+                        ' and upload them as metrics if --cloudwatch')
+    parser.add_argument('--max-rate',
+                        type=float,
+                        default=scheduler.DEFAULT_MAX_RATES['github'],
+                        help='Client side GitHub API requests per second, once the initial burst is used up')
     parser.add_argument('repo',
                         nargs='+',
                         help='1 or more repo names. Set to all to use defaults from script')
@@ -170,45 +449,104 @@ def main():
     created_after_timestamp = start_timestamp - datetime.timedelta(seconds=PIPELINE_TIMEOUT_SECS)
     one_day_ago_timestamp = timestamp - datetime.timedelta(days=1)
     created_after_timestamp = min(one_day_ago_timestamp, created_after_timestamp)
+    created_after_timestamp = round_down(created_after_timestamp, CREATED_AFTER_ROUND_SECS)
 
     if os.environ.get('GITHUB_TOKEN') is None:
         raise ValueError('please set GITHUB_TOKEN environment variable')
     github_token = os.environ.get('GITHUB_TOKEN')
 
-    workflow_summary = {}
+    if args.interval <= 0 or args.number <= 0:
+        parser.error('--interval and --number must be positive')
+    if args.max_rate <= 0:
+        parser.error('--max-rate must be positive')
+    scheduler.DEFAULT_MAX_RATES['github'] = args.max_rate
+    bucket_secs = args.interval if args.buckets else args.interval * args.number
+    buckets = [aggregation.StatsTable(('success', 'failed'))
+               for _ in range(args.number if args.buckets else 1)]
+    timing_buckets = [aggregation.SketchTable(TIMING_MEASURES) for _ in buckets]
     repos = args.repo
     if repos is None or repos[0] == 'all':
         repos = GITHUB_REPOS
 
+    pool = get_github_api_pool(args.api_url, github_token)
+    cache = None
+    if args.cache:
+        cache = http_cache.HttpCache(args.cache, args.cache_max_mb * 1024 * 1024, 'github')
+    ledger = github_state.RunLedger(args.state) if args.state else None
+    repo_timestamps = {}
+    recheck_run_ids = {}
     for repo in repos:
-        date = created_after_timestamp.strftime("%Y-%m-%dT%TZ")
-        num_workflows_processed = 0
-        for page in range(1,10000):
-            uri = f'https://api.github.com/repos/ministryofjustice/{repo}/actions/runs?event=schedule&created=>={date}&per_page={API_PAGE_SIZE}&page={page}'
-            if args.verbose >= 4:
-                sys.stderr.write(f'Verbose4: {uri}{os.linesep}')
-            workflow_runs = run_github_api(uri, github_token)
-
-            if 'workflow_runs' not in workflow_runs or 'total_count' not in workflow_runs:
-                sys.stderr.write(json.dumps(workflow_runs, indent=1))
-                raise ValueError('API response error')
-
-            total_count = workflow_runs["total_count"]
-            num_workflows = len(workflow_runs['workflow_runs'])
-            num_workflows_processed += num_workflows
-            if args.verbose >= 4:
-                sys.stderr.write(f'Verbose4: page {page}: got {num_workflows} workflows; {num_workflows_processed}/{total_count}{os.linesep}')
-
-            for workflow_run in workflow_runs['workflow_runs']:
-                check_workflow_run(workflow_summary, repo, workflow_run, args.verbose, start_timestamp, end_timestamp)
-            if num_workflows_processed == total_count:
-                break
-            if num_workflows == 0:
-                sys.stderr.write(f'page {page}: {num_workflows_processed}/{total_count}{os.linesep}')
-                raise ValueError(f'API did not return all workflow page={page} processed={num_workflows_processed}/{total_count}')
-
-    csv_timestamp = end_timestamp
-    print_workflow_summary_csv(workflow_summary, csv_timestamp.strftime("%Y-%m-%dT%TZ"))
-
-
-main()
+        fetch_after_timestamp = created_after_timestamp
+        if ledger:
+            fetch_after_timestamp = round_down(ledger.fetch_after(repo, created_after_timestamp),
+                                               CREATED_AFTER_ROUND_SECS)
+            recheck_run_ids[repo] = ledger.get_recheck_run_ids(repo, created_after_timestamp,
+                                                               fetch_after_timestamp)
+            # re-listing the whole lookback costs a request per page rather than per run
+            num_pages = -(-ledger.count_runs(repo, created_after_timestamp, fetch_after_timestamp)
+                          // API_PAGE_SIZE)
+            if len(recheck_run_ids[repo]) >= num_pages:
+                fetch_after_timestamp = created_after_timestamp
+                recheck_run_ids[repo] = []
+        repo_timestamps[repo] = fetch_after_timestamp
+    repo_dates = {repo: timestamp.strftime("%Y-%m-%dT%TZ") for repo, timestamp in repo_timestamps.items()}
+
+    with timings.phase('fetch') as timer:
+        repos_workflow_runs = fetch_workflow_runs(pool, repo_dates, args.verbose, cache)
+        rechecked_workflow_runs = recheck_workflow_runs(pool, recheck_run_ids, args.verbose)
+        timer.add_records(sum(len(workflow_runs) for workflow_runs in repos_workflow_runs.values()))
+    pool.close()
+    if cache:
+        cache.close()
+
+    if ledger:
+        with timings.phase('state_update'):
+            for repo, workflow_runs in repos_workflow_runs.items():
+                ledger.update_runs(repo, workflow_runs)
+                ledger.update_coverage(repo, repo_timestamps[repo])
+                ledger.update_runs(repo, *rechecked_workflow_runs[repo], listed=False)
+            ledger.prune(created_after_timestamp)
+            repos_workflow_runs = {repo: ledger.get_runs(repo, created_after_timestamp)
+                                   for repo in repos_workflow_runs}
+        ledger.close()
+
+    with timings.phase('aggregate') as timer:
+        for repo, workflow_runs in repos_workflow_runs.items():
+            for workflow_run in workflow_runs:
+                check_workflow_run(buckets, repo, workflow_run, args.verbose, start_timestamp, end_timestamp,
+                                   bucket_secs, timing_buckets)
+            timer.add_records(len(workflow_runs))
+
+    csv_timestamp = end_timestamp.strftime("%Y-%m-%dT%TZ")
+    buckets_summary = [
+        ((end_timestamp - datetime.timedelta(seconds=i * bucket_secs)).strftime("%Y-%m-%dT%TZ"),
+         workflow_stats.summary(), timings_table.summary())
+        for i, (workflow_stats, timings_table) in enumerate(zip(buckets, timing_buckets))
+    ]
+    with timings.phase('output'):
+        print_workflow_summary_csv(buckets_summary)
+    if args.cloudwatch:
+        client = aws_client.get_backend(region=cloudwatch.CLOUDWATCH_REGION)
+        metric_data = []
+        for timestamp, workflow_summary, timings_summary in buckets_summary:
+            metric_data += workflow_summary_to_metric_data(workflow_summary, timestamp, timings_summary)
+        with timings.phase('cloudwatch') as timer:
+            cloudwatch.put_metric_data(client, metric_data, args.dryrun)
+            timer.add_records(len(metric_data))
+    if args.timings:
+        report = timings.get_report()
+        timings.write_report(args.timings, report)
+        if args.cloudwatch:
+            cloudwatch.put_metric_data(client,
+                                       timings.report_to_metric_data(report, csv_timestamp,
+                                                                     'github-workflow-monitor'),
+                                       args.dryrun)
+    if args.verbose >= 4:
+        for name, counters in scheduler.get_counters().items():
+            sys.stderr.write(f'Verbose4: scheduler {name}: {json.dumps(counters)}{os.linesep}')
+        for name, counters in timings.get_report()['caches'].items():
+            sys.stderr.write(f'Verbose4: cache {name}: {json.dumps(counters)}{os.linesep}')
+
+
+if __name__ == '__main__':
+    main()
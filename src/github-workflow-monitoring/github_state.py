@@ -0,0 +1,146 @@
+"""Local SQLite run ledger for incremental github-workflow-monitor.py runs
+
+Workflow runs fetched by previous runs are kept, keyed by run id, along with
+a created_at watermark per repo and the start of the time they cover.
+Subsequent runs only need to list runs created since the watermark, plus
+re-check runs which were still open or didn't succeed, as they may since
+have been re-run, rather than listing the whole PIPELINE_TIMEOUT_SECS
+lookback. Runs created before the lookback are pruned, moving the coverage
+start forward, so a later run with a wider lookback lists everything again.
+"""
+
+import datetime
+import json
+import os
+import sqlite3
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from monitoring_common import aggregation  # pylint: disable=wrong-import-position
+
+# Re-list a little before the watermark in case of late arriving runs
+WATERMARK_OVERLAP_SECS = 3600
+SQLITE_TIMEOUT_SECS = 60
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS watermarks (
+    repo TEXT PRIMARY KEY,
+    created REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS coverage (
+    repo TEXT PRIMARY KEY,
+    start REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS workflow_runs (
+    repo TEXT NOT NULL,
+    run_id INTEGER NOT NULL,
+    created REAL NOT NULL,
+    status TEXT NOT NULL,
+    workflow_run TEXT NOT NULL,
+    PRIMARY KEY (repo, run_id)
+);
+CREATE INDEX IF NOT EXISTS workflow_runs_created
+    ON workflow_runs (repo, created);
+'''
+
+
+def created_epoch(workflow_run):
+    """Get created_at of a workflow run as epoch seconds"""
+
+    return aggregation.parse_timestamp(workflow_run['created_at']).timestamp()
+
+
+class RunLedger:
+    """Incremental state for all repos. Not thread safe"""
+
+    def __init__(self, filename):
+        self.db = sqlite3.connect(filename, timeout=SQLITE_TIMEOUT_SECS)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        """Close the database"""
+
+        self.db.close()
+
+    def fetch_after(self, repo, timestamp):
+        """Get the timestamp to list runs created after, i.e. the watermark
+        less an overlap or the given timestamp, whichever is later. If the
+        ledger doesn't cover back to timestamp, it is returned so all are
+        listed"""
+
+        coverage = self.db.execute(
+            'SELECT start FROM coverage WHERE repo = ?', (repo,)).fetchone()
+        if coverage is None or timestamp.timestamp() < coverage[0]:
+            return timestamp
+        row = self.db.execute(
+            'SELECT created FROM watermarks WHERE repo = ?', (repo,)).fetchone()
+        if row is None:
+            return timestamp
+        watermark = datetime.datetime.fromtimestamp(
+            int(row[0]) - WATERMARK_OVERLAP_SECS, datetime.timezone.utc)
+        return max(timestamp, watermark)
+
+    def update_coverage(self, repo, timestamp):
+        """Record that all runs created after timestamp have been listed"""
+
+        with self.db:
+            self.db.execute(
+                'INSERT INTO coverage (repo, start) VALUES (?, ?) '
+                'ON CONFLICT (repo) DO UPDATE SET start = MIN(start, excluded.start)',
+                (repo, timestamp.timestamp()))
+
+    def count_runs(self, repo, timestamp, fetch_after_timestamp):
+        """Count runs created between the two timestamps"""
+
+        return self.db.execute(
+            'SELECT COUNT(*) FROM workflow_runs WHERE repo = ? AND created >= ? AND created < ?',
+            (repo, timestamp.timestamp(), fetch_after_timestamp.timestamp())).fetchone()[0]
+
+    def get_recheck_run_ids(self, repo, timestamp, fetch_after_timestamp):
+        """Get IDs of runs created between the two timestamps that were not
+        completed when last fetched, or didn't succeed and may be re-run"""
+
+        rows = self.db.execute(
+            'SELECT run_id FROM workflow_runs '
+            'WHERE repo = ? AND created >= ? AND created < ? '
+            "AND (status != 'completed' OR json_extract(workflow_run, '$.conclusion') IS NOT 'success')",
+            (repo, timestamp.timestamp(), fetch_after_timestamp.timestamp()))
+        return [row[0] for row in rows]
+
+    def update_runs(self, repo, workflow_runs, deleted_run_ids=(), listed=True):
+        """Insert or update workflow runs and delete runs no longer found. If
+        the runs were listed, rather than re-checked, move the watermark to
+        the newest"""
+
+        with self.db:
+            self.db.executemany(
+                'INSERT OR REPLACE INTO workflow_runs (repo, run_id, created, status, workflow_run) '
+                'VALUES (?, ?, ?, ?, ?)',
+                [(repo, workflow_run['id'], created_epoch(workflow_run), workflow_run['status'],
+                  json.dumps(workflow_run)) for workflow_run in workflow_runs])
+            self.db.executemany(
+                'DELETE FROM workflow_runs WHERE repo = ? AND run_id = ?',
+                [(repo, run_id) for run_id in deleted_run_ids])
+            if listed and workflow_runs:
+                self.db.execute(
+                    'INSERT INTO watermarks (repo, created) VALUES (?, ?) '
+                    'ON CONFLICT (repo) DO UPDATE SET created = MAX(created, excluded.created)',
+                    (repo, max(created_epoch(workflow_run) for workflow_run in workflow_runs)))
+
+    def get_runs(self, repo, timestamp):
+        """Get workflow runs created on or after timestamp, newest first as
+        listed by the API"""
+
+        rows = self.db.execute(
+            'SELECT workflow_run FROM workflow_runs WHERE repo = ? AND created >= ? '
+            'ORDER BY created DESC, run_id DESC',
+            (repo, timestamp.timestamp()))
+        return [json.loads(row[0]) for row in rows]
+
+    def prune(self, timestamp):
+        """Delete runs created before timestamp"""
+
+        with self.db:
+            self.db.execute('DELETE FROM workflow_runs WHERE created < ?', (timestamp.timestamp(),))
+            self.db.execute('UPDATE coverage SET start = MAX(start, ?)', (timestamp.timestamp(),))
@@ -0,0 +1 @@
+"""Common code shared by the ssm-command-monitoring and github-workflow-monitoring scripts"""
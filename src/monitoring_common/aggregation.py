@@ -0,0 +1,132 @@
+"""Compact status counters shared by the monitoring scripts
+
+Counts are held in a flat dict keyed by (group, name), e.g. (instance_id,
+document_name) or (repo, workflow_name), with one small list of integers per
+key indexed by status. The 'all' rollup rows are calculated once when the
+summary is produced rather than on every increment.
+
+SketchTable holds quantile sketches with the same keys, e.g. run durations,
+rolled up the same way.
+"""
+
+import datetime
+import functools
+
+from monitoring_common import quantiles
+
+TIMESTAMP_CACHE_SIZE = 65536
+
+
+@functools.lru_cache(maxsize=TIMESTAMP_CACHE_SIZE)
+def parse_timestamp(value):
+    """Parse an ISO 8601 timestamp as returned by AWS and GitHub APIs. Many
+    records share the same timestamp, e.g. all invocations of a command, so
+    results are cached"""
+
+    if value.endswith('Z'):
+        value = value[:-1] + '+00:00'
+    return datetime.datetime.fromisoformat(value)
+
+
+class StatsTable:
+    """Status counters keyed by (group, name)"""
+
+    __slots__ = ('statuses', 'status_index', 'counters')
+
+    def __init__(self, statuses):
+        self.statuses = tuple(statuses)
+        self.status_index = {status: i for i, status in enumerate(self.statuses)}
+        self.counters = {}
+
+    def add(self, group, name, status=None):
+        """Increment the count for the given status. A group of None only
+        counts towards the 'all' group, and a status of None just ensures a
+        zeroed entry exists"""
+
+        key = (group, name)
+        counts = self.counters.get(key)
+        if counts is None:
+            counts = self.counters[key] = [0] * len(self.statuses)
+        if status is not None:
+            counts[self.status_index[status]] += 1
+
+    def update(self, other):
+        """Add the counts from another table with the same statuses, e.g. to
+        roll up time buckets into a window"""
+
+        for key, other_counts in other.counters.items():
+            counts = self.counters.get(key)
+            if counts is None:
+                self.counters[key] = list(other_counts)
+            else:
+                for i, count in enumerate(other_counts):
+                    counts[i] += count
+
+    def summary(self):
+        """Get stats as nested dicts, summary[group][name][status], including
+        'all' rows for totals across groups and names. Groups and names are
+        in the order they were first added"""
+
+        if not self.counters:
+            return {}
+        num_statuses = len(self.statuses)
+        totals = {'all': {'all': [0] * num_statuses}}
+        for (group, name), counts in self.counters.items():
+            targets = [totals['all']['all'], totals['all'].setdefault(name, [0] * num_statuses)]
+            if group is not None:
+                if group not in totals:
+                    totals[group] = {'all': [0] * num_statuses}
+                targets += [totals[group]['all'], totals[group].setdefault(name, [0] * num_statuses)]
+            for target in targets:
+                for i in range(num_statuses):
+                    target[i] += counts[i]
+        return {
+            group: {
+                name: dict(zip(self.statuses, counts))
+                for name, counts in names.items()
+            } for group, names in totals.items()
+        }
+
+
+class SketchTable:
+    """Quantile sketches of named measures keyed by (group, name)"""
+
+    __slots__ = ('measures', 'measure_index', 'sketches')
+
+    def __init__(self, measures):
+        self.measures = tuple(measures)
+        self.measure_index = {measure: i for i, measure in enumerate(self.measures)}
+        self.sketches = {}
+
+    def add(self, group, name, measure, value):
+        """Add a value of the measure, a group of None only counts towards
+        the 'all' group"""
+
+        key = (group, name)
+        sketches = self.sketches.get(key)
+        if sketches is None:
+            sketches = self.sketches[key] = [quantiles.QuantileSketch() for _ in self.measures]
+        sketches[self.measure_index[measure]].add(value)
+
+    def summary(self):
+        """Get merged sketches as nested dicts, summary[group][name][measure],
+        including 'all' rows as for StatsTable.summary()"""
+
+        totals = {}
+        for (group, name), sketches in self.sketches.items():
+            targets = [('all', 'all'), ('all', name)]
+            if group is not None:
+                targets += [(group, 'all'), (group, name)]
+            for target_group, target_name in targets:
+                names = totals.setdefault(target_group, {})
+                if target_name not in names:
+                    names[target_name] = [quantiles.QuantileSketch() for _ in self.measures]
+                target = names[target_name]
+                for total, sketch in zip(target, sketches):
+                    total.merge(sketch)
+        return {
+            group: {
+                name: dict(zip(self.measures, sketches))
+                for name, sketches in names.items()
+            } for group, names in totals.items()
+        }
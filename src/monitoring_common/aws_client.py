@@ -0,0 +1,309 @@
+"""AWS API backends for the monitoring scripts
+
+Two interchangeable backends are provided:
+
+  boto3 - in-process client. One botocore session and connection pool per
+          profile, pages walked in-process and records yielded as they arrive
+  cli   - spawn the aws cli for each call. Always available as a fallback
+
+Both accept API shaped parameters (as used by boto3 and --cli-input-json) and
+return records in the same shape as the aws cli JSON output, i.e. timestamps
+are ISO 8601 strings rather than datetime objects.
+"""
+
+import contextlib
+import json
+import os
+import re
+import subprocess
+import tempfile
+import threading
+import time
+
+try:
+    import boto3
+    import botocore
+    import botocore.config
+    import botocore.session
+    import botocore.utils
+except ImportError:
+    boto3 = None
+
+from monitoring_common import scheduler, timings
+
+AWSCLI_TIMEOUT_SECS = 30
+# Max records per aws cli call when paging, so memory stays bounded
+AWSCLI_PAGE_ITEMS = 10000
+# Records per API page, by service, where the aws cli pages through a call
+# itself. Rate limits apply per API page, as they do for the boto3 backend
+AWSCLI_API_PAGE_ITEMS = {
+    'ssm': 50,
+}
+# Linux limits each command line argument to 128KB, so larger --cli-input-json
+# is passed in a file, e.g. a full PutMetricData batch
+AWSCLI_MAX_INPUT_ARG_BYTES = 32768
+# Errors the aws cli reports which are worth retrying, as classified by
+# botocore standard mode retries for the boto3 backend. Anything else, e.g.
+# AccessDenied, expired credentials or validation errors, fails straight away
+AWSCLI_ERROR_CODE_RE = re.compile(r'An error occurred \(([^)]+)\)')
+AWSCLI_TRANSIENT_ERROR_CODES = {
+    'RequestTimeout',
+    'RequestTimeoutException',
+    'PriorRequestNotComplete',
+    'InternalError',
+    'InternalFailure',
+    'InternalServerError',
+    'InternalServerException',
+    'ServiceUnavailable',
+    'ServiceUnavailableException',
+    'BadGateway',
+    'GatewayTimeout',
+    '500',
+    '502',
+    '503',
+    '504',
+}
+AWSCLI_CONNECTION_ERRORS = (
+    'Could not connect to the endpoint URL',
+    'Connect timeout on endpoint URL',
+    'Read timeout on endpoint URL',
+    'Connection was closed',
+    'Connection reset',
+)
+BACKENDS = ['auto', 'boto3', 'cli']
+
+_backend_cache = {}
+
+
+def cli_timestamp(value):
+    """Parse a timestamp and format as the aws cli does by default"""
+
+    return botocore.utils.parse_timestamp(value).isoformat()
+
+
+@contextlib.contextmanager
+def cli_input_json(params):
+    """Get the aws cli arguments to pass API parameters, if any. Large
+    parameters are written to a temporary file which exists until exit"""
+
+    if not params:
+        yield []
+        return
+    input_json = json.dumps(params)
+    if len(input_json) <= AWSCLI_MAX_INPUT_ARG_BYTES:
+        yield ['--cli-input-json', input_json]
+        return
+    with tempfile.NamedTemporaryFile('w', encoding='utf-8', prefix='aws-cli-input-', suffix='.json') as f:
+        f.write(input_json)
+        f.flush()
+        yield ['--cli-input-json', 'file://' + f.name]
+
+
+class AwsCliBackend:
+    """Call AWS APIs by invoking the aws cli"""
+
+    name = 'cli'
+
+    def __init__(self, profile=None, region=None, endpoint_url=None,
+                 timeout=AWSCLI_TIMEOUT_SECS):
+        self.profile = profile
+        self.timeout = timeout
+        self.common_args = []
+        if profile:
+            self.common_args += ['--profile', profile]
+        if region:
+            self.common_args += ['--region', region]
+        if endpoint_url:
+            self.common_args += ['--endpoint-url', endpoint_url]
+
+    def run_once(self, cmd):
+        """Invoke AWS CLI and raise exception on error"""
+
+        start = time.perf_counter()
+        try:
+            result = subprocess.run(cmd,
+                                    capture_output=True,
+                                    text=True,
+                                    check=False,
+                                    timeout=self.timeout)
+        except subprocess.TimeoutExpired as e:
+            raise scheduler.RetryableError('timeout for cmd ' + ' '.join(cmd)) from e
+        timings.add_api_call(cmd[1], cmd[2], time.perf_counter() - start, len(result.stdout))
+        if result.returncode != 0:
+            error = (f'exit code {result.returncode} for cmd ' + ' '.join(cmd) +
+                     os.linesep + result.stderr)
+            if any(code in result.stderr for code in scheduler.THROTTLE_ERROR_CODES):
+                raise scheduler.ThrottledError(error)
+            match = AWSCLI_ERROR_CODE_RE.search(result.stderr)
+            if match and match.group(1) in AWSCLI_TRANSIENT_ERROR_CODES:
+                raise scheduler.RetryableError(error)
+            if not match and any(message in result.stderr for message in AWSCLI_CONNECTION_ERRORS):
+                raise scheduler.RetryableError(error)
+            raise ValueError(error)
+        if not result.stdout:
+            return {}
+        with timings.phase('json_decode'):
+            return json.loads(result.stdout)
+
+    def run(self, cmd):
+        """Invoke AWS CLI, rate limited and retried by the service's scheduler"""
+
+        cmd = cmd + self.common_args
+        return scheduler.get_scheduler(cmd[1], self.profile).run(lambda: self.run_once(cmd))
+
+    def call(self, service, operation, params=None):
+        """Call an API operation, e.g. ('ssm', 'list-commands'). The cli
+        merges all pages into a single response"""
+
+        with cli_input_json(params) as input_args:
+            return self.run(['aws', service, operation] + input_args)
+
+    def paginate_pages(self, service, operation, result_key, params=None):
+        """Yield lists of records, one aws cli call per AWSCLI_PAGE_ITEMS records"""
+
+        starting_token = None
+        with cli_input_json(params) as input_args:
+            while True:
+                cmd = ['aws', service, operation, '--max-items', str(AWSCLI_PAGE_ITEMS)] + input_args
+                if starting_token:
+                    cmd += ['--starting-token', starting_token]
+                start = time.monotonic()
+                response = self.run(cmd)
+                page = response.get(result_key, [])
+                timings.add_api_records(service, operation, len(page))
+                # run() took a token for the first API page, take one for each of the rest
+                api_pages = -(-len(page) // AWSCLI_API_PAGE_ITEMS.get(service, len(page) or 1))
+                if api_pages > 1:
+                    scheduler.get_scheduler(service, self.profile).acquire(api_pages - 1,
+                                                                           time.monotonic() - start)
+                yield page
+                starting_token = response.get('NextToken')
+                if not starting_token:
+                    return
+
+    def paginate(self, service, operation, result_key, params=None):
+        """Yield records from all pages of an API operation"""
+
+        for page in self.paginate_pages(service, operation, result_key, params):
+            yield from page
+
+
+def register_scheduler(client, request_scheduler):
+    """Rate limit every request attempt made by a boto3 client and feed
+    botocore retries and throttles back into the scheduler"""
+
+    def before_send(request, **_kwargs):
+        request_scheduler.acquire()
+        if request.context.get('retries', {}).get('attempt', 1) > 1:
+            request_scheduler.on_retry()
+
+    def needs_retry(response, caught_exception, **_kwargs):
+        # observe only, returning None leaves the decision to botocore
+        if caught_exception is not None or response is None:
+            return
+        code = response[1].get('Error', {}).get('Code')
+        if code in scheduler.THROTTLE_ERROR_CODES:
+            request_scheduler.on_throttle()
+        elif response[0].status_code < 400:
+            request_scheduler.on_success()
+
+    client.meta.events.register('before-send', before_send)
+    client.meta.events.register_first('needs-retry', needs_retry)
+
+
+def register_timings(client, service):
+    """Count API calls and bytes received by a boto3 client. Wall time of
+    each call includes any retries"""
+
+    def before_call(context, **_kwargs):
+        context['timings_start'] = time.perf_counter()
+
+    def after_call(http_response, model, context, **_kwargs):
+        wall_secs = time.perf_counter() - context.get('timings_start', time.perf_counter())
+        timings.add_api_call(service, botocore.xform_name(model.name, '-'),
+                             wall_secs, len(http_response.content or b''))
+
+    client.meta.events.register('before-call', before_call)
+    client.meta.events.register('after-call', after_call)
+
+
+class Boto3Backend:
+    """Call AWS APIs in-process using boto3"""
+
+    name = 'boto3'
+
+    def __init__(self, profile=None, region=None, endpoint_url=None,
+                 timeout=AWSCLI_TIMEOUT_SECS):
+        if boto3 is None:
+            raise ValueError('boto3 backend selected but boto3 is not installed')
+        botocore_session = botocore.session.get_session()
+        botocore_session.get_component(
+            'response_parser_factory').set_parser_defaults(
+                timestamp_parser=cli_timestamp)
+        self.session = boto3.Session(botocore_session=botocore_session,
+                                     profile_name=profile,
+                                     region_name=region)
+        self.profile = profile
+        self.endpoint_url = endpoint_url
+        # botocore standard mode retries with exponential backoff, jitter and
+        # a retry quota. Rate limiting is done by the shared scheduler
+        self.config = botocore.config.Config(connect_timeout=timeout,
+                                             read_timeout=timeout,
+                                             retries={
+                                                 'mode': 'standard',
+                                                 'max_attempts': scheduler.MAX_ATTEMPTS
+                                             })
+        self.clients = {}
+        self.clients_lock = threading.Lock()
+
+    def client(self, service):
+        """Get a client for the service, creating on first use. Clients are
+        thread safe but creating them from a shared session is not"""
+
+        with self.clients_lock:
+            if service not in self.clients:
+                client = self.session.client(
+                    service, config=self.config, endpoint_url=self.endpoint_url)
+                register_scheduler(client, scheduler.get_scheduler(service, self.profile))
+                register_timings(client, service)
+                self.clients[service] = client
+            return self.clients[service]
+
+    def call(self, service, operation, params=None):
+        """Call a single API operation, e.g. ('ssm', 'get-command-invocation')"""
+
+        method = getattr(self.client(service), operation.replace('-', '_'))
+        response = method(**(params or {}))
+        response.pop('ResponseMetadata', None)
+        return response
+
+    def paginate_pages(self, service, operation, result_key, params=None):
+        """Yield lists of records, one per API page"""
+
+        paginator = self.client(service).get_paginator(operation.replace('-', '_'))
+        for page in paginator.paginate(**(params or {})):
+            records = page.get(result_key, [])
+            timings.add_api_records(service, operation, len(records))
+            yield records
+
+    def paginate(self, service, operation, result_key, params=None):
+        """Yield records from all pages of an API operation"""
+
+        for page in self.paginate_pages(service, operation, result_key, params):
+            yield from page
+
+
+def get_backend(name='auto', profile=None, region=None, endpoint_url=None):
+    """Get a backend, reusing an existing one for the same profile"""
+
+    if name == 'auto':
+        name = 'cli' if boto3 is None else 'boto3'
+    key = (name, profile, region, endpoint_url)
+    if key not in _backend_cache:
+        if name == 'boto3':
+            _backend_cache[key] = Boto3Backend(profile, region, endpoint_url)
+        elif name == 'cli':
+            _backend_cache[key] = AwsCliBackend(profile, region, endpoint_url)
+        else:
+            raise ValueError(f'unsupported backend {name}')
+    return _backend_cache[key]
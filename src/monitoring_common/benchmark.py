@@ -0,0 +1,78 @@
+"""Results handling shared by the ssm-command and github-workflow benchmarks
+
+Each benchmark run appends a result per size to a JSON Lines file, with
+its parameters and a result per phase including wall_secs, peak_rss_mb,
+a count and a count per second. A phase regresses if, for the same
+parameters and count as the most recent previous result, throughput has
+dropped or peak RSS grown by more than a threshold.
+"""
+
+import importlib.util
+import json
+import os
+import resource
+import subprocess
+
+REGRESSION_THRESHOLD = 0.2
+# phases quicker than this are too noisy to compare
+REGRESSION_MIN_WALL_SECS = 1
+
+
+def load_script(filename, name):
+    """Import a monitor script, e.g. ssm-command-monitor.py, which isn't a
+    valid module name, to benchmark parts of it in-process"""
+
+    spec = importlib.util.spec_from_file_location(name, filename)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process so far"""
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def get_commit():
+    """Get current git commit, or None if not in a git repo"""
+
+    try:
+        result = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                                capture_output=True, text=True, check=False,
+                                cwd=os.path.dirname(os.path.abspath(__file__)))
+    except OSError:
+        return None
+    return result.stdout.strip() or None
+
+
+def read_results(filename):
+    """Read previous results"""
+
+    if not os.path.exists(filename):
+        return []
+    with open(filename, encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def find_previous(results, params):
+    """Find the most recent result with the same parameters"""
+
+    for result in reversed(results):
+        if result['params'] == params:
+            return result
+    return None
+
+
+def is_regression(phase_result, previous_phase_result, threshold, count='records'):
+    """Check if throughput, count per second, dropped or peak RSS grew by
+    more than threshold"""
+
+    if not previous_phase_result:
+        return False
+    if phase_result[count] != previous_phase_result[count]:
+        return False
+    if max(phase_result['wall_secs'], previous_phase_result['wall_secs']) < REGRESSION_MIN_WALL_SECS:
+        return False
+    return (phase_result[f'{count}_per_sec'] < previous_phase_result[f'{count}_per_sec'] * (1 - threshold)
+            or phase_result['peak_rss_mb'] > previous_phase_result['peak_rss_mb'] * (1 + threshold))
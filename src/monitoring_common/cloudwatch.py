@@ -0,0 +1,71 @@
+"""Batched upload of CloudWatch custom metrics
+
+Metrics are packed into as few PutMetricData calls as the API allows rather
+than one aws cli call per metric.
+"""
+
+import json
+import os
+import sys
+
+CLOUDWATCH_NAMESPACE = 'CustomMetrics'
+CLOUDWATCH_REGION = 'eu-west-2'
+PUT_METRIC_DATA_MAX_METRICS = 1000
+# API limit is 1MB per request. Query protocol encoding is larger than the
+# JSON used to estimate size, so leave plenty of headroom
+PUT_METRIC_DATA_MAX_JSON_BYTES = 400000
+
+
+def metric_datum(metric_name, value, timestamp, dimensions=None):
+    """Create a PutMetricData MetricDatum, dimensions is a dict of name to value"""
+
+    datum = {
+        'MetricName': metric_name,
+        'Value': value,
+        'Timestamp': timestamp,
+    }
+    if dimensions:
+        datum['Dimensions'] = [{
+            'Name': dimension_name,
+            'Value': dimension_value
+        } for dimension_name, dimension_value in dimensions.items()]
+    return datum
+
+
+def batch_metric_data(metric_data,
+                      max_metrics=PUT_METRIC_DATA_MAX_METRICS,
+                      max_json_bytes=PUT_METRIC_DATA_MAX_JSON_BYTES):
+    """Split metric data into the largest batches allowed by a single call"""
+
+    batch = []
+    batch_bytes = 0
+    for datum in metric_data:
+        datum_bytes = len(json.dumps(datum))
+        if batch and (len(batch) >= max_metrics or batch_bytes + datum_bytes > max_json_bytes):
+            yield batch
+            batch = []
+            batch_bytes = 0
+        batch.append(datum)
+        batch_bytes += datum_bytes
+    if batch:
+        yield batch
+
+
+def put_metric_data(client, metric_data, dryrun=False, namespace=CLOUDWATCH_NAMESPACE):
+    """Upload metrics in batches using an aws_client backend. If dryrun, show the
+    equivalent aws cli commands but don't upload. Returns number of batches"""
+
+    num_batches = 0
+    for batch in batch_metric_data(metric_data):
+        cmd = (f"aws cloudwatch put-metric-data --namespace {namespace} "
+               f"--metric-data '{json.dumps(batch)}' --region {CLOUDWATCH_REGION}")
+        num_batches += 1
+        if dryrun:
+            sys.stderr.write(f'DRYRUN: {cmd}' + os.linesep)
+            continue
+        sys.stderr.write(cmd + os.linesep)
+        client.call('cloudwatch', 'put-metric-data', {
+            'Namespace': namespace,
+            'MetricData': batch
+        })
+    return num_batches
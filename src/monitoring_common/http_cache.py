@@ -0,0 +1,113 @@
+"""On-disk HTTP response cache for conditional requests
+
+The ETag and Last-Modified validators of each cached GET response are kept
+with its body in SQLite, keyed by URL. Requests for a cached URL send
+If-None-Match / If-Modified-Since, and on 304 Not Modified the cached body
+is used. GitHub doesn't count 304 responses against the rate limit, so
+re-fetching unchanged pages costs almost nothing.
+
+Bodies are stored zlib compressed. When the total stored size exceeds
+max_bytes, the least recently used entries are evicted.
+"""
+
+import sqlite3
+import threading
+import time
+import zlib
+
+from monitoring_common import timings
+
+DEFAULT_MAX_MB = 64
+SQLITE_TIMEOUT_SECS = 60
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS responses (
+    url TEXT PRIMARY KEY,
+    etag TEXT,
+    last_modified TEXT,
+    used REAL NOT NULL,
+    size INTEGER NOT NULL,
+    body BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS responses_used ON responses (used);
+'''
+
+
+class HttpCache:
+    """Cached responses, safe to share between fetch threads. Lookups and
+    304 hits are counted in timings under the given name"""
+
+    def __init__(self, filename, max_bytes=DEFAULT_MAX_MB * 1024 * 1024, name='http'):
+        self.max_bytes = max_bytes
+        self.name = name
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(filename, timeout=SQLITE_TIMEOUT_SECS, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        """Close the database"""
+
+        with self.lock:
+            self.db.close()
+
+    def get_validators(self, url):
+        """Get conditional request headers for a cached URL, empty if not
+        cached"""
+
+        with self.lock:
+            row = self.db.execute(
+                'SELECT etag, last_modified FROM responses WHERE url = ?', (url,)).fetchone()
+        headers = {}
+        if row and row[0]:
+            headers['If-None-Match'] = row[0]
+        if row and row[1]:
+            headers['If-Modified-Since'] = row[1]
+        return headers
+
+    def get_body(self, url):
+        """Get the cached body after a 304 response, and count the hit.
+        Returns None if the entry has since been evicted"""
+
+        with self.lock:
+            row = self.db.execute('SELECT body FROM responses WHERE url = ?', (url,)).fetchone()
+            if row is not None:
+                with self.db:
+                    self.db.execute('UPDATE responses SET used = ? WHERE url = ?', (time.time(), url))
+        timings.add_cache_lookup(self.name, row is not None)
+        return None if row is None else zlib.decompress(row[0])
+
+    def put(self, url, headers, body):
+        """Cache a 200 response if it has a validator, and count the miss"""
+
+        timings.add_cache_lookup(self.name, False)
+        etag = headers.get('ETag')
+        last_modified = headers.get('Last-Modified')
+        if not etag and not last_modified:
+            return
+        data = zlib.compress(body)
+        if len(data) > self.max_bytes:
+            return
+        with self.lock, self.db:
+            self.db.execute(
+                'INSERT OR REPLACE INTO responses (url, etag, last_modified, used, size, body) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (url, etag, last_modified, time.time(), len(data), data))
+            self.evict()
+
+    def evict(self):
+        """Delete least recently used entries until within max_bytes. Call
+        with the lock held"""
+
+        total = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        rows = self.db.execute('SELECT url, size FROM responses ORDER BY used').fetchall()
+        evicted = []
+        for url, size in rows:
+            if total <= self.max_bytes:
+                break
+            evicted.append((url,))
+            total -= size
+        self.db.executemany('DELETE FROM responses WHERE url = ?', evicted)
+        timings.add_cache_evictions(self.name, len(evicted))
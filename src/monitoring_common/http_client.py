@@ -0,0 +1,119 @@
+"""Pooled keep-alive HTTP client for REST APIs, e.g. GitHub
+
+Starting a process and a TLS handshake per request costs far more than the
+request itself, so connections to the API host are kept open and reused.
+Each connection carries one request at a time, so the pool holds up to
+max_connections of them, shared by the threads of a fetch pool. A reused
+connection may have been closed by the server while idle, in which case
+the request is retried once on a fresh connection.
+"""
+
+import gzip
+import http.client
+import queue
+import threading
+import urllib.parse
+
+DEFAULT_MAX_CONNECTIONS = 8
+DEFAULT_TIMEOUT_SECS = 10
+
+
+class HttpResponse:
+    """Status, headers and decoded body of a completed request"""
+
+    __slots__ = ('status', 'headers', 'body', 'bytes_received')
+
+    def __init__(self, status, headers, body, bytes_received):
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.bytes_received = bytes_received
+
+    def text(self):
+        """Get the body as a string"""
+
+        return self.body.decode('utf-8', errors='replace')
+
+
+class HttpConnectionPool:
+    """Keep-alive connections to the host of base_url. Connection and
+    protocol errors are raised as OSError or http.client.HTTPException"""
+
+    def __init__(self, base_url, max_connections=DEFAULT_MAX_CONNECTIONS,
+                 timeout=DEFAULT_TIMEOUT_SECS, headers=None):
+        url = urllib.parse.urlsplit(base_url)
+        if url.scheme not in ('http', 'https'):
+            raise ValueError(f'unsupported URL {base_url}')
+        self.base_url = base_url.rstrip('/')
+        self.scheme = url.scheme
+        self.host = url.hostname
+        self.port = url.port
+        self.base_path = url.path.rstrip('/')
+        self.timeout = timeout
+        self.headers = dict(headers or {})
+        self.headers.setdefault('Accept-Encoding', 'gzip')
+        self.idle = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(max_connections)
+        self.connections_opened = 0
+        self.lock = threading.Lock()
+
+    def new_connection(self):
+        """Open a connection to the host"""
+
+        with self.lock:
+            self.connections_opened += 1
+        if self.scheme == 'https':
+            return http.client.HTTPSConnection(self.host, self.port, timeout=self.timeout)
+        return http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+    def path(self, uri):
+        """Get the request path for a path or full URL on the pool's host"""
+
+        if uri.startswith(self.base_url):
+            uri = uri[len(self.base_url):]
+        elif '://' in uri:
+            raise ValueError(f'{uri} is not on {self.base_url}')
+        return self.base_path + uri
+
+    def request(self, method, uri, headers=None):
+        """Send a request and read the whole response, waiting for a free
+        connection if all are in use"""
+
+        path = self.path(uri)
+        request_headers = dict(self.headers, **(headers or {}))
+        with self.slots:
+            try:
+                connection = self.idle.get_nowait()
+                reused = True
+            except queue.Empty:
+                connection = self.new_connection()
+                reused = False
+            while True:
+                try:
+                    connection.request(method, path, headers=request_headers)
+                    response = connection.getresponse()
+                    body = response.read()
+                    break
+                except (OSError, http.client.HTTPException):
+                    connection.close()
+                    if not reused:
+                        raise
+                    connection = self.new_connection()
+                    reused = False
+            if response.will_close:
+                connection.close()
+            else:
+                self.idle.put(connection)
+        bytes_received = len(body)
+        if response.getheader('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        return HttpResponse(response.status, response.headers, body, bytes_received)
+
+    def close(self):
+        """Close all idle connections"""
+
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                return
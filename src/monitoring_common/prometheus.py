@@ -0,0 +1,139 @@
+"""Prometheus text format /metrics endpoint for long running monitors
+
+The monitor formats all its metrics after each poll and hands the text to
+MetricsServer, which serves the latest copy from a background thread. So
+scrapes are cheap and always see a consistent set of metrics.
+"""
+
+import http.server
+import threading
+
+from monitoring_common import scheduler, timings
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+DEFAULT_METRICS_ADDRESS = '127.0.0.1'
+DEFAULT_METRICS_PORT = 9464
+
+
+def escape_label_value(value):
+    """Escape a label value as required by the text format"""
+
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_metric(name, metric_type, help_text, samples):
+    """Format a metric family, samples is a list of (labels dict, value)"""
+
+    lines = [f'# HELP {name} {help_text}', f'# TYPE {name} {metric_type}']
+    for labels, value in samples:
+        if labels:
+            label_str = ','.join(f'{key}="{escape_label_value(label)}"'
+                                 for key, label in labels.items())
+            lines.append(f'{name}{{{label_str}}} {value}')
+        else:
+            lines.append(f'{name} {value}')
+    return lines
+
+
+def format_scheduler_counters():
+    """Format API request counters for all schedulers"""
+
+    counters = scheduler.get_counters()
+    lines = []
+    for counter in ('requests', 'retries', 'throttles', 'errors'):
+        lines += format_metric(
+            f'monitor_api_{counter}_total', 'counter', f'API {counter} by scheduler',
+            [({'scheduler': name}, values[counter]) for name, values in counters.items()])
+    lines += format_metric(
+        'monitor_api_wait_seconds_total', 'counter', 'Time spent waiting for rate limit by scheduler',
+        [({'scheduler': name}, round(values['wait_secs'], 3)) for name, values in counters.items()])
+    quotas = [(name, values) for name, values in counters.items() if 'quota_used' in values]
+    if quotas:
+        lines += format_metric(
+            'monitor_api_quota_used_total', 'counter', 'API quota used by scheduler',
+            [({'scheduler': name}, values['quota_used']) for name, values in quotas])
+        lines += format_metric(
+            'monitor_api_quota_remaining', 'gauge', 'API quota remaining by scheduler',
+            [({'scheduler': name}, values['quota_remaining']) for name, values in quotas])
+    return lines
+
+
+def format_timings():
+    """Format per-phase and per-API operation counters, see timings"""
+
+    report = timings.get_report()
+    phases = report['phases'].items()
+    api_calls = report['api_calls'].items()
+    lines = format_metric(
+        'monitor_phase_seconds_total', 'counter', 'Wall time by phase',
+        [({'phase': name}, values['wall_secs']) for name, values in phases])
+    lines += format_metric(
+        'monitor_phase_cpu_seconds_total', 'counter', 'CPU time by phase',
+        [({'phase': name}, values['cpu_secs']) for name, values in phases])
+    lines += format_metric(
+        'monitor_phase_records_total', 'counter', 'Records processed by phase',
+        [({'phase': name}, values['records']) for name, values in phases])
+    for counter in ('calls', 'pages', 'records', 'bytes'):
+        lines += format_metric(
+            f'monitor_api_{counter}_total', 'counter', f'API {counter} by operation',
+            [({'api': name}, values[counter]) for name, values in api_calls])
+    lines += format_metric(
+        'monitor_api_seconds_total', 'counter', 'API call wall time by operation',
+        [({'api': name}, values['wall_secs']) for name, values in api_calls])
+    for counter in ('hits', 'misses', 'evictions'):
+        lines += format_metric(
+            f'monitor_cache_{counter}_total', 'counter', f'Response cache {counter}',
+            [({'cache': name}, values[counter]) for name, values in report['caches'].items()])
+    lines += format_metric(
+        'monitor_peak_rss_bytes', 'gauge', 'Peak resident set size',
+        [({}, int(report['peak_rss_mb'] * 1024 * 1024))])
+    return lines
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    """Serve the current metrics on /metrics"""
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """Metrics request"""
+
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        data = self.server.get_metrics().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class MetricsServer(http.server.ThreadingHTTPServer):
+    """HTTP server for the /metrics endpoint, serving in a background thread"""
+
+    daemon_threads = True
+
+    def __init__(self, address=DEFAULT_METRICS_ADDRESS, port=DEFAULT_METRICS_PORT):
+        super().__init__((address, port), MetricsHandler)
+        self.metrics = ''
+        self.metrics_lock = threading.Lock()
+
+    def start(self):
+        """Start serving in a background thread"""
+
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def set_metrics(self, lines):
+        """Replace the metrics served"""
+
+        text = '\n'.join(lines) + '\n'
+        with self.metrics_lock:
+            self.metrics = text
+
+    def get_metrics(self):
+        """Get the metrics to serve"""
+
+        with self.metrics_lock:
+            return self.metrics
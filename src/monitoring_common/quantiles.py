@@ -0,0 +1,84 @@
+"""Mergeable streaming quantile sketch
+
+QuantileSketch keeps counts in logarithmic bins, as in DDSketch, so any
+quantile is returned within relative_accuracy of the true value using
+bounded memory however many values are added. Sketches with the same
+accuracy merge exactly, so per-workflow sketches can be rolled up across
+repos and time buckets without keeping the values.
+"""
+
+import math
+
+DEFAULT_RELATIVE_ACCURACY = 0.01
+# Values at or below this are counted as zero, e.g. a run that didn't queue
+MIN_VALUE = 1e-3
+# With 1% accuracy this covers 1ms to over 10 days without collapsing
+MAX_BINS = 2048
+
+
+class QuantileSketch:
+    """Approximate quantiles of non-negative values"""
+
+    __slots__ = ('relative_accuracy', 'gamma', 'log_gamma', 'bins', 'zero_count', 'count', 'max')
+
+    def __init__(self, relative_accuracy=DEFAULT_RELATIVE_ACCURACY):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.bins = {}
+        self.zero_count = 0
+        self.count = 0
+        self.max = None
+
+    def add(self, value):
+        """Add a value, negative values are counted as zero"""
+
+        value = max(0.0, value)
+        self.count += 1
+        self.max = value if self.max is None else max(self.max, value)
+        if value <= MIN_VALUE:
+            self.zero_count += 1
+            return
+        key = math.ceil(math.log(value) / self.log_gamma)
+        self.bins[key] = self.bins.get(key, 0) + 1
+        if len(self.bins) > MAX_BINS:
+            self.collapse()
+
+    def collapse(self):
+        """Fold the lowest bins together to stay within MAX_BINS, losing
+        accuracy only for the smallest values"""
+
+        keys = sorted(self.bins)
+        excess = len(keys) - MAX_BINS
+        folded = sum(self.bins.pop(key) for key in keys[:excess + 1])
+        self.bins[keys[excess]] = folded
+
+    def merge(self, other):
+        """Add the values of another sketch with the same accuracy"""
+
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError('cannot merge sketches with different relative accuracy')
+        if not other.count:
+            return
+        for key, count in other.bins.items():
+            self.bins[key] = self.bins.get(key, 0) + count
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self.max = other.max if self.max is None else max(self.max, other.max)
+        if len(self.bins) > MAX_BINS:
+            self.collapse()
+
+    def quantile(self, q):
+        """Get the approximate q quantile, 0 <= q <= 1, or None if empty"""
+
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        if rank < self.zero_count:
+            return 0.0
+        seen = self.zero_count
+        for key in sorted(self.bins):
+            seen += self.bins[key]
+            if seen > rank:
+                return min(self.max, 2 * self.gamma ** key / (self.gamma + 1))
+        return self.max
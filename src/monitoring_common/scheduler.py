@@ -0,0 +1,299 @@
+"""Client side rate limiting and retries for API calls
+
+One RequestScheduler is kept per API and account. Each request first takes a
+token from an adaptive token bucket. The rate halves on every throttle and
+creeps back up towards the configured maximum on success, so throughput stays
+close to the API limit without repeatedly tripping it. Failed requests are
+retried with exponential backoff and full jitter, subject to a per scheduler
+retry budget so a struggling API fails fast rather than retrying forever.
+
+APIs which report their quota, e.g. GitHub's X-RateLimit-* headers, can
+also pass it to update_quota(). If the remaining quota won't cover the
+requests planned with plan(), the rate is capped so the quota lasts until
+it resets, and once exhausted all requests wait for the reset. A Retry-After
+on a throttle likewise pauses all requests to the API.
+"""
+
+import random
+import threading
+import time
+
+# Requests per second. API limits aren't published for all of these so err on
+# the side of caution, the bucket adapts downwards if we are throttled anyway
+DEFAULT_MAX_RATES = {
+    'cloudwatch': 20,
+    'ec2': 20,
+    'github': 10,
+    'ssm': 10,
+}
+DEFAULT_MAX_RATE = 10
+# Requests which may be sent at once before the rate applies, default the
+# rate. GitHub's secondary rate limit allows 900 REST requests a minute, so
+# a burst of 300 plus 60 seconds at 10 per second stays within it
+DEFAULT_BURSTS = {
+    'github': 300,
+}
+MIN_RATE = 0.5
+RATE_INCREASE_FRACTION = 0.01
+# Concurrent requests tend to be throttled together, only count this as
+# a single event when reducing the rate
+RATE_DECREASE_INTERVAL_SECS = 1
+MAX_ATTEMPTS = 4
+BACKOFF_BASE_SECS = 1
+BACKOFF_MAX_SECS = 20
+# Each retry uses one from the budget and each success refills a fraction,
+# so a sustained retry rate above that fraction soon fails fast
+RETRY_BUDGET = 50
+RETRY_BUDGET_REFILL = 0.2
+# Fail rather than wait longer than this for a Retry-After or quota reset
+RETRY_AFTER_MAX_SECS = 300
+# Leave some quota for other users of the same credentials
+QUOTA_RESERVE = 10
+
+THROTTLE_ERROR_CODES = {
+    'RequestLimitExceeded',
+    'Throttling',
+    'ThrottlingException',
+    'ThrottledException',
+    'TooManyRequestsException',
+    'RequestThrottled',
+    'RequestThrottledException',
+    'Rate exceeded',
+}
+
+_schedulers = {}
+_schedulers_lock = threading.Lock()
+
+
+class RetryableError(ValueError):
+    """Transient API error, the request can be retried"""
+
+
+class ThrottledError(RetryableError):
+    """API rate limit exceeded, the request can be retried more slowly, or
+    after retry_after seconds if the API said so"""
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """Thread safe token bucket. Callers reserve a token and sleep until it
+    is available, so waiters are served in order"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens=1, secs=0):
+        """Take tokens, waiting if necessary. Returns seconds waited. Tokens
+        for requests already made over the last secs may also use those
+        refilled meanwhile, beyond the burst"""
+
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst + secs * self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= tokens
+            wait = 0 if self.tokens >= 0 else -self.tokens / self.rate
+        if wait:
+            time.sleep(wait)
+        return wait
+
+
+class RequestScheduler:
+    """Rate limit and retry requests to one API for one account"""
+
+    def __init__(self, name, max_rate, burst=None, max_attempts=MAX_ATTEMPTS, retry_budget=RETRY_BUDGET):
+        self.name = name
+        self.max_rate = max_rate
+        self.max_attempts = max_attempts
+        self.retry_budget = retry_budget
+        self.max_retry_budget = retry_budget
+        self.bucket = TokenBucket(max_rate, max(max_rate, burst or 0))
+        self.rate_decreased = 0
+        self.quota_rate = None
+        self.quota_window = None
+        self.paused_until = 0
+        self.planned = 0
+        self.lock = threading.Lock()
+        self.counters = {
+            'requests': 0,
+            'retries': 0,
+            'throttles': 0,
+            'errors': 0,
+            'wait_secs': 0.0,
+        }
+
+    def acquire(self, requests=1, secs=0):
+        """Wait for a token before sending a request. Or for several, e.g.
+        for the pages a call fetched by paging through the API itself over
+        secs, so they are paced as if each had been requested separately"""
+
+        wait = max(0, self.paused_until - time.monotonic())
+        if wait:
+            time.sleep(wait)
+        wait += self.bucket.acquire(requests, secs)
+        with self.lock:
+            self.counters['requests'] += requests
+            self.counters['wait_secs'] += wait
+
+    def on_success(self):
+        """Additive increase of the request rate and refill retry budget"""
+
+        with self.lock:
+            self.retry_budget = min(self.max_retry_budget,
+                                    self.retry_budget + RETRY_BUDGET_REFILL)
+        with self.bucket.lock:
+            max_rate = self.max_rate if self.quota_rate is None else min(self.max_rate, self.quota_rate)
+            self.bucket.rate = min(max_rate, self.bucket.rate + self.max_rate * RATE_INCREASE_FRACTION)
+
+    def pause(self, secs):
+        """Hold all requests for secs, e.g. for a Retry-After"""
+
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + secs)
+
+    def plan(self, requests):
+        """Add to the number of requests expected, so the remaining quota
+        can be spread over them"""
+
+        with self.lock:
+            self.planned += requests
+
+    def update_quota(self, limit, remaining, reset):
+        """Record the quota reported by the API, limit requests per window
+        with remaining requests until reset epoch seconds, and pace requests
+        if the remaining quota won't last the planned requests"""
+
+        secs_to_reset = max(1.0, reset - time.time())
+        with self.lock:
+            # responses to concurrent requests arrive out of order, so
+            # track the quota used as the spread of remaining in each window
+            self.counters.setdefault('quota_used', 0)
+            if self.quota_window is None or self.quota_window[0] != reset:
+                if self.quota_window is not None:
+                    self.counters['quota_used'] += self.quota_window[1] - self.quota_window[2]
+                self.quota_window = [reset, remaining + 1, remaining]
+            else:
+                self.quota_window[1] = max(self.quota_window[1], remaining + 1)
+                self.quota_window[2] = min(self.quota_window[2], remaining)
+            self.counters['quota_limit'] = limit
+            self.counters['quota_remaining'] = self.quota_window[2]
+            outstanding = self.planned - self.counters['requests']
+            usable = remaining - QUOTA_RESERVE
+        if usable <= 0:
+            self.quota_rate = None
+            if secs_to_reset <= RETRY_AFTER_MAX_SECS:
+                self.pause(secs_to_reset)
+        elif usable < outstanding:
+            self.quota_rate = usable / secs_to_reset
+            with self.bucket.lock:
+                self.bucket.rate = min(self.bucket.rate, self.quota_rate)
+                # don't burst through the quota that is left
+                self.bucket.tokens = min(self.bucket.tokens, 1)
+        else:
+            self.quota_rate = None
+
+    def get_quota_used(self):
+        """Get the quota used so far, as reported by update_quota()"""
+
+        with self.lock:
+            if self.quota_window is None:
+                return None
+            return self.counters['quota_used'] + self.quota_window[1] - self.quota_window[2]
+
+    def on_throttle(self, retry_after=None):
+        """Multiplicative decrease of the request rate, also discarding any
+        burst so queued requests are spread out at the new rate. If the API
+        gave a retry_after, hold all requests until then"""
+
+        if retry_after:
+            self.pause(retry_after)
+        now = time.monotonic()
+        with self.bucket.lock:
+            if now - self.rate_decreased >= RATE_DECREASE_INTERVAL_SECS:
+                self.bucket.rate = max(MIN_RATE, self.bucket.rate / 2)
+                self.bucket.tokens = min(self.bucket.tokens, 0)
+                self.rate_decreased = now
+        with self.lock:
+            self.counters['throttles'] += 1
+
+    def on_retry(self):
+        """Count a retry made outside of run(), e.g. by botocore"""
+
+        with self.lock:
+            self.counters['retries'] += 1
+
+    def on_error(self):
+        """Count a request that failed without being retried"""
+
+        with self.lock:
+            self.counters['errors'] += 1
+
+    def take_retry(self):
+        """Use up one retry from the budget, returns False if exhausted"""
+
+        with self.lock:
+            if self.retry_budget < 1:
+                return False
+            self.retry_budget -= 1
+            self.counters['retries'] += 1
+            return True
+
+    def run(self, func):
+        """Call func, retrying on RetryableError with exponential backoff
+        and full jitter"""
+
+        attempt = 1
+        while True:
+            self.acquire()
+            try:
+                result = func()
+            except RetryableError as e:
+                retry_after = getattr(e, 'retry_after', None)
+                if isinstance(e, ThrottledError):
+                    self.on_throttle(retry_after)
+                if (attempt >= self.max_attempts or (retry_after or 0) > RETRY_AFTER_MAX_SECS or
+                        not self.take_retry()):
+                    self.on_error()
+                    raise
+                time.sleep(random.uniform(0, min(BACKOFF_MAX_SECS, BACKOFF_BASE_SECS * 2 ** attempt)))
+                attempt += 1
+                continue
+            except Exception:
+                self.on_error()
+                raise
+            self.on_success()
+            return result
+
+
+def get_scheduler(api, account=None):
+    """Get the scheduler for an API and account, creating on first use"""
+
+    key = (api, account or '')
+    with _schedulers_lock:
+        if key not in _schedulers:
+            name = f'{api}/{account}' if account else api
+            _schedulers[key] = RequestScheduler(name, DEFAULT_MAX_RATES.get(api, DEFAULT_MAX_RATE),
+                                                DEFAULT_BURSTS.get(api))
+        return _schedulers[key]
+
+
+def get_counters():
+    """Get counters for all schedulers, keyed by scheduler name"""
+
+    with _schedulers_lock:
+        schedulers = list(_schedulers.values())
+    counters = {}
+    for scheduler in schedulers:
+        quota_used = scheduler.get_quota_used()
+        with scheduler.lock:
+            counters[scheduler.name] = dict(scheduler.counters)
+        if quota_used is not None:
+            counters[scheduler.name]['quota_used'] = quota_used
+    return counters
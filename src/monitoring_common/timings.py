@@ -0,0 +1,188 @@
+"""Per-phase timing and API instrumentation for the monitoring scripts
+
+Phases, e.g. list_commands or aggregate, are timed with the phase() context
+manager, recording wall time, CPU time of the calling thread and the number
+of records handled. API calls are counted per operation with pages, records, bytes
+received and wall time by the aws_client backends and the GitHub client,
+and response caches count hits, misses and evictions.
+
+Counters are process wide and accumulate, so when accounts are collected
+in parallel the phase wall times add up to more than the run time. Phases
+may also overlap, e.g. invocations are aggregated while later pages are
+still being fetched, so the aggregate phase includes time spent waiting
+for pages, which also appears under the API calls.
+"""
+
+import contextlib
+import json
+import resource
+import threading
+import time
+
+from monitoring_common import cloudwatch, scheduler
+
+_lock = threading.Lock()
+_phases = {}
+_api_calls = {}
+_caches = {}
+_start = time.monotonic()
+_start_cpu = time.process_time()
+
+
+class PhaseTimer:
+    """Handle for a running phase, add the number of records processed"""
+
+    def __init__(self):
+        self.records = 0
+
+    def add_records(self, records):
+        """Count records processed in this phase"""
+
+        self.records += records
+
+
+@contextlib.contextmanager
+def phase(name):
+    """Time a block of code as the named phase"""
+
+    timer = PhaseTimer()
+    start = time.perf_counter()
+    start_cpu = time.thread_time()
+    try:
+        yield timer
+    finally:
+        wall_secs = time.perf_counter() - start
+        cpu_secs = time.thread_time() - start_cpu
+        with _lock:
+            counters = _phases.setdefault(name, {
+                'calls': 0, 'wall_secs': 0.0, 'cpu_secs': 0.0, 'records': 0})
+            counters['calls'] += 1
+            counters['wall_secs'] += wall_secs
+            counters['cpu_secs'] += cpu_secs
+            counters['records'] += timer.records
+
+
+def add_api_call(api, operation, wall_secs=0.0, bytes_received=0, pages=1, records=0):
+    """Count an API call, e.g. ('ssm', 'list-commands')"""
+
+    with _lock:
+        counters = _api_calls.setdefault(f'{api} {operation}', {
+            'calls': 0, 'pages': 0, 'records': 0, 'bytes': 0, 'wall_secs': 0.0})
+        counters['calls'] += 1
+        counters['pages'] += pages
+        counters['records'] += records
+        counters['bytes'] += bytes_received
+        counters['wall_secs'] += wall_secs
+
+
+def add_api_records(api, operation, records):
+    """Count records returned by an API call already counted, e.g. by a
+    paginator"""
+
+    with _lock:
+        counters = _api_calls.setdefault(f'{api} {operation}', {
+            'calls': 0, 'pages': 0, 'records': 0, 'bytes': 0, 'wall_secs': 0.0})
+        counters['records'] += records
+
+
+def get_cache_counters(name):
+    """Get the counters for the named cache, call with the lock held"""
+
+    return _caches.setdefault(name, {'hits': 0, 'misses': 0, 'evictions': 0})
+
+
+def add_cache_lookup(name, hit):
+    """Count a cache hit or miss"""
+
+    with _lock:
+        get_cache_counters(name)['hits' if hit else 'misses'] += 1
+
+
+def add_cache_evictions(name, evictions):
+    """Count entries evicted from a cache"""
+
+    with _lock:
+        get_cache_counters(name)['evictions'] += evictions
+
+
+def get_report():
+    """Get all counters as a dict, suitable for JSON"""
+
+    with _lock:
+        phases = {name: dict(counters) for name, counters in _phases.items()}
+        api_calls = {name: dict(counters) for name, counters in _api_calls.items()}
+        caches = {name: dict(counters) for name, counters in _caches.items()}
+    for counters in caches.values():
+        lookups = counters['hits'] + counters['misses']
+        counters['hit_rate'] = round(counters['hits'] / lookups, 3) if lookups else 0.0
+    for counters in list(phases.values()) + list(api_calls.values()):
+        for key in ('wall_secs', 'cpu_secs'):
+            if key in counters:
+                counters[key] = round(counters[key], 3)
+    return {
+        'wall_secs': round(time.monotonic() - _start, 3),
+        'cpu_secs': round(time.process_time() - _start_cpu, 3),
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'phases': phases,
+        'api_calls': api_calls,
+        'caches': caches,
+        'schedulers': scheduler.get_counters(),
+    }
+
+
+def write_report(filename, report=None):
+    """Write the report as JSON, '-' for stdout"""
+
+    text = json.dumps(report or get_report(), indent=1) + '\n'
+    if filename == '-':
+        print(text, end='')
+        return
+    with open(filename, 'w', encoding='utf-8') as f:
+        f.write(text)
+
+
+def report_to_metric_data(report, timestamp, script):
+    """Convert the report to CloudWatch metric data, dimensioned by script
+    name and phase or API operation"""
+
+    metric_data = [
+        cloudwatch.metric_datum('MonitorRunWallTime', report['wall_secs'], timestamp, {'Script': script}),
+        cloudwatch.metric_datum('MonitorRunCpuTime', report['cpu_secs'], timestamp, {'Script': script}),
+        cloudwatch.metric_datum('MonitorPeakRss', report['peak_rss_mb'], timestamp, {'Script': script}),
+    ]
+    for name, counters in report['phases'].items():
+        dimensions = {'Script': script, 'Phase': name}
+        metric_data += [
+            cloudwatch.metric_datum('MonitorPhaseWallTime', counters['wall_secs'], timestamp, dimensions),
+            cloudwatch.metric_datum('MonitorPhaseCpuTime', counters['cpu_secs'], timestamp, dimensions),
+            cloudwatch.metric_datum('MonitorPhaseRecords', counters['records'], timestamp, dimensions),
+        ]
+    for name, counters in report['api_calls'].items():
+        dimensions = {'Script': script, 'Api': name}
+        metric_data += [
+            cloudwatch.metric_datum('MonitorApiCalls', counters['calls'], timestamp, dimensions),
+            cloudwatch.metric_datum('MonitorApiPages', counters['pages'], timestamp, dimensions),
+            cloudwatch.metric_datum('MonitorApiRecords', counters['records'], timestamp, dimensions),
+            cloudwatch.metric_datum('MonitorApiBytes', counters['bytes'], timestamp, dimensions),
+            cloudwatch.metric_datum('MonitorApiWallTime', counters['wall_secs'], timestamp, dimensions),
+        ]
+    for name, counters in report['schedulers'].items():
+        dimensions = {'Script': script, 'Scheduler': name}
+        metric_data += [
+            cloudwatch.metric_datum('MonitorApiRetries', counters['retries'], timestamp, dimensions),
+            cloudwatch.metric_datum('MonitorApiThrottles', counters['throttles'], timestamp, dimensions),
+        ]
+        if 'quota_used' in counters:
+            metric_data += [
+                cloudwatch.metric_datum('MonitorApiQuotaUsed', counters['quota_used'], timestamp, dimensions),
+                cloudwatch.metric_datum('MonitorApiQuotaRemaining', counters['quota_remaining'],
+                                        timestamp, dimensions),
+            ]
+    for name, counters in report['caches'].items():
+        dimensions = {'Script': script, 'Cache': name}
+        metric_data += [
+            cloudwatch.metric_datum('MonitorCacheHits', counters['hits'], timestamp, dimensions),
+            cloudwatch.metric_datum('MonitorCacheMisses', counters['misses'], timestamp, dimensions),
+            cloudwatch.metric_datum('MonitorCacheEvictions', counters['evictions'], timestamp, dimensions),
+        ]
+    return metric_data
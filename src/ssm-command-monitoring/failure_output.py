@@ -0,0 +1,125 @@
+"""Failure output enrichment for ssm-command-monitor.py
+
+Failed, non-ignored invocations are otherwise only reported by ID, so the
+plugin output has to be fetched by hand. Here get-command-invocation is
+called for each failure by a bounded pool of workers, and the stdout and
+stderr kept, truncated to the last max_chars. Finished invocations don't
+change, so if a state store is given the output is cached there and repeat
+failures across runs cost no API calls.
+
+Enrichment is best effort and must never hold up the metrics, so it runs
+after them and stops at a deadline. Workers are daemon threads, so calls
+still in flight at the deadline are abandoned rather than waited for, and
+their failures are reported without output.
+"""
+
+import os
+import queue
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from monitoring_common import aggregation  # pylint: disable=wrong-import-position
+
+DEFAULT_BUDGET_SECS = 30
+DEFAULT_MAX_CHARS = 4000
+DEFAULT_MAX_WORKERS = 4
+
+OUTPUT_FIELDS = ('ResponseCode', 'StatusDetails', 'StandardOutputContent', 'StandardErrorContent')
+
+
+def truncate(text, max_chars):
+    """Keep the last max_chars of text, where errors usually are. Returns
+    (text, truncated)"""
+
+    if len(text) <= max_chars:
+        return text, False
+    return text[-max_chars:], True
+
+
+def get_output(response, max_chars):
+    """Get the fields kept from a get-command-invocation response"""
+
+    output = {field: response.get(field) for field in OUTPUT_FIELDS}
+    output['Truncated'] = False
+    for field in ('StandardOutputContent', 'StandardErrorContent'):
+        output[field], truncated = truncate(output[field] or '', max_chars)
+        output['Truncated'] = output['Truncated'] or truncated
+    return output
+
+
+class FailureOutputEnricher:
+    """Fetch output of failed invocations. get_invocation(command_id,
+    instance_id) returns the get-command-invocation response"""
+
+    def __init__(self, get_invocation, state=None, max_workers=DEFAULT_MAX_WORKERS,
+                 max_chars=DEFAULT_MAX_CHARS):
+        self.get_invocation = get_invocation
+        self.state = state
+        self.max_workers = max_workers
+        self.max_chars = max_chars
+
+    def fetch(self, keys, deadline):
+        """Fetch output for a list of (command_id, instance_id) until the
+        time.monotonic() deadline. Returns a dict of key to ('api', output) or
+        ('error', message), keys not fetched in time are left out"""
+
+        tasks = queue.Queue()
+        for key in keys:
+            tasks.put(key)
+        results = {}
+        lock = threading.Lock()
+
+        def worker():
+            while time.monotonic() < deadline:
+                try:
+                    key = tasks.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    result = ('api', get_output(self.get_invocation(*key), self.max_chars))
+                except Exception as e:  # pylint: disable=broad-exception-caught
+                    result = ('error', str(e).splitlines()[0] if str(e) else type(e).__name__)
+                with lock:
+                    results[key] = result
+
+        threads = [threading.Thread(target=worker, daemon=True)
+                   for _ in range(min(self.max_workers, len(keys)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(max(0, deadline - time.monotonic()))
+        with lock:
+            return dict(results)
+
+    def enrich(self, failures, deadline):
+        """Get a record per failed invocation, in the order given, with its
+        output and Source: cache, api, error or timeout"""
+
+        keys = list(dict.fromkeys((failure['CommandId'], failure['InstanceId']) for failure in failures))
+        cached = self.state.get_command_outputs(keys) if self.state else {}
+        fetched = self.fetch([key for key in keys if key not in cached], deadline)
+        if self.state:
+            requested = {(failure['CommandId'], failure['InstanceId']): failure['RequestedDateTime']
+                         for failure in failures}
+            self.state.update_command_outputs({
+                key: (aggregation.parse_timestamp(requested[key]).timestamp(), output)
+                for key, (source, output) in fetched.items() if source == 'api'
+            })
+
+        records = []
+        for failure in failures:
+            key = (failure['CommandId'], failure['InstanceId'])
+            record = {field: failure.get(field) for field in
+                      ('CommandId', 'InstanceId', 'DocumentName', 'Status', 'Comment', 'RequestedDateTime')}
+            if key in cached:
+                record.update(cached[key], Source='cache')
+            elif key in fetched and fetched[key][0] == 'api':
+                record.update(fetched[key][1], Source='api')
+            elif key in fetched:
+                record.update(Source='error', Error=fetched[key][1])
+            else:
+                record.update(Source='timeout')
+            records.append(record)
+        return records
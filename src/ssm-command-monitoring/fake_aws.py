@@ -0,0 +1,521 @@
+"""Synthetic SSM data and a local fake SSM/EC2 endpoint for benchmarking
+
+SyntheticData generates instance tags, associations, commands and command
+invocations with a realistic mix of documents, failures and ignorable
+results. Records are derived from their index rather than stored, so a
+million invocations need no more memory than ten thousand, and the same
+parameters always give the same data.
+
+FakeAwsServer serves that data over the AWS SSM JSON and EC2 query
+protocols, so ssm-command-monitor.py can be pointed at it with
+--endpoint-url using either backend. Latency and page size can be set to
+mimic the real APIs. Run standalone with e.g.
+
+  python3 fake_aws.py --invocations 100000 --instances 5000 --port 8765
+  AWS_ACCESS_KEY_ID=fake AWS_SECRET_ACCESS_KEY=fake AWS_DEFAULT_REGION=eu-west-2 \\
+    python3 ssm-command-monitor.py -i 3600 --endpoint-url http://127.0.0.1:8765
+
+Timestamps are returned as epoch seconds like the real APIs, so aws cli v1
+needs cli_timestamp_format = iso8601 in its config to match v2 output.
+GET /stats returns request and record counts per API operation.
+"""
+
+import argparse
+import collections
+import datetime
+import http.server
+import json
+import random
+import sys
+import threading
+import time
+import urllib.parse
+from xml.sax.saxutils import escape
+
+DEFAULT_INVOCATIONS = 10000
+DEFAULT_INSTANCES = 5000
+DEFAULT_FANOUT = 20
+DEFAULT_SPAN_SECS = 3600
+DEFAULT_PAGE_SIZE = 50
+DESCRIBE_TAGS_PAGE_SIZE = 1000
+ASSOCIATIONS = 50
+TERMINATED_INSTANCE_FRACTION = 0.02
+
+APPLICATIONS = [
+    'nomis', 'oasys', 'delius-core', 'delius-mis', 'nomis-combined-reporting',
+    'corporate-staff-rostering', 'hmpps-oem', 'oasys-national-reporting',
+]
+ENVIRONMENTS = ['development', 'test', 'preproduction', 'production']
+# server-type, os-type
+SERVER_TYPES = [
+    ('nomis-db', 'Linux'),
+    ('nomis-web', 'Linux'),
+    ('NomisClient', 'Windows'),
+    ('NartClient', 'Windows'),
+    ('onr-boe', 'Linux'),
+    ('onr-web', 'Linux'),
+    ('oasys-db', 'Linux'),
+    ('csr-app', 'Windows'),
+    ('hmpps-oem', 'Linux'),
+]
+# name, weight, run by association
+DOCUMENTS = [
+    ('AWS-RunShellScript', 30, False),
+    ('AWS-RunPowerShellScript', 10, False),
+    ('AWS-RunPatchBaseline', 15, True),
+    ('AWS-UpdateSSMAgent', 10, True),
+    ('AmazonInspector2-InvokeInspectorSsmPluginLinux', 15, True),
+    ('AmazonInspector2-InvokeInspectorSsmPlugin', 5, True),
+    ('ec2-configuration-management-linux', 10, True),
+    ('ec2-configuration-management-windows', 5, True),
+]
+SHELL_SCRIPT_COMMENTS = [
+    '',
+    'ansible-playbook site.yml',
+    'systemctl stop sapbobj',
+    'systemctl start sapbobj',
+    'bip_control.sh pipeline start',
+]
+# cumulative fraction, status
+STATUSES = [
+    (0.900, 'Success'),
+    (0.960, 'Failed'),
+    (0.970, 'TimedOut'),
+    (0.985, 'InProgress'),
+    (0.995, 'Cancelled'),
+    (1.000, 'DeliveryTimedOut'),
+]
+
+
+def fraction(i, salt):
+    """Deterministic pseudo random number in [0, 1) for record i"""
+
+    x = (i * 0x9e3779b1 + salt * 0x85ebca77) & 0xffffffff
+    x ^= x >> 15
+    x = (x * 0x2c1b3c6d) & 0xffffffff
+    x ^= x >> 12
+    x = (x * 0x297a2d39) & 0xffffffff
+    x ^= x >> 15
+    return x / 4294967296
+
+
+def uuid(i, salt):
+    """Deterministic UUID formatted ID, as used for CommandId and AssociationId"""
+
+    return f'{i:08x}-{salt:04x}-4000-8000-{i:012x}'
+
+
+def cli_record(record):
+    """Convert a record's epoch RequestedDateTime to ISO 8601, as the aws cli
+    and aws_client backends return it"""
+
+    record = dict(record)
+    record['RequestedDateTime'] = datetime.datetime.fromtimestamp(
+        record['RequestedDateTime'], datetime.timezone.utc).isoformat()
+    return record
+
+
+class SyntheticData:
+    """Synthetic SSM commands and invocations, newest first. Each command is
+    run on fanout instances and commands are spread evenly over span_secs
+    before now"""
+
+    def __init__(self, invocations=DEFAULT_INVOCATIONS, instances=DEFAULT_INSTANCES,
+                 fanout=DEFAULT_FANOUT, span_secs=DEFAULT_SPAN_SECS, now=None, seed=0):
+        self.num_invocations = invocations
+        self.num_instances = instances
+        self.fanout = min(fanout, instances)
+        self.num_commands = -(-invocations // self.fanout)
+        self.span_secs = span_secs
+        self.now = time.time() if now is None else now
+        self.seed = seed
+        rng = random.Random(seed)
+        self.instance_ids = [f'i-{rng.getrandbits(68):017x}' for _ in range(instances)]
+        self.instance_tags = {}
+        for instance_id in self.instance_ids:
+            if rng.random() < TERMINATED_INSTANCE_FRACTION:
+                continue
+            server_type, os_type = rng.choice(SERVER_TYPES)
+            environment_name = f'{rng.choice(APPLICATIONS)}-{rng.choice(ENVIRONMENTS)}'
+            self.instance_tags[instance_id] = {
+                'Name': f'{server_type}-{instance_id[-4:]}',
+                'environment-name': environment_name,
+                'server-type': server_type,
+                'os-type': os_type,
+            }
+        self.association_ids = [uuid(i, seed) for i in range(ASSOCIATIONS)]
+        self.documents = []
+        for name, weight, by_association in DOCUMENTS:
+            self.documents += [(name, by_association)] * weight
+
+    def requested(self, command_index):
+        """Epoch seconds a command was requested"""
+
+        return self.now - self.span_secs * command_index / self.num_commands
+
+    def commands_after(self, timestamp):
+        """Number of commands requested on or after epoch timestamp"""
+
+        if timestamp > self.now:
+            return 0
+        return min(self.num_commands,
+                   int((self.now - timestamp) * self.num_commands / self.span_secs) + 1)
+
+    def invocations_after(self, timestamp):
+        """Number of invocations requested on or after epoch timestamp"""
+
+        return min(self.num_invocations, self.commands_after(timestamp) * self.fanout)
+
+    def command_index(self, command_id):
+        """Get index of command from CommandId, or None if unknown"""
+
+        try:
+            index = int(command_id[:8], 16)
+        except ValueError:
+            return None
+        if index >= self.num_commands or uuid(index, self.seed) != command_id:
+            return None
+        return index
+
+    def command(self, j):
+        """Get command j"""
+
+        document_name, by_association = self.documents[int(fraction(j, 1) * len(self.documents))]
+        comment = ''
+        if by_association:
+            association_id = self.association_ids[int(fraction(j, 2) * ASSOCIATIONS)]
+            r = fraction(j, 3)
+            if r < 0.02:
+                association_id = None
+            elif r < 0.05:
+                # association since deleted
+                association_id = uuid(ASSOCIATIONS + j, self.seed)
+            comment = f'{association_id}:{uuid(j, 0xa55)}' if association_id else 'run manually'
+        elif document_name == 'AWS-RunShellScript':
+            comment = SHELL_SCRIPT_COMMENTS[int(fraction(j, 4) * len(SHELL_SCRIPT_COMMENTS))]
+        return {
+            'CommandId': uuid(j, self.seed),
+            'DocumentName': document_name,
+            'DocumentVersion': '$DEFAULT',
+            'Comment': comment,
+            'RequestedDateTime': self.requested(j),
+            'Status': 'Success',
+            'TargetCount': self.fanout,
+        }
+
+    def invocation(self, i, command=None):
+        """Get invocation i, command may be given if already known"""
+
+        j = i // self.fanout
+        if command is None:
+            command = self.command(j)
+        instance_id = self.instance_ids[(j * 7919 + i % self.fanout) % self.num_instances]
+        r = fraction(i, 5)
+        for cumulative, status in STATUSES:
+            if r < cumulative:
+                break
+        return {
+            'CommandId': command['CommandId'],
+            'InstanceId': instance_id,
+            'InstanceName': '',
+            'Comment': command['Comment'],
+            'DocumentName': command['DocumentName'],
+            'DocumentVersion': command['DocumentVersion'],
+            'RequestedDateTime': command['RequestedDateTime'],
+            'Status': status,
+            'StatusDetails': status,
+            'StandardOutputUrl': '',
+            'StandardErrorUrl': '',
+            'CommandPlugins': [],
+        }
+
+    def command_invocation_output(self, command_id, instance_id):
+        """Get an invocation with its output, as GetCommandInvocation, or
+        None if not found"""
+
+        j = self.command_index(command_id)
+        if j is None:
+            return None
+        command = self.command(j)
+        for i in range(j * self.fanout, min(self.num_invocations, (j + 1) * self.fanout)):
+            invocation = self.invocation(i, command)
+            if invocation['InstanceId'] != instance_id:
+                continue
+            success = invocation['Status'] == 'Success'
+            # output size varies a lot, some are larger than the monitor keeps
+            lines = int(fraction(i, 6) ** 3 * 500) + 1
+            stdout = ''.join(f'{command["DocumentName"]} step {n}: ok\n' for n in range(lines))
+            stderr = '' if success else f'ERROR: step {lines} failed with exit code 1\n'
+            return {
+                'CommandId': command_id,
+                'InstanceId': instance_id,
+                'Comment': command['Comment'],
+                'DocumentName': command['DocumentName'],
+                'DocumentVersion': command['DocumentVersion'],
+                'PluginName': 'aws:runShellScript',
+                'ResponseCode': 0 if success else 1,
+                'Status': invocation['Status'],
+                'StatusDetails': invocation['StatusDetails'],
+                'StandardOutputContent': stdout[-24000:],
+                'StandardErrorContent': stderr,
+            }
+        return None
+
+    def commands(self, start=0, stop=None):
+        """Yield commands by index"""
+
+        for j in range(start, self.num_commands if stop is None else stop):
+            yield self.command(j)
+
+    def invocations(self, start=0, stop=None):
+        """Yield invocations by index"""
+
+        command = None
+        for i in range(start, self.num_invocations if stop is None else stop):
+            if command is None or i % self.fanout == 0:
+                command = self.command(i // self.fanout)
+            yield self.invocation(i, command)
+
+    def associations(self):
+        """Get associations"""
+
+        return [{
+            'AssociationId': association_id,
+            'Name': DOCUMENTS[i % len(DOCUMENTS)][0],
+            'AssociationVersion': '1',
+        } for i, association_id in enumerate(self.association_ids)]
+
+    def tags(self, instance_ids=None):
+        """Get EC2 tags in describe-tags format, optionally only for the given
+        instances"""
+
+        if instance_ids is None:
+            instance_ids = self.instance_ids
+        tags = []
+        for instance_id in instance_ids:
+            for key, value in self.instance_tags.get(instance_id, {}).items():
+                tags.append({
+                    'Key': key,
+                    'ResourceId': instance_id,
+                    'ResourceType': 'instance',
+                    'Value': value,
+                })
+        return tags
+
+
+def parse_invoked_after(params):
+    """Get InvokedAfter filter as epoch seconds, or None"""
+
+    for api_filter in params.get('Filters', []):
+        if api_filter['key'] == 'InvokedAfter':
+            return datetime.datetime.fromisoformat(
+                api_filter['value'].replace('Z', '+00:00')).timestamp()
+    return None
+
+
+class FakeAwsServer(http.server.ThreadingHTTPServer):
+    """Serve SyntheticData as the SSM and EC2 APIs"""
+
+    daemon_threads = True
+
+    def __init__(self, data, port=0, latency=0, page_size=DEFAULT_PAGE_SIZE):
+        super().__init__(('127.0.0.1', port), FakeAwsHandler)
+        self.data = data
+        self.latency = latency
+        self.page_size = page_size
+        self.stats = collections.Counter()
+        self.stats_lock = threading.Lock()
+
+    @property
+    def url(self):
+        """Endpoint URL to pass to the monitor"""
+
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    def count(self, operation, records):
+        """Count a request and the records returned"""
+
+        with self.stats_lock:
+            self.stats[operation] += 1
+            self.stats[operation + '.records'] += records
+
+    def get_stats(self):
+        """Get a copy of the request counters"""
+
+        with self.stats_lock:
+            return dict(self.stats)
+
+    def page(self, params, total, max_page_size):
+        """Get the start and stop index of the requested page, and the next
+        token if there are more"""
+
+        start = int(params.get('NextToken') or 0)
+        page_size = min(int(params.get('MaxResults') or max_page_size), max_page_size)
+        stop = min(total, start + page_size)
+        return start, stop, str(stop) if stop < total else None
+
+    def list_command_invocations(self, params):
+        """ListCommandInvocations, InvokedAfter and CommandId are supported"""
+
+        data = self.data
+        if params.get('CommandId'):
+            j = data.command_index(params['CommandId'])
+            first = 0 if j is None else j * data.fanout
+            total = 0 if j is None else min(data.num_invocations, first + data.fanout) - first
+        else:
+            invoked_after = parse_invoked_after(params)
+            first = 0
+            total = data.num_invocations if invoked_after is None else data.invocations_after(invoked_after)
+        start, stop, next_token = self.page(params, total, self.page_size)
+        response = {'CommandInvocations': list(data.invocations(first + start, first + stop))}
+        return response, next_token
+
+    def list_commands(self, params):
+        """ListCommands, InvokedAfter is supported"""
+
+        data = self.data
+        invoked_after = parse_invoked_after(params)
+        total = data.num_commands if invoked_after is None else data.commands_after(invoked_after)
+        start, stop, next_token = self.page(params, total, self.page_size)
+        return {'Commands': list(data.commands(start, stop))}, next_token
+
+    def get_command_invocation(self, params):
+        """GetCommandInvocation, returns None if not found"""
+
+        return self.data.command_invocation_output(params.get('CommandId'), params.get('InstanceId')), None
+
+    def list_associations(self, params):
+        """ListAssociations"""
+
+        associations = self.data.associations()
+        start, stop, next_token = self.page(params, len(associations), self.page_size)
+        return {'Associations': associations[start:stop]}, next_token
+
+    def describe_tags(self, params):
+        """DescribeTags, resource-id filter is supported. Returns XML"""
+
+        instance_ids = None
+        for name, values in params.items():
+            if name.startswith('Filter.') and name.endswith('.Name') and values[0] == 'resource-id':
+                prefix = name[:-len('Name')] + 'Value.'
+                instance_ids = [value[0] for key, value in params.items() if key.startswith(prefix)]
+        tags = self.data.tags(instance_ids)
+        page_params = {key: values[0] for key, values in params.items()}
+        start, stop, next_token = self.page(page_params, len(tags), DESCRIBE_TAGS_PAGE_SIZE)
+        items = ''.join(
+            f'<item><resourceId>{tag["ResourceId"]}</resourceId>'
+            f'<resourceType>{tag["ResourceType"]}</resourceType>'
+            f'<key>{escape(tag["Key"])}</key><value>{escape(tag["Value"])}</value></item>'
+            for tag in tags[start:stop])
+        token = f'<nextToken>{next_token}</nextToken>' if next_token else ''
+        body = ('<?xml version="1.0" encoding="UTF-8"?>'
+                '<DescribeTagsResponse xmlns="http://ec2.amazonaws.com/doc/2016-11-15/">'
+                f'<requestId>fake</requestId><tagSet>{items}</tagSet>{token}'
+                '</DescribeTagsResponse>')
+        return body, stop - start
+
+
+class FakeAwsHandler(http.server.BaseHTTPRequestHandler):
+    """Request handler for FakeAwsServer"""
+
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately, avoid delayed ACK stalls
+    disable_nagle_algorithm = True
+
+    SSM_OPERATIONS = {
+        'ListCommandInvocations': ('list_command_invocations', 'CommandInvocations'),
+        'ListCommands': ('list_commands', 'Commands'),
+        'ListAssociations': ('list_associations', 'Associations'),
+        'GetCommandInvocation': ('get_command_invocation', None),
+    }
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+    def send_body(self, status, content_type, body):
+        """Send a complete response"""
+
+        data = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """Request counters"""
+
+        self.send_body(200, 'application/json', json.dumps(self.server.get_stats()))
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        """SSM or EC2 API request"""
+
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        target = self.headers.get('X-Amz-Target')
+        if target:
+            operation = target.split('.')[-1]
+            if operation not in self.SSM_OPERATIONS:
+                error = {'__type': 'InvalidAction', 'message': f'{operation} not supported'}
+                self.send_body(400, 'application/x-amz-json-1.1', json.dumps(error))
+                return
+            method, result_key = self.SSM_OPERATIONS[operation]
+            response, next_token = getattr(self.server, method)(json.loads(body or b'{}'))
+            if response is None:
+                error = {'__type': 'InvocationDoesNotExist', 'message': 'invocation not found'}
+                self.send_body(400, 'application/x-amz-json-1.1', json.dumps(error))
+                return
+            if next_token:
+                response['NextToken'] = next_token
+            self.server.count(operation, len(response[result_key]) if result_key else 1)
+            self.send_body(200, 'application/x-amz-json-1.1', json.dumps(response))
+            return
+        params = urllib.parse.parse_qs(body.decode('utf-8'))
+        if params.get('Action') != ['DescribeTags']:
+            self.send_body(400, 'text/xml', '<Response><Errors><Error><Code>InvalidAction</Code>'
+                           '</Error></Errors></Response>')
+            return
+        response, records = self.server.describe_tags(params)
+        self.server.count('DescribeTags', records)
+        self.send_body(200, 'text/xml', response)
+
+
+def main():
+    """Main function"""
+
+    parser = argparse.ArgumentParser(
+        description='Serve synthetic SSM command invocations as a fake SSM/EC2 endpoint')
+    parser.add_argument('--invocations', type=int, default=DEFAULT_INVOCATIONS,
+                        help='Number of command invocations')
+    parser.add_argument('--instances', type=int, default=DEFAULT_INSTANCES,
+                        help='Number of EC2 instances')
+    parser.add_argument('--fanout', type=int, default=DEFAULT_FANOUT,
+                        help='Number of instances each command is run on')
+    parser.add_argument('--span', type=int, default=DEFAULT_SPAN_SECS,
+                        help='Spread commands over this many seconds before now')
+    parser.add_argument('--now', type=float,
+                        help='Epoch seconds of the newest command, default current time')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Random seed for instance tags and IDs')
+    parser.add_argument('--port', type=int, default=0,
+                        help='Port to listen on, default any free port')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='Seconds to delay each response by')
+    parser.add_argument('--page-size', type=int, default=DEFAULT_PAGE_SIZE,
+                        help='Max records per SSM API page')
+    args = parser.parse_args()
+
+    data = SyntheticData(args.invocations, args.instances, args.fanout,
+                         args.span, args.now, args.seed)
+    server = FakeAwsServer(data, args.port, args.latency, args.page_size)
+    # first line of output is read by ssm-command-benchmark.py
+    print(f'Listening on {server.url}', flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        sys.exit(0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+"""Compiled SSM command failure ignore rules for ssm-command-monitor.py
+
+Rule tables are compiled once into per document lookups: comment sets,
+precompiled tag regexes and the tag keys each document's rules depend on.
+Tag rule decisions are memoised on (document, relevant tag values) since
+many invocations share a relatively small number of instances.
+
+Rules can also be loaded from a JSON or YAML file, e.g.
+
+  {
+    "ignore_failures_without_association": ["AWS-UpdateSSMAgent"],
+    "ignore_failures_by_tags": {
+      "AWS-RunPatchBaseline": [{"environment-name": ".*-development$"}]
+    },
+    "ignore_failures_by_comment": {
+      "AWS-RunShellScript": ["systemctl stop sapbobj"]
+    }
+  }
+
+Any table missing from the file keeps its default value.
+"""
+
+import json
+import re
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+
+class IgnoreRules:
+    """Indexed matcher for the IGNORE_FAILURES_* rule tables"""
+
+    def __init__(self, without_association, by_tags, by_comment):
+        self.without_association = frozenset(without_association)
+        self.by_comment = {
+            document_name: frozenset(comments)
+            for document_name, comments in by_comment.items()
+        }
+        self.by_tags = {}
+        self.tag_keys = {}
+        for document_name, tag_lists in by_tags.items():
+            self.by_tags[document_name] = [
+                [(tag, re.compile(pattern)) for tag, pattern in tag_list.items()]
+                for tag_list in tag_lists
+            ]
+            self.tag_keys[document_name] = tuple(
+                sorted({tag for tag_list in tag_lists for tag in tag_list}))
+        self.decisions = {}
+
+    def is_taglist_match(self, instance_tags, match_tags):
+        """Check if an instance has tag values matching all compiled patterns"""
+
+        for tag, pattern in match_tags:
+            value = instance_tags.get(tag)
+            if value is None or not pattern.match(value):
+                return False
+        return True
+
+    def is_status_ignorable(self, document_name, status, comment, instance_tags):
+        """Check whether to skip over a failed SSM doc"""
+
+        if status != 'Failed':
+            return False
+
+        comments = self.by_comment.get(document_name)
+        if comments is not None and comment in comments:
+            return True
+
+        tag_lists = self.by_tags.get(document_name)
+        if tag_lists is None:
+            return False
+
+        key = (document_name,
+               tuple(instance_tags.get(tag) for tag in self.tag_keys[document_name]))
+        decision = self.decisions.get(key)
+        if decision is None:
+            decision = any(
+                self.is_taglist_match(instance_tags, tag_list)
+                for tag_list in tag_lists)
+            self.decisions[key] = decision
+        return decision
+
+
+def load_ignore_rules(filename, without_association, by_tags, by_comment):
+    """Load rules from a JSON or YAML file, using the given defaults for
+    any table not defined in the file"""
+
+    with open(filename, encoding='utf-8') as f:
+        if filename.endswith(('.yaml', '.yml')):
+            if yaml is None:
+                raise ValueError(f'{filename}: PyYAML is not installed, use JSON instead')
+            rules = yaml.safe_load(f) or {}
+        else:
+            rules = json.load(f)
+    return IgnoreRules(
+        rules.get('ignore_failures_without_association', without_association),
+        rules.get('ignore_failures_by_tags', by_tags),
+        rules.get('ignore_failures_by_comment', by_comment))
@@ -0,0 +1,103 @@
+"""Cardinality capped per-instance metrics for ssm-command-monitor.py
+
+Emitting a series per instance for every instance is slow and costly, so
+an InstanceId series is only emitted for instances that stand out: the top
+N by failures and any at or over a failure threshold, capped at max_series.
+All other instances are folded into a single InstanceId=other series.
+
+Instances can also be grouped by tag values, e.g. environment-name, with a
+series per value. Again only the max_series values with the most failures
+are kept and the rest folded into other.
+
+So there are at most (1 + number of tags) * (max_series + 1) series per
+window, however many instances there are.
+"""
+
+DEFAULT_MAX_SERIES = 20
+OTHER = 'other'
+UNKNOWN = 'unknown'
+STATUSES = ('success', 'failed', 'ignore')
+
+
+def add_counts(totals, counts):
+    """Add success/failed/ignore counts into totals"""
+
+    for status in STATUSES:
+        totals[status] += counts[status]
+
+
+def failures_order(item):
+    """Sort key for (name, counts), most failures first then by name"""
+
+    name, counts = item
+    return (-counts['failed'], -sum(counts[status] for status in STATUSES), name)
+
+
+class InstanceMetricsPolicy:
+    """Select which per-instance and per-tag series to emit"""
+
+    def __init__(self, top=0, threshold=None, tags=(), max_series=DEFAULT_MAX_SERIES):
+        self.top = top
+        self.threshold = threshold
+        self.tags = tuple(tags)
+        self.max_series = max_series
+
+    def select_instances(self, instances):
+        """Get IDs of the instances to emit series for, given a dict of
+        instance_id to counts"""
+
+        ordered = sorted(instances.items(), key=failures_order)
+        selected = []
+        for i, (instance_id, counts) in enumerate(ordered):
+            if len(selected) >= self.max_series or counts['failed'] == 0:
+                break
+            if i < self.top or (self.threshold is not None and counts['failed'] >= self.threshold):
+                selected.append(instance_id)
+        return selected
+
+    def fold(self, dimension, groups):
+        """Get series for the largest groups, folding the rest into other"""
+
+        ordered = sorted(groups.items(), key=failures_order)
+        series = [({dimension: name}, counts) for name, counts in ordered[:self.max_series]]
+        if len(ordered) > self.max_series:
+            other = dict.fromkeys(STATUSES, 0)
+            for _, counts in ordered[self.max_series:]:
+                add_counts(other, counts)
+            series.append(({dimension: OTHER}, other))
+        return series
+
+    def get_series(self, commands_summary, instance_tags):
+        """Get a list of (dimensions, counts) series from SSM command stats,
+        instance_tags is a dict of instance_id to tags"""
+
+        instances = {
+            instance_id: commands['all']
+            for instance_id, commands in commands_summary.items()
+            if instance_id != 'all'
+        }
+        if not instances:
+            return []
+
+        series = []
+        if self.top or self.threshold is not None:
+            selected = self.select_instances(instances)
+            series += [({'InstanceId': instance_id}, instances[instance_id])
+                       for instance_id in selected]
+            if len(selected) < len(instances):
+                other = dict.fromkeys(STATUSES, 0)
+                selected = set(selected)
+                for instance_id, counts in instances.items():
+                    if instance_id not in selected:
+                        add_counts(other, counts)
+                series.append(({'InstanceId': OTHER}, other))
+
+        for tag in self.tags:
+            groups = {}
+            for instance_id, counts in instances.items():
+                value = instance_tags.get(instance_id, {}).get(tag) or UNKNOWN
+                if value not in groups:
+                    groups[value] = dict.fromkeys(STATUSES, 0)
+                add_counts(groups[value], counts)
+            series += self.fold(tag, groups)
+        return series
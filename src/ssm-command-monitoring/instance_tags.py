@@ -0,0 +1,96 @@
+"""Targeted EC2 instance tag resolution for ssm-command-monitor.py
+
+Rather than downloading every tag in the account, tags are only resolved for
+instances seen in command invocations. Invocations are processed in chunks,
+and any instance IDs not already known are looked up in batches. If a state
+store is given, resolved tags are cached there for a TTL so subsequent runs
+only need to look up new instances. Instances without tags are cached for a
+much shorter TTL, as a newly launched instance may not be tagged yet.
+
+The invocations may be streamed from the same state store, so newly resolved
+tags are only written once they have all been passed through. Writing while
+its read cursor is open fails with "database is locked" if another account's
+thread has written to the file in the meantime.
+"""
+
+import time
+
+DESCRIBE_TAGS_MAX_IDS = 200
+RESOLVE_CHUNK_SIZE = 1000
+TAGS_CACHE_TTL_SECS = 21600
+NOT_FOUND_CACHE_TTL_SECS = 300
+
+
+class InstanceTagResolver:
+    """Lazily resolve instance tags. tags_dict is filled in as invocations are
+    passed through resolve(), instances that don't exist are left out. A
+    dict may be given to collect the tags in"""
+
+    def __init__(self, describe_tags, state=None, ttl=TAGS_CACHE_TTL_SECS, tags_dict=None,
+                 not_found_ttl=NOT_FOUND_CACHE_TTL_SECS):
+        self.describe_tags = describe_tags
+        self.state = state
+        self.ttl = ttl
+        self.not_found_ttl = min(ttl, not_found_ttl)
+        self.tags_dict = {} if tags_dict is None else tags_dict
+        self.not_found = set()
+        # (resolved, updated) not yet written to the state store
+        self.unsaved = []
+
+    def is_known(self, instance_id):
+        """Check if instance has already been resolved"""
+
+        return instance_id in self.tags_dict or instance_id in self.not_found
+
+    def add(self, instance_tags):
+        """Add resolved tags, a dict of instance_id to tags or None if not found"""
+
+        for instance_id, tags in instance_tags.items():
+            if tags is None:
+                self.not_found.add(instance_id)
+            else:
+                self.tags_dict[instance_id] = tags
+
+    def resolve_instances(self, instance_ids):
+        """Resolve tags for the given instances, from cache if possible"""
+
+        instance_ids = [
+            instance_id for instance_id in dict.fromkeys(instance_ids)
+            if not self.is_known(instance_id)
+        ]
+        if not instance_ids:
+            return
+        now = time.time()
+        if self.state:
+            cached = self.state.get_instance_tags(instance_ids, now - self.ttl, now - self.not_found_ttl)
+            self.add(cached)
+            instance_ids = [instance_id for instance_id in instance_ids if instance_id not in cached]
+        for i in range(0, len(instance_ids), DESCRIBE_TAGS_MAX_IDS):
+            batch = instance_ids[i:i + DESCRIBE_TAGS_MAX_IDS]
+            found = self.describe_tags(batch)
+            resolved = {instance_id: found.get(instance_id) for instance_id in batch}
+            self.add(resolved)
+            if self.state:
+                self.unsaved.append((resolved, now))
+
+    def save(self):
+        """Write newly resolved tags to the state store"""
+
+        for resolved, updated in self.unsaved:
+            self.state.update_instance_tags(resolved, updated)
+        self.unsaved = []
+
+    def resolve(self, command_invocations, chunk_size=RESOLVE_CHUNK_SIZE):
+        """Pass through command invocations, resolving tags for each chunk
+        before it is yielded. Newly resolved tags are saved at the end"""
+
+        chunk = []
+        for invocation in command_invocations:
+            chunk.append(invocation)
+            if len(chunk) >= chunk_size:
+                self.resolve_instances(record['InstanceId'] for record in chunk)
+                yield from chunk
+                chunk = []
+        self.resolve_instances(record['InstanceId'] for record in chunk)
+        yield from chunk
+        self.save()
@@ -0,0 +1,374 @@
+"""Benchmark ssm-command-monitor.py against synthetic data
+
+For each size a fake SSM/EC2 endpoint is started (see fake_aws.py) and the
+benchmark phases are run in a separate process, so peak RSS is measured per
+size. Phases:
+
+  fetch       get_account_commands_summary() against the fake endpoint
+  fetch_default_rate
+              as fetch with the monitor's default client side rate limits,
+              whatever --max-rate, in a process of its own
+  state_cold  as fetch with an empty --state file
+  state_warm  as fetch again with the now populated --state file
+  generate    generate the synthetic invocations in-process
+  summary     get_commands_summary() over the generated invocations, this
+              includes the generate time
+  aggregate   as summary over invocations generated up front, so only
+              get_commands_summary() is timed, but they are all in memory
+  ignore_rules
+              IgnoreRules.is_status_ignorable() alone over the failed
+              invocations of instances with tags, with the default rules
+              and an empty memo. 1e6 / records_per_sec is microseconds per
+              invocation
+
+Peak RSS is the process high water mark at the end of each phase, so is
+only specific to a phase if it is larger than all the phases before it.
+
+Results are appended to a JSON Lines file and compared with the previous
+result for the same parameters, flagging throughput or peak RSS regressions.
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+import fake_aws
+from ignore_rules import IgnoreRules
+import ssm_state
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from monitoring_common import aws_client, benchmark, scheduler  # pylint: disable=wrong-import-position
+
+DEFAULT_SIZES = [10000, 100000]
+DEFAULT_RESULTS_FILE = 'ssm-command-benchmark.jsonl'
+PHASES = ['fetch', 'fetch_default_rate', 'state_cold', 'state_warm', 'generate', 'summary', 'aggregate',
+          'ignore_rules']
+# phases run in a process of their own, with the default rate limits
+DEFAULT_RATE_PHASES = ('fetch_default_rate',)
+# effectively no client side rate limit
+UNLIMITED_RATE = 1e9
+FAKE_AWS_ENV = {
+    'AWS_ACCESS_KEY_ID': 'fake',
+    'AWS_SECRET_ACCESS_KEY': 'fake',
+    'AWS_DEFAULT_REGION': 'eu-west-2',
+}
+
+
+def get_server_stats(endpoint_url):
+    """Get fake endpoint request counters"""
+
+    with urllib.request.urlopen(endpoint_url + '/stats') as response:
+        return json.load(response)
+
+
+def run_phase(func, endpoint_url=None):
+    """Run a benchmark phase. func returns (records, summary) where records
+    is the number of records processed, or None to count the invocations
+    returned by the fake endpoint"""
+
+    stats_before = get_server_stats(endpoint_url) if endpoint_url else {}
+    start = time.perf_counter()
+    records, summary = func()
+    wall_secs = time.perf_counter() - start
+    stats = get_server_stats(endpoint_url) if endpoint_url else {}
+    api_calls = {
+        name: count - stats_before.get(name, 0)
+        for name, count in stats.items()
+        if not name.endswith('.records') and count != stats_before.get(name, 0)
+    }
+    if records is None:
+        records = (stats.get('ListCommandInvocations.records', 0) -
+                   stats_before.get('ListCommandInvocations.records', 0))
+    return {
+        'wall_secs': round(wall_secs, 3),
+        'records': records,
+        'records_per_sec': round(records / wall_secs) if wall_secs else 0,
+        'peak_rss_mb': round(benchmark.peak_rss_mb(), 1),
+        'api_calls': api_calls,
+        'totals': summary.get('all', {}).get('all', {}),
+    }
+
+
+def run_size(args):
+    """Run the benchmark phases for one size against a running fake
+    endpoint. Returns dict of phase to results"""
+
+    monitor = benchmark.load_script(
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ssm-command-monitor.py'),
+        'ssm_command_monitor')
+    if not set(args.phases) & set(DEFAULT_RATE_PHASES):
+        max_rate = args.max_rate or UNLIMITED_RATE
+        scheduler.DEFAULT_MAX_RATE = max_rate
+        for api in scheduler.DEFAULT_MAX_RATES:
+            scheduler.DEFAULT_MAX_RATES[api] = max_rate
+
+    data = fake_aws.SyntheticData(args.run_size, args.instances, args.fanout,
+                                  args.span, args.now, args.seed)
+    now = datetime.datetime.fromtimestamp(data.now, datetime.timezone.utc)
+    start_timestamp = now - datetime.timedelta(seconds=args.span + 60)
+    end_timestamp = now + datetime.timedelta(seconds=60)
+    one_day_ago_timestamp = now - datetime.timedelta(days=1)
+    client = aws_client.get_backend(args.backend, endpoint_url=args.endpoint_url)
+
+    def fetch(state=None):
+        summary = monitor.get_account_commands_summary(client, 0, start_timestamp, end_timestamp,
+                                                       start_timestamp, one_day_ago_timestamp,
+                                                       state)
+        return None, summary
+
+    def generate():
+        records = sum(1 for _ in data.invocations())
+        return records, {}
+
+    def summary(command_invocations=None):
+        document_names = {command['DocumentName'] for command in data.commands()}
+        if command_invocations is None:
+            command_invocations = (fake_aws.cli_record(invocation) for invocation in data.invocations())
+        associations_dict = monitor.associations_json_to_associations_dict(data.associations())
+        return data.num_invocations, monitor.get_commands_summary(
+            document_names, command_invocations, data.instance_tags, associations_dict,
+            0, start_timestamp, end_timestamp)
+
+    def ignore_rules(failures):
+        rules = IgnoreRules(monitor.IGNORE_FAILURES_WITHOUT_ASSOCIATION,
+                            monitor.IGNORE_FAILURES_BY_TAGS,
+                            monitor.IGNORE_FAILURES_BY_COMMENT)
+        for failure in failures:
+            rules.is_status_ignorable(*failure)
+        return len(failures), {}
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        state_filename = os.path.join(tmpdir, 'state.sqlite')
+        for phase in args.phases:
+            if phase in ('fetch', 'fetch_default_rate'):
+                results[phase] = run_phase(fetch, args.endpoint_url)
+            elif phase in ('state_cold', 'state_warm'):
+                state = ssm_state.StateStore(state_filename)
+                try:
+                    results[phase] = run_phase(lambda state=state: fetch(state), args.endpoint_url)
+                finally:
+                    state.close()
+            elif phase == 'generate':
+                results[phase] = run_phase(generate)
+            elif phase == 'summary':
+                results[phase] = run_phase(summary)
+            elif phase == 'aggregate':
+                command_invocations = [fake_aws.cli_record(invocation) for invocation in data.invocations()]
+                results[phase] = run_phase(lambda command_invocations=command_invocations:
+                                           summary(iter(command_invocations)))
+                del command_invocations
+            elif phase == 'ignore_rules':
+                failures = [(invocation['DocumentName'], invocation['Status'], invocation['Comment'],
+                             data.instance_tags[invocation['InstanceId']])
+                            for invocation in data.invocations()
+                            if invocation['Status'] == 'Failed' and invocation['InstanceId'] in data.instance_tags]
+                results[phase] = run_phase(lambda failures=failures: ignore_rules(failures))
+    return results
+
+
+def start_fake_aws(args, size, now):
+    """Start fake_aws.py in the background. Returns the process and its URL"""
+
+    cmd = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fake_aws.py'),
+           '--invocations', str(size),
+           '--instances', str(args.instances),
+           '--fanout', str(args.fanout),
+           '--span', str(args.span),
+           '--now', str(now),
+           '--seed', str(args.seed),
+           '--latency', str(args.latency),
+           '--page-size', str(args.page_size)]
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, text=True)
+    line = process.stdout.readline()
+    if not line.startswith('Listening on '):
+        process.kill()
+        raise ValueError(f'fake_aws.py failed to start: {line}')
+    return process, line.split()[-1]
+
+
+def run_size_process(args, size, endpoint_url, now, phases):
+    """Run phases for one size in a separate process. Returns dict of phase
+    to results"""
+
+    cmd = [sys.executable, os.path.abspath(__file__),
+           '--run-size', str(size),
+           '--endpoint-url', endpoint_url,
+           '--now', str(now),
+           '--instances', str(args.instances),
+           '--fanout', str(args.fanout),
+           '--span', str(args.span),
+           '--seed', str(args.seed),
+           '--backend', args.backend,
+           '--max-rate', str(args.max_rate),
+           '--phases'] + phases
+    env = {name: value for name, value in os.environ.items()
+           if name not in ('AWS_PROFILE', 'AWS_DEFAULT_PROFILE', 'AWS_SESSION_TOKEN')}
+    env.update(FAKE_AWS_ENV)
+    result = subprocess.run(cmd, capture_output=True, text=True, check=False, env=env)
+    if result.returncode != 0:
+        raise ValueError(f'benchmark of {size} invocations failed' + os.linesep + result.stderr)
+    return json.loads(result.stdout)
+
+
+def benchmark_size(args, size):
+    """Run the phases for one size in a separate process, and the default
+    rate phases in another, as rate limits are fixed per process"""
+
+    now = time.time()
+    process, endpoint_url = start_fake_aws(args, size, now)
+    try:
+        results = {}
+        phases = [phase for phase in args.phases if phase not in DEFAULT_RATE_PHASES]
+        if phases:
+            results.update(run_size_process(args, size, endpoint_url, now, phases))
+        for phase in args.phases:
+            if phase in DEFAULT_RATE_PHASES:
+                results.update(run_size_process(args, size, endpoint_url, now, [phase]))
+        return {phase: results[phase] for phase in args.phases}
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def print_results_csv(size, phases, previous, threshold):
+    """Print phase results in CSV, with previous results for comparison.
+    Returns True if there are any regressions"""
+
+    regressions = False
+    for phase, phase_result in phases.items():
+        previous_phase_result = previous['phases'].get(phase) if previous else None
+        regression = benchmark.is_regression(phase_result, previous_phase_result, threshold)
+        regressions = regressions or regression
+        previous_rps = previous_phase_result['records_per_sec'] if previous_phase_result else ''
+        previous_rss = previous_phase_result['peak_rss_mb'] if previous_phase_result else ''
+        api_calls = sum(phase_result['api_calls'].values())
+        print(f'{size},{phase},{phase_result["wall_secs"]},{phase_result["records"]},'
+              f'{phase_result["records_per_sec"]},{phase_result["peak_rss_mb"]},{api_calls},'
+              f'{previous_rps},{previous_rss},{int(regression)}', flush=True)
+    return regressions
+
+
+def check_totals(size, phases):
+    """Warn if phases disagree on the summary totals"""
+
+    totals = {json.dumps(phase_result['totals'], sort_keys=True)
+              for phase_result in phases.values() if phase_result['totals']}
+    if len(totals) > 1:
+        sys.stderr.write(f'Warning: {size} invocations: summary totals differ between phases: '
+                         + ' '.join(sorted(totals)) + os.linesep)
+
+
+def main():
+    """Main function"""
+
+    parser = argparse.ArgumentParser(
+        description='Benchmark ssm-command-monitor.py against a fake SSM/EC2 endpoint')
+    parser.add_argument('--sizes',
+                        nargs='+',
+                        type=int,
+                        default=DEFAULT_SIZES,
+                        help='Number of command invocations to benchmark, e.g. 10000 100000 1000000')
+    parser.add_argument('--instances',
+                        type=int,
+                        default=fake_aws.DEFAULT_INSTANCES,
+                        help='Number of EC2 instances')
+    parser.add_argument('--fanout',
+                        type=int,
+                        default=fake_aws.DEFAULT_FANOUT,
+                        help='Number of instances each command is run on')
+    parser.add_argument('--span',
+                        type=int,
+                        default=fake_aws.DEFAULT_SPAN_SECS,
+                        help='Spread commands over this many seconds')
+    parser.add_argument('--seed',
+                        type=int,
+                        default=0,
+                        help='Random seed for synthetic data')
+    parser.add_argument('--latency',
+                        type=float,
+                        default=0,
+                        help='Fake endpoint response latency in seconds')
+    parser.add_argument('--page-size',
+                        type=int,
+                        default=fake_aws.DEFAULT_PAGE_SIZE,
+                        help='Fake endpoint max records per SSM API page')
+    parser.add_argument('-b',
+                        '--backend',
+                        choices=aws_client.BACKENDS,
+                        default='auto',
+                        help='AWS API backend, auto=boto3 if installed, otherwise aws cli')
+    parser.add_argument('--max-rate',
+                        type=float,
+                        default=0,
+                        help='Client side requests per second per API, 0=unlimited')
+    parser.add_argument('--phases',
+                        nargs='+',
+                        choices=PHASES,
+                        default=PHASES,
+                        help='Phases to run')
+    parser.add_argument('--results',
+                        type=str,
+                        default=DEFAULT_RESULTS_FILE,
+                        help='JSON Lines file to append results to and compare against')
+    parser.add_argument('--threshold',
+                        type=float,
+                        default=benchmark.REGRESSION_THRESHOLD,
+                        help='Flag a regression if throughput drops or peak RSS grows by this fraction')
+    parser.add_argument('--check',
+                        action='store_true',
+                        help='Exit with error if there are any regressions')
+    # internal, used to run a single size in a separate process
+    parser.add_argument('--run-size', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--endpoint-url', type=str, help=argparse.SUPPRESS)
+    parser.add_argument('--now', type=float, help=argparse.SUPPRESS)
+
+    args = parser.parse_args()
+
+    if args.run_size:
+        print(json.dumps(run_size(args)))
+        return
+
+    previous_results = benchmark.read_results(args.results)
+    regressions = False
+    print('Size,Phase,WallSecs,Records,RecordsPerSec,PeakRssMB,ApiCalls,'
+          'PreviousRecordsPerSec,PreviousPeakRssMB,Regression', flush=True)
+    for size in args.sizes:
+        params = {
+            'size': size,
+            'instances': args.instances,
+            'fanout': args.fanout,
+            'span': args.span,
+            'seed': args.seed,
+            'latency': args.latency,
+            'page_size': args.page_size,
+            'backend': args.backend,
+            'max_rate': args.max_rate,
+        }
+        phases = benchmark_size(args, size)
+        check_totals(size, phases)
+        previous = benchmark.find_previous(previous_results, params)
+        regressions = print_results_csv(size, phases, previous, args.threshold) or regressions
+        result = {
+            'timestamp': datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%dT%TZ"),
+            'commit': benchmark.get_commit(),
+            'python': platform.python_version(),
+            'params': params,
+            'phases': phases,
+        }
+        with open(args.results, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(result) + os.linesep)
+
+    if args.check and regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -11,9 +11,10 @@ if [[ -z $interval ]]; then
 fi
 shift 3
 accounts=$("$basedir"/../get_dso_aws_accounts.sh text "$applications" "$environments")
+if [[ -z $accounts ]]; then
+  echo "No accounts found for applications '$applications' environments '$environments'" >&2
+  exit 0
+fi
 
-echo "Account,DocumentName,SuccessCount,FailedCount,IgnoreCount"
-for account in $accounts; do
-  echo "$account: ssm-command-monitor.py --interval $interval --profile $account" >&2
-  python3 "$basedir"/ssm-command-monitor.py --interval "$interval" --profile "$account" "$@" | tail -n +2 | sed -e "s/^/$account,/"
-done
+echo "ssm-command-monitor.py --interval $interval --accounts" $accounts >&2
+python3 "$basedir"/ssm-command-monitor.py --interval "$interval" --accounts $accounts "$@"
@@ -1,17 +1,33 @@
 """Get aggregate statistics for SSM Command Invocation"""
 
 import argparse
+import concurrent.futures
 import json
-import subprocess
 import datetime
+import math
 import os
+import queue
+import signal
 import textwrap
-import re
 import sys
+import threading
 import time
 
-AWSCLI_TIMEOUT_SECS = 30
-AWSCLI_COMMON_ARGS = []
+import failure_output
+from ignore_rules import IgnoreRules, load_ignore_rules
+from instance_metrics import DEFAULT_MAX_SERIES, InstanceMetricsPolicy
+from instance_tags import InstanceTagResolver, TAGS_CACHE_TTL_SECS
+import ssm_state
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from monitoring_common import aggregation, aws_client, cloudwatch, prometheus, scheduler, timings  # pylint: disable=wrong-import-position
+
+FETCH_MAX_WORKERS = 4
+FETCH_TIMEOUT_SECS = 300
+PREFETCH_MAX_PAGES = 4
+ACCOUNTS_MAX_WORKERS = 8
+DAEMON_POLL_INTERVAL_SECS = 60
+MAX_BUCKETS = 1000
 
 IGNORE_FAILURES_WITHOUT_ASSOCIATION = {
     "AWS-UpdateSSMAgent",
@@ -66,84 +82,149 @@ IGNORE_FAILURES_BY_COMMENT = {
     ],
 }
 
-def run_aws_cli(cmd):
-    """Invoke AWS CLI and raise exception on error"""
-
-    cmd += AWSCLI_COMMON_ARGS
-    result = subprocess.run(cmd,
-                            capture_output=True,
-                            text=True,
-                            check=False,
-                            timeout=AWSCLI_TIMEOUT_SECS)
-    if result.returncode != 0:
-        # Can fail due to rate limiting. Sleep and try again
-        time.sleep(2)
-        result = subprocess.run(cmd,
-                                capture_output=True,
-                                text=True,
-                                check=False,
-                                timeout=AWSCLI_TIMEOUT_SECS)
-        if result.returncode != 0:
-            raise ValueError(f'exit code {result.returncode} for cmd' +
-                             ' '.join(cmd) + os.linesep + result.stderr)
-    return json.loads(result.stdout)
-
-
-def describe_tags():
-    """Get EC2 Instance tags"""
-
-    cmd = [
-        'aws',
-        'ec2',
-        'describe-tags',
-        '--filters',
-        'Name=resource-type,Values=instance'
-    ]
-    return run_aws_cli(cmd)
-
-
-def list_associations():
-    """Get SSM Doc associations"""
+IGNORE_RULES = IgnoreRules(IGNORE_FAILURES_WITHOUT_ASSOCIATION,
+                           IGNORE_FAILURES_BY_TAGS,
+                           IGNORE_FAILURES_BY_COMMENT)
 
-    cmd = [
-        'aws',
-        'ssm',
-        'list-associations',
-    ]
-    return run_aws_cli(cmd)
 
+def describe_tags(client, instance_ids):
+    """Get EC2 Instance tags for the given instances"""
 
-def list_commands(timestamp):
-    """Get SSM Command history"""
+    params = {
+        'Filters': [
+            {'Name': 'resource-type', 'Values': ['instance']},
+            {'Name': 'resource-id', 'Values': instance_ids},
+        ],
+    }
+    return client.paginate('ec2', 'describe-tags', 'Tags', params)
 
-    cmd = [
-        'aws',
-        'ssm',
-        'list-commands',
-        '--filters',
-        'key=InvokedAfter,value=' + timestamp.strftime("%Y-%m-%dT%TZ"),
-    ]
-    return run_aws_cli(cmd)
 
+def list_associations(client):
+    """Get SSM Doc associations"""
+
+    return client.paginate('ssm', 'list-associations', 'Associations')
 
-def list_command_invocations(timestamp):
-    """Get SSM Command Invocation history"""
 
-    cmd = [
-        'aws',
-        'ssm',
-        'list-command-invocations',
-        '--filters',
-        'key=InvokedAfter,value=' + timestamp.strftime("%Y-%m-%dT%TZ"),
-    ]
-    return run_aws_cli(cmd)
+def list_commands(client, timestamp):
+    """Get SSM Command history"""
 
+    params = {
+        'Filters': [{
+            'key': 'InvokedAfter',
+            'value': timestamp.strftime("%Y-%m-%dT%TZ")
+        }],
+    }
+    return client.paginate('ssm', 'list-commands', 'Commands', params)
+
+
+def list_command_invocations(client, timestamp):
+    """Get SSM Command Invocation history, one page at a time"""
+
+    params = {
+        'Filters': [{
+            'key': 'InvokedAfter',
+            'value': timestamp.strftime("%Y-%m-%dT%TZ")
+        }],
+    }
+    return client.paginate_pages('ssm', 'list-command-invocations',
+                                 'CommandInvocations', params)
+
+
+def fetch_concurrently(fetchers, max_workers=FETCH_MAX_WORKERS, timeout=FETCH_TIMEOUT_SECS):
+    """Run independent fetch functions in a thread pool and return a dict of
+    results keyed by name. Each fetch must complete within timeout seconds
+    and the first error is raised without waiting for the other fetches.
+    Each fetch is timed as a phase named by the first word of its name"""
+
+    def fetch(name, fetcher):
+        with timings.phase(name.split()[0]) as timer:
+            records = list(fetcher())
+            timer.add_records(len(records))
+        return records
+
+    results = {}
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        deadline = time.monotonic() + timeout
+        futures = {
+            name: executor.submit(fetch, name, fetcher)
+            for name, fetcher in fetchers.items()
+        }
+        for name, future in futures.items():
+            try:
+                results[name] = future.result(timeout=max(0, deadline - time.monotonic()))
+            except concurrent.futures.TimeoutError as e:
+                raise ValueError(f'{name} did not complete within {timeout} seconds') from e
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+    return results
+
+
+def list_command_invocations_for_command(client, command_id):
+    """Get SSM Command Invocations for a single command"""
+
+    return client.paginate('ssm', 'list-command-invocations',
+                           'CommandInvocations', {'CommandId': command_id})
+
+
+def prefetch_pages(pages, max_pages=PREFETCH_MAX_PAGES, timeout=FETCH_TIMEOUT_SECS):
+    """Start fetching pages in a background thread and return a generator of
+    records. At most max_pages are buffered, so memory stays flat however
+    many records there are, and records can be processed while later pages
+    are still being fetched. Close the generator if it may not be read to
+    the end, e.g. on error, to stop the fetch"""
+
+    buffer = queue.Queue(maxsize=max_pages)
+    stop = threading.Event()
+    done = object()
+    deadline = time.monotonic() + timeout
+
+    def put(item):
+        # give up if the consumer closes the generator or doesn't read it in time
+        while not stop.is_set() and time.monotonic() < deadline:
+            try:
+                buffer.put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
 
-def tags_json_to_instance_dict(tags_json):
+    def producer():
+        try:
+            for page in pages:
+                if not put(page):
+                    return
+            put(done)
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            put(e)
+
+    def records():
+        try:
+            yield None  # primed below, so closing always reaches the finally
+            while True:
+                try:
+                    page = buffer.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty as e:
+                    raise ValueError(f'pages did not complete within {timeout} seconds') from e
+                if page is done:
+                    return
+                if isinstance(page, Exception):
+                    raise page
+                yield from page
+        finally:
+            stop.set()
+
+    threading.Thread(target=producer, daemon=True).start()
+    generator = records()
+    next(generator)
+    return generator
+
+
+def tags_json_to_instance_dict(tags):
     """Convert AWS EC2 instance tags json into more convenient dictionary"""
 
     instance_dict = {}
-    for tag in tags_json['Tags']:
+    for tag in tags:
         instance_id = tag['ResourceId']
         tag_key = tag['Key']
         tag_value = tag['Value']
@@ -153,86 +234,33 @@ def tags_json_to_instance_dict(tags_json):
     return instance_dict
 
 
-def associations_json_to_associations_dict(associations_json):
+def associations_json_to_associations_dict(associations):
     """Convert SSM doc association json into more convenient dictionary"""
 
     associations_dict = {}
-    for association in associations_json['Associations']:
+    for association in associations:
         association_id = association['AssociationId']
         associations_dict[association_id] = association
     return associations_dict
 
 
-def is_taglist_match(instance_tags, match_tags):
-    """Check if an instance has the given tag values"""
-
-    for match_tag in match_tags.keys():
-        if match_tag not in instance_tags.keys():
-            return False
-        if not re.match(match_tags[match_tag], instance_tags[match_tag]):
-            return False
-    return True
-
-
-def is_status_ignorable(document_name, status, comment, instance_tags):
-    """Check whether to skip over a failed SSM doc as defined in global variables"""
-    if status != 'Failed':
-        return False
-
-    if document_name in IGNORE_FAILURES_BY_COMMENT:
-        if comment in IGNORE_FAILURES_BY_COMMENT[document_name]:
-            return True
-
-    if document_name in IGNORE_FAILURES_BY_TAGS:
-        for tag_list in IGNORE_FAILURES_BY_TAGS[document_name]:
-            if is_taglist_match(instance_tags, tag_list):
-                return True
-
-    return False
-
-
-def add_commands_stat(commands_summary, instance_id, document_name, status):
-    """Add to the SSM command stats"""
-
-    zeroed_stats = {}
-    zeroed_stats["ignore"] = 0
-    zeroed_stats["success"] = 0
-    zeroed_stats["failed"] = 0
-    if 'all' not in commands_summary:
-        commands_summary['all'] = {}
-        commands_summary['all']['all'] = zeroed_stats.copy()
-    if document_name not in commands_summary['all']:
-        commands_summary['all'][document_name] = zeroed_stats.copy()
-    if instance_id is not None:
-        if instance_id not in commands_summary:
-            commands_summary[instance_id] = {}
-            commands_summary[instance_id]['all'] = zeroed_stats.copy()
-        if document_name not in commands_summary[instance_id]:
-            commands_summary[instance_id][document_name] = zeroed_stats.copy()
-    if status is not None:
-        commands_summary['all']['all'][status] += 1
-        commands_summary['all'][document_name][status] += 1
-        if instance_id is not None:
-            commands_summary[instance_id]['all'][status] += 1
-            commands_summary[instance_id][document_name][status] += 1
-
-
-def get_commands_summary(commands_json, command_invocations_json, tags_dict, associations_dict, verbose, start_timestamp, end_timestamp):
-    """Aggregate all SSM command stats"""
+def get_commands_stats(document_names, command_invocations, tags_dict, associations_dict, verbose,
+                       start_timestamp, end_timestamp, bucket_secs, failures=None):
+    """Aggregate SSM command stats into time buckets of bucket_secs ending at
+    end_timestamp. Returns a StatsTable per bucket, most recent first. If
+    failures is given, a list, failed non-ignored invocations are appended"""
 
-    commands_summary = {}
+    num_buckets = -(-int((end_timestamp - start_timestamp).total_seconds()) // bucket_secs)
+    buckets = [aggregation.StatsTable(('ignore', 'success', 'failed')) for _ in range(num_buckets)]
+    end_epoch = end_timestamp.timestamp()
 
     # add zeroed stats for all documents. To ensure cloudwatch metric widgets/alarms work properly
-    for command in commands_json['Commands']:
-        document_name = command['DocumentName']
-        add_commands_stat(commands_summary, None, document_name, None)
+    for document_name in document_names:
+        for stats in buckets:
+            stats.add(None, document_name)
 
-    for command in command_invocations_json['CommandInvocations']:
-        requested_datetime = command['RequestedDateTime']
-        if "." in requested_datetime:
-            timestamp = datetime.datetime.strptime(requested_datetime, '%Y-%m-%dT%H:%M:%S.%f%z')
-        else:
-            timestamp = datetime.datetime.strptime(requested_datetime, '%Y-%m-%dT%H:%M:%S%z')
+    for command in command_invocations:
+        timestamp = aggregation.parse_timestamp(command['RequestedDateTime'])
         command_id = command['CommandId']
         document_name = command['DocumentName']
         instance_id = command['InstanceId']
@@ -242,59 +270,56 @@ def get_commands_summary(commands_json, command_invocations_json, tags_dict, ass
 
         if timestamp < start_timestamp or timestamp >= end_timestamp:
             continue
+        # bucket i covers [end - (i + 1) * bucket_secs, end - i * bucket_secs)
+        stats = buckets[-int((timestamp.timestamp() - end_epoch) // bucket_secs) - 1]
 
         instance_tags = None
         if instance_id in tags_dict:
             instance_tags = tags_dict[instance_id]
 
-        if document_name in IGNORE_FAILURES_WITHOUT_ASSOCIATION and len(
+        if document_name in IGNORE_RULES.without_association and len(
                 comment_ids) != 2:
-            add_commands_stat(commands_summary, instance_id, document_name,
-                              'ignore')
+            stats.add(instance_id, document_name, 'ignore')
             if verbose >= 2:
                 sys.stderr.write(
                     f'Verbose2: InstanceId={instance_id} CommandId={command_id}: ignoring {document_name} {status} "{comment}" - not scheduled'
                     + os.linesep)
             continue
-        if document_name in IGNORE_FAILURES_WITHOUT_ASSOCIATION and comment_ids[
+        if document_name in IGNORE_RULES.without_association and comment_ids[
                 0] not in associations_dict:
-            add_commands_stat(commands_summary, instance_id, document_name,
-                              'ignore')
+            stats.add(instance_id, document_name, 'ignore')
             if verbose >= 2:
                 sys.stderr.write(
                     f'Verbose2: InstanceId={instance_id} CommandId={command_id}: ignoring {document_name} {status} "{comment}" - association not found'
                     + os.linesep)
             continue
         if status == 'InProgress':
-            add_commands_stat(commands_summary, instance_id, document_name,
-                              'ignore')
+            stats.add(instance_id, document_name, 'ignore')
             if verbose >= 2:
                 sys.stderr.write(
                     f'Verbose2: InstanceId={instance_id} CommandId={command_id}: ignoring {document_name} {status} "{comment}" - still running'
                     + os.linesep)
             continue
         if instance_tags is None:
-            add_commands_stat(commands_summary, instance_id, document_name,
-                              'ignore')
+            stats.add(instance_id, document_name, 'ignore')
             if verbose >= 2:
                 sys.stderr.write(
                     f'Verbose2: InstanceId={instance_id} CommandId={command_id}: ignoring {document_name} {status} "{comment}" - EC2 not found'
                     + os.linesep)
             continue
-        if is_status_ignorable(document_name, status, comment, instance_tags):
-            add_commands_stat(commands_summary, instance_id, document_name,
-                              'ignore')
+        if IGNORE_RULES.is_status_ignorable(document_name, status, comment, instance_tags):
+            stats.add(instance_id, document_name, 'ignore')
             if verbose >= 2:
                 sys.stderr.write(
                     f'Verbose2: InstanceId={instance_id} CommandId={command_id}: ignoring {document_name} {status} "{comment}" - in ignore list'
                     + os.linesep)
             continue
         if status == 'Success':
-            add_commands_stat(commands_summary, instance_id, document_name,
-                              'success')
+            stats.add(instance_id, document_name, 'success')
         else:
-            add_commands_stat(commands_summary, instance_id, document_name,
-                              'failed')
+            stats.add(instance_id, document_name, 'failed')
+            if failures is not None:
+                failures.append(command)
             if verbose >= 1:
                 sys.stderr.write(
                     f'Verbose1: InstanceId={instance_id} CommandId={command_id}: {document_name} {status} "{comment}"'
@@ -307,24 +332,372 @@ def get_commands_summary(commands_json, command_invocations_json, tags_dict, ass
                 sys.stderr.write(
                     textwrap.indent(json.dumps(instance_tags, indent=1),
                                     'Verbose4: ') + os.linesep)
-    return commands_summary
+    return buckets
 
 
-def print_commands_summary_csv(commands_summary, timestamp):
-    """Print SSM command stats in CSV"""
+def get_commands_summary(document_names, command_invocations, tags_dict, associations_dict, verbose, start_timestamp, end_timestamp):
+    """Aggregate all SSM command stats"""
 
-    print('Timestamp,InstanceId,DocumentName,SuccessCount,FailedCount,IgnoreCount')
-    for instance_id in commands_summary.keys():
-        for command_key in commands_summary[instance_id].keys():
-            command = commands_summary[instance_id][command_key]
-            print(
-                f'{timestamp},{instance_id},{command_key},{command["success"]},{command["failed"]},{command["ignore"]}'
-            )
+    bucket_secs = int((end_timestamp - start_timestamp).total_seconds())
+    return get_commands_stats(document_names, command_invocations, tags_dict, associations_dict,
+                              verbose, start_timestamp, end_timestamp, bucket_secs)[0].summary()
+
+
+def get_windows_summary(buckets, bucket_secs, end_timestamp, windows):
+    """Roll up bucket stats into a summary for each of windows, a list of
+    (window_end_timestamp, window_secs). Returns a list of
+    (window_end_timestamp, window_secs, summary)"""
+
+    windows_summary = []
+    for window_end_timestamp, window_secs in windows:
+        first = int((end_timestamp - window_end_timestamp).total_seconds()) // bucket_secs
+        stats = aggregation.StatsTable(('ignore', 'success', 'failed'))
+        for bucket in buckets[first:first + window_secs // bucket_secs]:
+            stats.update(bucket)
+        windows_summary.append((window_end_timestamp, window_secs, stats.summary()))
+    return windows_summary
+
+
+def get_account_commands_summary(client, verbose, start_timestamp, end_timestamp,
+                                 invoke_after_timestamp, document_names_after_timestamp,
+                                 state=None, tags_ttl=TAGS_CACHE_TTL_SECS, windows=None,
+                                 instance_tags=None, failures=None):
+    """Fetch and aggregate SSM command stats for one account. If a state store
+    is given, only fetch invocations newer than the previous run, cache
+    instance tags, and take the document names to report from its registry
+    rather than listing commands since document_names_after_timestamp. If
+    instance_tags is given, a dict, it is updated with the tags of instances
+    seen, e.g. for per-instance metric dimensions. If failures is given, a
+    list, failed invocations are appended to it.
+
+    Returns the summary from start to end timestamp, or if windows is given,
+    a list of (window_end_timestamp, window_secs), a summary for each window
+    from the one fetch, see get_windows_summary()"""
+
+    document_names = None
+    invocations_after_timestamp = invoke_after_timestamp
+    pending_command_ids = []
+    if state:
+        document_names = state.get_document_names(document_names_after_timestamp)
+        invocations_after_timestamp = state.fetch_after('command_invocations', invoke_after_timestamp)
+        pending_command_ids = state.get_pending_command_ids(invoke_after_timestamp,
+                                                            invocations_after_timestamp)
+
+    # invocations are streamed and aggregated as pages arrive, while the
+    # reference data needed to process them is fetched concurrently
+    invocation_pages = prefetch_pages(
+        list_command_invocations(client, invocations_after_timestamp))
+    command_invocations = invocation_pages
+    try:
+        fetchers = {
+            'list_associations': lambda: list_associations(client),
+        }
+        # without a registry of document names yet, sweep the command history
+        if not document_names:
+            fetchers['list_commands'] = lambda: list_commands(client, document_names_after_timestamp)
+        for command_id in pending_command_ids:
+            fetchers[f'list_command_invocations {command_id}'] = (
+                lambda command_id=command_id: list_command_invocations_for_command(client, command_id))
+        results = fetch_concurrently(fetchers)
+
+        if 'list_commands' in results and not state:
+            document_names = dict.fromkeys(command['DocumentName'] for command in results['list_commands'])
+        if state:
+            with timings.phase('state_update'):
+                if 'list_commands' in results:
+                    state.update_document_names(ssm_state.get_document_names_last_seen(results['list_commands']))
+                state.update_command_invocations(command_invocations)
+                state.update_coverage('command_invocations', invocations_after_timestamp)
+                for command_id in pending_command_ids:
+                    state.update_command_invocations(results[f'list_command_invocations {command_id}'])
+                state.prune(document_names_after_timestamp, invoke_after_timestamp, time.time() - tags_ttl)
+                document_names = state.get_document_names(document_names_after_timestamp)
+                command_invocations = state.get_command_invocations(invoke_after_timestamp)
+
+        def get_tags(instance_ids):
+            with timings.phase('describe_tags') as timer:
+                tags = tags_json_to_instance_dict(describe_tags(client, instance_ids))
+                timer.add_records(len(tags))
+            return tags
+
+        # only look up tags for instances seen in the invocations
+        tag_resolver = InstanceTagResolver(get_tags, state, tags_ttl, instance_tags)
+        command_invocations = tag_resolver.resolve(command_invocations)
+        associations_dict = associations_json_to_associations_dict(results['list_associations'])
+        if windows:
+            bucket_secs = math.gcd(*[window_secs for _, window_secs in windows] +
+                                   [int((end_timestamp - window_end_timestamp).total_seconds())
+                                    for window_end_timestamp, _ in windows])
+        else:
+            bucket_secs = int((end_timestamp - start_timestamp).total_seconds())
+        # without a state store, this includes waiting for invocation pages
+        with timings.phase('aggregate') as timer:
+            buckets = get_commands_stats(document_names,
+                                         command_invocations,
+                                         tag_resolver.tags_dict,
+                                         associations_dict,
+                                         verbose,
+                                         start_timestamp,
+                                         end_timestamp,
+                                         bucket_secs,
+                                         failures)
+            timer.add_records(sum(sum(counts) for stats in buckets for counts in stats.counters.values()))
+            if not windows:
+                return buckets[0].summary()
+            return get_windows_summary(buckets, bucket_secs, end_timestamp, windows)
+    finally:
+        invocation_pages.close()
+
+
+def get_accounts_commands_summary(accounts, get_summary, max_workers=ACCOUNTS_MAX_WORKERS):
+    """Collect SSM command stats for multiple accounts in parallel. Returns a
+    dict of account to either the stats or the exception raised"""
+
+    accounts_summary = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            account: executor.submit(get_summary, account)
+            for account in accounts
+        }
+        for account, future in futures.items():
+            try:
+                accounts_summary[account] = future.result()
+            except Exception as e:  # pylint: disable=broad-exception-caught
+                sys.stderr.write(f'{account}: {e}' + os.linesep)
+                accounts_summary[account] = e
+    return accounts_summary
+
+
+def read_accounts_file(filename):
+    """Read account names from a file, e.g. output of get_dso_aws_accounts.sh text"""
+
+    accounts = []
+    with open(filename, encoding='utf-8') as f:
+        for line in f:
+            line = line.split('#')[0].strip()
+            if line:
+                accounts += line.split()
+    return accounts
+
+
+def print_commands_summary_csv(windows_summary, show_window=False):
+    """Print SSM command stats in CSV, see get_windows_summary(). The Window
+    column is only shown if show_window is set"""
+
+    window_header = 'Window,' if show_window else ''
+    print(f'Timestamp,{window_header}InstanceId,DocumentName,SuccessCount,FailedCount,IgnoreCount')
+    for end_timestamp, window_secs, commands_summary in windows_summary:
+        timestamp = end_timestamp.strftime("%Y-%m-%dT%TZ")
+        window = f'{window_secs},' if show_window else ''
+        for instance_id in commands_summary.keys():
+            for command_key in commands_summary[instance_id].keys():
+                command = commands_summary[instance_id][command_key]
+                print(
+                    f'{timestamp},{window}{instance_id},{command_key},{command["success"]},{command["failed"]},{command["ignore"]}'
+                )
+
+
+def print_accounts_summary_csv(accounts_summary, timestamp, show_window=False):
+    """Print SSM command stats for multiple accounts in CSV"""
+
+    window_header = 'Window,' if show_window else ''
+    window_error = ',' if show_window else ''
+    print(f'Account,Status,Timestamp,{window_header}InstanceId,DocumentName,SuccessCount,FailedCount,IgnoreCount')
+    for account, windows_summary in accounts_summary.items():
+        if isinstance(windows_summary, Exception):
+            print(f'{account},error,{timestamp},{window_error},,,,')
+            continue
+        for end_timestamp, window_secs, commands_summary in windows_summary:
+            window_timestamp = end_timestamp.strftime("%Y-%m-%dT%TZ")
+            window = f'{window_secs},' if show_window else ''
+            for instance_id in commands_summary.keys():
+                for command_key in commands_summary[instance_id].keys():
+                    command = commands_summary[instance_id][command_key]
+                    print(
+                        f'{account},ok,{window_timestamp},{window}{instance_id},{command_key},{command["success"]},{command["failed"]},{command["ignore"]}'
+                    )
+
+
+def commands_summary_to_metric_data(windows_summary, interval, instance_metrics_policy=None,
+                                    instance_tags=None):
+    """Convert SSM command stats to CloudWatch metric data. Instance specific
+    metrics are only uploaded as selected by instance_metrics_policy. Windows
+    other than the main interval get a Window dimension, so the existing
+    metrics are unchanged"""
+
+    metric_data = []
+    for end_timestamp, window_secs, commands_summary in windows_summary:
+        timestamp = end_timestamp.strftime("%Y-%m-%dT%TZ")
+        series = []
+        for document_name, command in commands_summary.get('all', {}).items():
+            dimensions = {}
+            if document_name != 'all':
+                dimensions['DocumentName'] = document_name
+            series.append((dimensions, command))
+        if instance_metrics_policy:
+            series += instance_metrics_policy.get_series(commands_summary, instance_tags or {})
+        for dimensions, command in series:
+            if window_secs != interval:
+                dimensions = dict(dimensions, Window=str(window_secs))
+            metric_data += [
+                cloudwatch.metric_datum('SSMCommandSuccessCount', command['success'], timestamp, dimensions),
+                cloudwatch.metric_datum('SSMCommandFailedCount', command['failed'], timestamp, dimensions),
+                cloudwatch.metric_datum('SSMCommandIgnoreCount', command['ignore'], timestamp, dimensions),
+            ]
+    return metric_data
+
+
+def commands_summary_to_prometheus(accounts_summary):
+    """Convert SSM command stats for each account to Prometheus metrics.
+    As with CloudWatch, instance specific metrics are left out. Only windows
+    ending at the most recent timestamp are current, earlier --buckets are
+    left out"""
+
+    samples = []
+    for account, windows_summary in accounts_summary.items():
+        latest_timestamp = max(end_timestamp for end_timestamp, _, _ in windows_summary)
+        for end_timestamp, window_secs, commands_summary in windows_summary:
+            if end_timestamp != latest_timestamp:
+                continue
+            for document_name, command in commands_summary.get('all', {}).items():
+                for status in ('success', 'failed', 'ignore'):
+                    samples.append(({
+                        'account': account,
+                        'window': window_secs,
+                        'document_name': document_name,
+                        'status': status,
+                    }, command[status]))
+    return prometheus.format_metric('ssm_command_invocations', 'gauge',
+                                    'SSM command invocations in the window by status',
+                                    samples)
+
+
+def get_timestamps(timestamp, interval, round_interval=False, span=None,
+                   document_retention=ssm_state.DOCUMENT_NAMES_RETENTION_SECS):
+    """Get (start, end, invoke_after, document_names_after) timestamps for
+    checking the given interval up to timestamp. If span is given, start is
+    that many seconds before end, e.g. to cover multiple windows. Documents
+    seen within document_retention seconds are reported even if not run"""
+
+    timestamp = timestamp.replace(microsecond=0)
+    span = span or interval
+    if round_interval:
+        epoch_time = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+        delta = int((timestamp - epoch_time).total_seconds()) % interval
+        end_timestamp = timestamp - datetime.timedelta(seconds=delta)
+        start_timestamp = end_timestamp - datetime.timedelta(seconds=span)
+        invoke_after_timestamp = start_timestamp - datetime.timedelta(seconds=60)
+    else:
+        start_timestamp = timestamp - datetime.timedelta(seconds=span)
+        end_timestamp = timestamp
+        invoke_after_timestamp = start_timestamp
+    document_names_after_timestamp = timestamp - datetime.timedelta(seconds=document_retention)
+    return start_timestamp, end_timestamp, invoke_after_timestamp, document_names_after_timestamp
+
+
+def get_windows(end_timestamp, interval, windows=None, buckets=None):
+    """Get the (window_end_timestamp, window_secs) windows to report. Either
+    the interval and any additional windows ending at end_timestamp, or the
+    given number of consecutive intervals"""
+
+    if buckets:
+        return [(end_timestamp - datetime.timedelta(seconds=interval * i), interval)
+                for i in range(buckets)]
+    return [(end_timestamp, window_secs) for window_secs in sorted({interval, *(windows or [])})]
+
+
+def run_daemon(accounts, get_summary, upload_metrics, metrics_server,
+               interval, round_interval, poll_interval=DAEMON_POLL_INTERVAL_SECS, span=None,
+               document_retention=ssm_state.DOCUMENT_NAMES_RETENTION_SECS):
+    """Poll SSM command stats every poll_interval seconds until SIGTERM or
+    SIGINT, serving the latest stats on the metrics server. If an account
+    fails, its last good stats are kept and its up metric set to 0. Stats
+    are only uploaded once per interval, so each upload is a new interval
+    rather than one overlapping the last"""
+
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_args: stop.set())
+    signal.signal(signal.SIGINT, lambda *_args: stop.set())
+    labels = {account: account or 'default' for account in accounts}
+    last_summary = {}
+    last_success = {}
+    next_upload = {}
+    poll_errors = {account: 0 for account in accounts}
+    metrics_server.start()
+    while not stop.is_set():
+        poll_start = time.monotonic()
+        timestamps = get_timestamps(datetime.datetime.now(datetime.timezone.utc),
+                                    interval, round_interval, span, document_retention)
+        accounts_summary = get_accounts_commands_summary(
+            accounts, lambda account: get_summary(account, timestamps))
+        poll_secs = time.monotonic() - poll_start
+        for account, windows_summary in accounts_summary.items():
+            if isinstance(windows_summary, Exception):
+                poll_errors[account] += 1
+                continue
+            last_summary[labels[account]] = windows_summary
+            last_success[account] = time.time()
+            if timestamps[1] >= next_upload.get(account, timestamps[1]):
+                upload_metrics(account, windows_summary)
+                next_upload[account] = timestamps[1] + datetime.timedelta(seconds=interval)
+
+        metrics = commands_summary_to_prometheus(last_summary)
+        metrics += prometheus.format_metric(
+            'ssm_command_monitor_up', 'gauge', 'Whether the last poll of the account succeeded',
+            [({'account': labels[account]}, int(not isinstance(accounts_summary[account], Exception)))
+             for account in accounts])
+        metrics += prometheus.format_metric(
+            'ssm_command_monitor_last_success_timestamp_seconds', 'gauge',
+            'Time of the last successful poll of the account',
+            [({'account': labels[account]}, round(last_success[account], 3))
+             for account in accounts if account in last_success])
+        metrics += prometheus.format_metric(
+            'ssm_command_monitor_poll_errors_total', 'counter', 'Failed polls of the account',
+            [({'account': labels[account]}, poll_errors[account]) for account in accounts])
+        metrics += prometheus.format_metric(
+            'ssm_command_monitor_poll_duration_seconds', 'gauge', 'Duration of the last poll',
+            [({}, round(poll_secs, 3))])
+        metrics += prometheus.format_scheduler_counters()
+        metrics += prometheus.format_timings()
+        metrics_server.set_metrics(metrics)
+        stop.wait(max(0, poll_interval - (time.monotonic() - poll_start)))
+    metrics_server.shutdown()
+
+
+def write_failure_output(filename, accounts_failures, args, deadline):
+    """Fetch output of failed invocations for each account, until deadline,
+    and write a JSON Lines record for each. Returns the number of records"""
+
+    counts = {}
+    with open(filename, 'w', encoding='utf-8') as f:
+        for account, failures in accounts_failures.items():
+            if not failures:
+                continue
+            client = aws_client.get_backend(args.backend,
+                                            profile=account,
+                                            endpoint_url=args.endpoint_url)
+            state = ssm_state.StateStore(args.state, account) if args.state else None
+            try:
+                enricher = failure_output.FailureOutputEnricher(
+                    lambda command_id, instance_id: client.call(
+                        'ssm', 'get-command-invocation',
+                        {'CommandId': command_id, 'InstanceId': instance_id}),
+                    state,
+                    max_chars=args.failure_output_max_chars)
+                for record in enricher.enrich(failures, deadline):
+                    f.write(json.dumps(dict(Account=account, **record)) + '\n')
+                    counts[record['Source']] = counts.get(record['Source'], 0) + 1
+            finally:
+                if state:
+                    state.close()
+    if args.verbose >= 4:
+        sys.stderr.write(f'Verbose4: failure output: {json.dumps(counts)}{os.linesep}')
+    return sum(counts.values())
 
 
 def main():
     """Main function"""
-    global AWSCLI_COMMON_ARGS
+    global IGNORE_RULES
 
     parser = argparse.ArgumentParser(
         description='Check SSM command invocations status')
@@ -333,14 +706,110 @@ def main():
                         required=True,
                         type=int,
                         help='Check SSM commands for this time interval in seconds')
-    parser.add_argument('-p',
-                        '--profile',
+    accounts_group = parser.add_mutually_exclusive_group()
+    accounts_group.add_argument('-p',
+                                '--profile',
+                                type=str,
+                                help='Optional profile to use for aws cli')
+    accounts_group.add_argument('-a',
+                                '--accounts',
+                                nargs='+',
+                                help='Collect multiple accounts in parallel, using account name as profile')
+    accounts_group.add_argument('--accounts-file',
+                                type=str,
+                                help='As --accounts but read account names from file')
+    parser.add_argument('-b',
+                        '--backend',
+                        choices=aws_client.BACKENDS,
+                        default='auto',
+                        help='AWS API backend, auto=boto3 if installed, otherwise aws cli')
+    parser.add_argument('--endpoint-url',
+                        type=str,
+                        help='Optional AWS API endpoint override, e.g. a local stub')
+    parser.add_argument('-c',
+                        '--cloudwatch',
+                        action='store_true',
+                        help='Upload metrics to cloudwatch')
+    parser.add_argument('-d',
+                        '--dryrun',
+                        action='store_true',
+                        help='Show cloudwatch aws cli commands but don\'t upload')
+    parser.add_argument('--instance-top',
+                        type=int,
+                        default=0,
+                        help='Upload InstanceId metrics for this many instances with the most failures')
+    parser.add_argument('--instance-threshold',
+                        type=int,
+                        help='Upload InstanceId metrics for instances with at least this many failures')
+    parser.add_argument('--instance-tags',
+                        nargs='+',
+                        default=[],
+                        help='Upload metrics by these instance tags, e.g. environment-name server-type')
+    parser.add_argument('--max-series',
+                        type=int,
+                        default=DEFAULT_MAX_SERIES,
+                        help='Max InstanceId or tag value series per window, the rest are folded into "other"')
+    parser.add_argument('--ignore-rules',
                         type=str,
-                        help='Optional profile to use for aws cli')
+                        help='Optional JSON or YAML file overriding the IGNORE_FAILURES_* rules')
+    windows_group = parser.add_mutually_exclusive_group()
+    windows_group.add_argument('-w',
+                               '--windows',
+                               nargs='+',
+                               type=int,
+                               help='Also report these time windows in seconds, e.g. 21600 86400, from the same fetch')
+    windows_group.add_argument('--buckets',
+                               type=int,
+                               help='Report this many consecutive --interval windows, from the same fetch')
     parser.add_argument('-r',
                         '--round',
                         action='store_true',
                         help='Round the time interval checked, e.g. if 3600, check from 14:00 to 15:00')
+    parser.add_argument('-s',
+                        '--state',
+                        type=str,
+                        help='Optional SQLite file to keep state between runs, so only new invocations are fetched')
+    parser.add_argument('--tags-ttl',
+                        type=int,
+                        default=TAGS_CACHE_TTL_SECS,
+                        help='How long to cache EC2 instance tags in the state file, in seconds')
+    parser.add_argument('--document-retention',
+                        type=int,
+                        default=ssm_state.DOCUMENT_NAMES_RETENTION_SECS,
+                        help='Report zero counts for documents run within this many seconds, from the'
+                        ' --state document name registry if given, otherwise by listing commands')
+    parser.add_argument('--daemon',
+                        action='store_true',
+                        help='Keep running, polling every --poll-interval and serving stats on /metrics.'
+                        ' With --cloudwatch, stats are uploaded once per --interval')
+    parser.add_argument('--poll-interval',
+                        type=int,
+                        default=DAEMON_POLL_INTERVAL_SECS,
+                        help='How often to poll in --daemon mode, in seconds')
+    parser.add_argument('--metrics-address',
+                        type=str,
+                        default=prometheus.DEFAULT_METRICS_ADDRESS,
+                        help='Address for the --daemon /metrics endpoint to listen on')
+    parser.add_argument('--metrics-port',
+                        type=int,
+                        default=prometheus.DEFAULT_METRICS_PORT,
+                        help='Port for the --daemon /metrics endpoint to listen on')
+    parser.add_argument('--failure-output',
+                        type=str,
+                        help='Fetch stdout/stderr of failed invocations after the metrics are output,'
+                        ' and write them as JSON Lines to this file. Cached in --state if given')
+    parser.add_argument('--failure-output-budget',
+                        type=int,
+                        default=failure_output.DEFAULT_BUDGET_SECS,
+                        help='Stop fetching --failure-output after this many seconds')
+    parser.add_argument('--failure-output-max-chars',
+                        type=int,
+                        default=failure_output.DEFAULT_MAX_CHARS,
+                        help='Keep only the last this many characters of each --failure-output stdout/stderr')
+    parser.add_argument('--timings',
+                        type=str,
+                        help='Write per-phase timings and API call counts as JSON to this file, - for stdout,'
+                        ' and upload them as metrics to the --profile account if --cloudwatch')
     parser.add_argument(
         '-v',
         '--verbose',
@@ -352,37 +821,140 @@ def main():
 
     args = parser.parse_args()
 
-    timestamp = datetime.datetime.now(datetime.timezone.utc)
-    timestamp = timestamp.replace(microsecond=0)
-    if args.round:
-        epoch_time = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
-        delta = int((timestamp - epoch_time).total_seconds()) % args.interval
-        end_timestamp = timestamp - datetime.timedelta(seconds=delta)
-        start_timestamp = end_timestamp - datetime.timedelta(seconds=args.interval)
-        invoke_after_timestamp = start_timestamp - datetime.timedelta(seconds=60)
+    if args.ignore_rules:
+        IGNORE_RULES = load_ignore_rules(args.ignore_rules,
+                                         IGNORE_FAILURES_WITHOUT_ASSOCIATION,
+                                         IGNORE_FAILURES_BY_TAGS,
+                                         IGNORE_FAILURES_BY_COMMENT)
+
+    if min([args.interval] + (args.windows or []) + [1 if args.buckets is None else args.buckets]) <= 0:
+        parser.error('--interval, --windows and --buckets must be positive')
+    # all windows are rolled up from buckets of one fetch covering the widest
+    if args.buckets:
+        span = args.interval * args.buckets
+        bucket_secs = args.interval
     else:
-        start_timestamp = timestamp - datetime.timedelta(seconds=args.interval)
-        end_timestamp = timestamp
-        invoke_after_timestamp = start_timestamp
-    one_day_ago_timestamp = timestamp - datetime.timedelta(days=1)
-
-    if args.profile:
-        AWSCLI_COMMON_ARGS += ["--profile", args.profile]
-
-    tags_json = describe_tags()
-    tags_dict = tags_json_to_instance_dict(tags_json)
-    associations_json = list_associations()
-    associations_dict = associations_json_to_associations_dict(associations_json)
-    commands_json = list_commands(one_day_ago_timestamp)
-    command_invocations_json = list_command_invocations(invoke_after_timestamp)
-    commands_summary = get_commands_summary(commands_json,
-                                            command_invocations_json,
-                                            tags_dict,
-                                            associations_dict,
-                                            args.verbose,
-                                            start_timestamp,
-                                            end_timestamp)
-    print_commands_summary_csv(commands_summary, end_timestamp.strftime("%Y-%m-%dT%TZ"))
-
-
-main()
+        span = max([args.interval] + (args.windows or []))
+        bucket_secs = math.gcd(args.interval, *(args.windows or []))
+    if span // bucket_secs > MAX_BUCKETS:
+        parser.error(f'--windows need more than {MAX_BUCKETS} buckets of {bucket_secs} seconds')
+    show_window = bool(args.windows or args.buckets)
+    if args.daemon and args.failure_output:
+        parser.error('--failure-output is not supported with --daemon')
+    # timings cover every account, so there's no one account to upload them to
+    if args.timings and args.cloudwatch and not args.daemon and (args.accounts or args.accounts_file):
+        parser.error('--timings with --cloudwatch is not supported with --accounts')
+
+    instance_metrics_policy = None
+    if args.instance_top or args.instance_threshold is not None or args.instance_tags:
+        instance_metrics_policy = InstanceMetricsPolicy(args.instance_top,
+                                                        args.instance_threshold,
+                                                        args.instance_tags,
+                                                        args.max_series)
+
+    # in daemon mode state is kept between polls, in memory unless --state
+    states = {}
+    # instance tags by account, for instance metric dimensions
+    accounts_tags = {}
+    # failed invocations by account, for --failure-output
+    accounts_failures = {}
+
+    def get_summary(profile, timestamps):
+        client = aws_client.get_backend(args.backend,
+                                        profile=profile,
+                                        endpoint_url=args.endpoint_url)
+        state = states.get(profile)
+        accounts_tags[profile] = {}
+        accounts_failures[profile] = []
+        if args.state and not args.daemon:
+            state = ssm_state.StateStore(args.state, profile)
+        try:
+            return get_account_commands_summary(client,
+                                                args.verbose,
+                                                *timestamps,
+                                                state,
+                                                args.tags_ttl,
+                                                get_windows(timestamps[1], args.interval,
+                                                            args.windows, args.buckets),
+                                                accounts_tags[profile],
+                                                accounts_failures[profile] if args.failure_output else None)
+        finally:
+            if state and not args.daemon:
+                state.close()
+
+    def upload_metrics(profile, windows_summary):
+        if not args.cloudwatch:
+            return
+        client = aws_client.get_backend(args.backend,
+                                        profile=profile,
+                                        region=cloudwatch.CLOUDWATCH_REGION,
+                                        endpoint_url=args.endpoint_url)
+        metric_data = commands_summary_to_metric_data(windows_summary, args.interval,
+                                                      instance_metrics_policy,
+                                                      accounts_tags.get(profile))
+        with timings.phase('cloudwatch') as timer:
+            cloudwatch.put_metric_data(client, metric_data, args.dryrun)
+            timer.add_records(len(metric_data))
+
+    accounts = args.accounts
+    if args.accounts_file:
+        accounts = read_accounts_file(args.accounts_file)
+
+    if args.daemon:
+        for account in accounts or [args.profile]:
+            states[account] = ssm_state.StateStore(args.state or ':memory:', account)
+        metrics_server = prometheus.MetricsServer(args.metrics_address, args.metrics_port)
+        run_daemon(accounts or [args.profile], get_summary, upload_metrics, metrics_server,
+                   args.interval, args.round, args.poll_interval, span, args.document_retention)
+        for state in states.values():
+            state.close()
+        if args.timings:
+            timings.write_report(args.timings)
+        return
+
+    timestamps = get_timestamps(datetime.datetime.now(datetime.timezone.utc),
+                                args.interval, args.round, span, args.document_retention)
+    csv_timestamp = timestamps[1].strftime("%Y-%m-%dT%TZ")
+    if accounts:
+        accounts_summary = get_accounts_commands_summary(
+            accounts, lambda account: get_summary(account, timestamps))
+        with timings.phase('output'):
+            print_accounts_summary_csv(accounts_summary, csv_timestamp, show_window)
+        for account, windows_summary in accounts_summary.items():
+            if not isinstance(windows_summary, Exception):
+                upload_metrics(account, windows_summary)
+    else:
+        windows_summary = get_summary(args.profile, timestamps)
+        with timings.phase('output'):
+            print_commands_summary_csv(windows_summary, show_window)
+        upload_metrics(args.profile, windows_summary)
+        accounts_summary = {args.profile: windows_summary}
+
+    if args.failure_output:
+        with timings.phase('failure_output') as timer:
+            num_records = write_failure_output(args.failure_output, accounts_failures, args,
+                                               time.monotonic() + args.failure_output_budget)
+            timer.add_records(num_records)
+
+    if args.timings:
+        report = timings.get_report()
+        timings.write_report(args.timings, report)
+        if args.cloudwatch:
+            client = aws_client.get_backend(args.backend,
+                                            profile=args.profile,
+                                            region=cloudwatch.CLOUDWATCH_REGION,
+                                            endpoint_url=args.endpoint_url)
+            cloudwatch.put_metric_data(client,
+                                       timings.report_to_metric_data(report, csv_timestamp,
+                                                                     'ssm-command-monitor'),
+                                       args.dryrun)
+
+    if args.verbose >= 4:
+        for name, counters in scheduler.get_counters().items():
+            sys.stderr.write(f'Verbose4: scheduler {name}: {json.dumps(counters)}{os.linesep}')
+    if any(isinstance(summary, Exception) for summary in accounts_summary.values()):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,321 @@
+"""Local SQLite state store for incremental ssm-command-monitor.py runs
+
+Command invocations fetched by previous runs are kept along with a
+RequestedDateTime watermark, and the start of the time they cover.
+Subsequent runs only need to fetch invocations newer than the watermark,
+plus re-check any which were still pending. Invocations older than the
+lookback window are pruned, moving the coverage start forward, so a later
+run with a wider lookback fetches everything again.
+
+The names of documents seen in invocations are kept in a registry, with
+when each was last seen, so every document can be reported with zero
+counts for a retention period without listing a day of command history on
+each run. Names not seen within the retention period are expired.
+
+Resolved EC2 instance tags are also cached here, see instance_tags.py, as
+is the output of failed invocations, see failure_output.py.
+"""
+
+import datetime
+import json
+import os
+import sqlite3
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from monitoring_common import aggregation  # pylint: disable=wrong-import-position
+
+# Re-fetch a little before the watermark in case of late arriving records
+WATERMARK_OVERLAP_SECS = 300
+PENDING_STATUSES = ('Pending', 'InProgress', 'Delayed')
+SQLITE_TIMEOUT_SECS = 60
+SQLITE_MAX_VARIABLES = 900
+SQLITE_WRITE_BATCH_ROWS = 1000
+DOCUMENT_NAMES_RETENTION_SECS = 86400
+SCHEMA_VERSION = 1
+
+# Statements to upgrade a store to each schema version, from the one before
+MIGRATIONS = {
+    1: 'DROP TABLE IF EXISTS commands;',  # replaced by the document_names registry
+}
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS watermarks (
+    account TEXT NOT NULL,
+    name TEXT NOT NULL,
+    requested REAL NOT NULL,
+    PRIMARY KEY (account, name)
+);
+CREATE TABLE IF NOT EXISTS coverage (
+    account TEXT NOT NULL,
+    name TEXT NOT NULL,
+    start REAL NOT NULL,
+    PRIMARY KEY (account, name)
+);
+CREATE TABLE IF NOT EXISTS document_names (
+    account TEXT NOT NULL,
+    document_name TEXT NOT NULL,
+    last_seen REAL NOT NULL,
+    PRIMARY KEY (account, document_name)
+);
+CREATE TABLE IF NOT EXISTS command_invocations (
+    account TEXT NOT NULL,
+    command_id TEXT NOT NULL,
+    instance_id TEXT NOT NULL,
+    requested REAL NOT NULL,
+    status TEXT NOT NULL,
+    invocation TEXT NOT NULL,
+    PRIMARY KEY (account, command_id, instance_id)
+);
+CREATE INDEX IF NOT EXISTS command_invocations_requested
+    ON command_invocations (account, requested);
+CREATE TABLE IF NOT EXISTS command_outputs (
+    account TEXT NOT NULL,
+    command_id TEXT NOT NULL,
+    instance_id TEXT NOT NULL,
+    requested REAL NOT NULL,
+    output TEXT NOT NULL,
+    PRIMARY KEY (account, command_id, instance_id)
+);
+CREATE TABLE IF NOT EXISTS instance_tags (
+    account TEXT NOT NULL,
+    instance_id TEXT NOT NULL,
+    updated REAL NOT NULL,
+    tags TEXT NOT NULL,
+    PRIMARY KEY (account, instance_id)
+);
+'''
+
+
+def requested_epoch(record):
+    """Get RequestedDateTime of an SSM command or invocation as epoch seconds"""
+
+    return aggregation.parse_timestamp(record['RequestedDateTime']).timestamp()
+
+
+def get_document_names_last_seen(records):
+    """Get dict of DocumentName to latest RequestedDateTime epoch seconds of
+    SSM commands or invocations"""
+
+    last_seen = {}
+    for record in records:
+        requested = requested_epoch(record)
+        last_seen[record['DocumentName']] = max(requested, last_seen.get(record['DocumentName'], requested))
+    return last_seen
+
+
+class StateStore:
+    """Incremental state for one account. Not thread safe, but may be used
+    from different threads one at a time, e.g. by successive --daemon polls.
+    A filename of ':memory:' keeps state for the life of the process"""
+
+    def __init__(self, filename, account=None):
+        self.account = account or ''
+        self.db = sqlite3.connect(filename, timeout=SQLITE_TIMEOUT_SECS, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.executescript(SCHEMA)
+        self.migrate()
+
+    def migrate(self):
+        """Upgrade a store written by an earlier version, once"""
+
+        version = self.db.execute('PRAGMA user_version').fetchone()[0]
+        for target in range(version + 1, SCHEMA_VERSION + 1):
+            self.db.executescript(f'{MIGRATIONS[target]}\nPRAGMA user_version = {target};')
+
+    def close(self):
+        """Close the database"""
+
+        self.db.close()
+
+    def fetch_after(self, name, timestamp):
+        """Get the timestamp to fetch records after, i.e. the watermark less
+        an overlap or the given timestamp, whichever is later. If the store
+        doesn't cover back to timestamp, it is returned so all are fetched"""
+
+        coverage = self.db.execute(
+            'SELECT start FROM coverage WHERE account = ? AND name = ?',
+            (self.account, name)).fetchone()
+        if coverage is None or timestamp.timestamp() < coverage[0]:
+            return timestamp
+        row = self.db.execute(
+            'SELECT requested FROM watermarks WHERE account = ? AND name = ?',
+            (self.account, name)).fetchone()
+        if row is None:
+            return timestamp
+        watermark = datetime.datetime.fromtimestamp(
+            int(row[0]) - WATERMARK_OVERLAP_SECS, datetime.timezone.utc)
+        return max(timestamp, watermark)
+
+    def update_coverage(self, name, timestamp):
+        """Record that all records after timestamp have been fetched"""
+
+        with self.db:
+            self.db.execute(
+                'INSERT INTO coverage (account, name, start) VALUES (?, ?, ?) '
+                'ON CONFLICT (account, name) DO UPDATE SET start = MIN(start, excluded.start)',
+                (self.account, name, timestamp.timestamp()))
+
+    def update_watermark(self, name, requested):
+        """Move the watermark forward"""
+
+        self.db.execute(
+            'INSERT INTO watermarks (account, name, requested) VALUES (?, ?, ?) '
+            'ON CONFLICT (account, name) DO UPDATE SET requested = MAX(requested, excluded.requested)',
+            (self.account, name, requested))
+
+    def update_document_names(self, last_seen):
+        """Add document names to the registry, a dict of DocumentName to
+        epoch seconds last seen"""
+
+        with self.db:
+            self.db.executemany(
+                'INSERT INTO document_names (account, document_name, last_seen) VALUES (?, ?, ?) '
+                'ON CONFLICT (account, document_name) DO UPDATE SET last_seen = MAX(last_seen, excluded.last_seen)',
+                [(self.account, document_name, requested) for document_name, requested in last_seen.items()])
+
+    def get_document_names(self, timestamp):
+        """Get names of documents last seen on or after timestamp, most
+        recently seen first, the order list-commands would first see them"""
+
+        rows = self.db.execute(
+            'SELECT document_name FROM document_names WHERE account = ? AND last_seen >= ? '
+            'ORDER BY last_seen DESC, document_name',
+            (self.account, timestamp.timestamp()))
+        return [row[0] for row in rows]
+
+    def update_command_invocations(self, command_invocations):
+        """Insert or update SSM command invocations, which may be a generator,
+        and add their document names to the registry. Rows are written in
+        batches, each in its own transaction, so the write lock isn't held
+        while a generator waits for the next page. The watermark only moves
+        once every invocation has been written"""
+
+        watermark = None
+        last_seen = {}
+        rows = []
+        for invocation in command_invocations:
+            requested = requested_epoch(invocation)
+            watermark = requested if watermark is None else max(watermark, requested)
+            document_name = invocation['DocumentName']
+            last_seen[document_name] = max(requested, last_seen.get(document_name, requested))
+            rows.append((self.account, invocation['CommandId'], invocation['InstanceId'],
+                         requested, invocation['Status'], json.dumps(invocation)))
+            if len(rows) >= SQLITE_WRITE_BATCH_ROWS:
+                self.insert_command_invocations(rows)
+                rows = []
+        self.insert_command_invocations(rows)
+
+        with self.db:
+            self.update_document_names(last_seen)
+            if watermark is not None:
+                self.update_watermark('command_invocations', watermark)
+
+    def insert_command_invocations(self, rows):
+        """Insert or replace a batch of command_invocations rows"""
+
+        with self.db:
+            self.db.executemany(
+                'INSERT OR REPLACE INTO command_invocations '
+                '(account, command_id, instance_id, requested, status, invocation) '
+                'VALUES (?, ?, ?, ?, ?, ?)', rows)
+
+    def get_command_invocations(self, timestamp):
+        """Yield SSM command invocations requested on or after timestamp,
+        newest first as list-command-invocations returns them"""
+
+        rows = self.db.execute(
+            'SELECT invocation FROM command_invocations WHERE account = ? AND requested >= ? '
+            'ORDER BY requested DESC, rowid',
+            (self.account, timestamp.timestamp()))
+        for row in rows:
+            yield json.loads(row[0])
+
+    def get_pending_command_ids(self, timestamp, fetch_after_timestamp):
+        """Get IDs of commands with invocations requested between the two
+        timestamps that were still pending when last fetched"""
+
+        placeholders = ','.join('?' * len(PENDING_STATUSES))
+        rows = self.db.execute(
+            'SELECT DISTINCT command_id FROM command_invocations '
+            f'WHERE account = ? AND requested >= ? AND requested < ? AND status IN ({placeholders})',
+            (self.account, timestamp.timestamp(), fetch_after_timestamp.timestamp()) +
+            PENDING_STATUSES)
+        return [row[0] for row in rows]
+
+    def get_instance_tags(self, instance_ids, min_updated, not_found_min_updated=None):
+        """Get cached tags updated after min_updated epoch seconds, or for
+        instances that were not found, after not_found_min_updated if given.
+        Returns dict of instance_id to tags, or None if instance was not found"""
+
+        if not_found_min_updated is None:
+            not_found_min_updated = min_updated
+        instance_tags = {}
+        for i in range(0, len(instance_ids), SQLITE_MAX_VARIABLES):
+            batch = instance_ids[i:i + SQLITE_MAX_VARIABLES]
+            placeholders = ','.join('?' * len(batch))
+            rows = self.db.execute(
+                'SELECT instance_id, tags FROM instance_tags '
+                "WHERE account = ? AND updated >= CASE WHEN tags = 'null' THEN ? ELSE ? END "
+                f'AND instance_id IN ({placeholders})',
+                [self.account, not_found_min_updated, min_updated] + batch)
+            for instance_id, tags in rows:
+                instance_tags[instance_id] = json.loads(tags)
+        return instance_tags
+
+    def update_instance_tags(self, instance_tags, updated):
+        """Cache tags, a dict of instance_id to tags or None if not found"""
+
+        with self.db:
+            self.db.executemany(
+                'INSERT OR REPLACE INTO instance_tags (account, instance_id, updated, tags) '
+                'VALUES (?, ?, ?, ?)',
+                [(self.account, instance_id, updated, json.dumps(tags))
+                 for instance_id, tags in instance_tags.items()])
+
+    def get_command_outputs(self, keys):
+        """Get cached output for a list of (command_id, instance_id). Returns
+        dict of (command_id, instance_id) to output"""
+
+        outputs = {}
+        for command_id, instance_id in keys:
+            row = self.db.execute(
+                'SELECT output FROM command_outputs '
+                'WHERE account = ? AND command_id = ? AND instance_id = ?',
+                (self.account, command_id, instance_id)).fetchone()
+            if row:
+                outputs[(command_id, instance_id)] = json.loads(row[0])
+        return outputs
+
+    def update_command_outputs(self, outputs):
+        """Cache output of finished invocations, a dict of (command_id,
+        instance_id) to (requested epoch seconds, output)"""
+
+        with self.db:
+            self.db.executemany(
+                'INSERT OR REPLACE INTO command_outputs (account, command_id, instance_id, requested, output) '
+                'VALUES (?, ?, ?, ?, ?)',
+                [(self.account, command_id, instance_id, requested, json.dumps(output))
+                 for (command_id, instance_id), (requested, output) in outputs.items()])
+
+    def prune(self, document_names_timestamp, command_invocations_timestamp, instance_tags_updated):
+        """Delete records older than the lookback windows, document names not
+        seen since the retention period, and cached tags updated before
+        instance_tags_updated epoch seconds"""
+
+        with self.db:
+            self.db.execute(
+                'DELETE FROM document_names WHERE account = ? AND last_seen < ?',
+                (self.account, document_names_timestamp.timestamp()))
+            self.db.execute(
+                'DELETE FROM command_invocations WHERE account = ? AND requested < ?',
+                (self.account, command_invocations_timestamp.timestamp()))
+            self.db.execute(
+                "UPDATE coverage SET start = MAX(start, ?) WHERE account = ? AND name = 'command_invocations'",
+                (command_invocations_timestamp.timestamp(), self.account))
+            self.db.execute(
+                'DELETE FROM command_outputs WHERE account = ? AND requested < ?',
+                (self.account, command_invocations_timestamp.timestamp()))
+            self.db.execute(
+                'DELETE FROM instance_tags WHERE account = ? AND updated < ?',
+                (self.account, instance_tags_updated))